@@ -0,0 +1,128 @@
+# ベンチマーク用の決定的なチャットモデル
+# Geminiを呼ばずに、指定した遅延でツール呼び出しと応答のトークンを返す
+#
+# 環境変数(LLM_BACKEND=fakeのときにllm_serverが読む)
+# - FAKE_MODEL_LATENCY: 最初のトークンまでの秒数
+# - FAKE_MODEL_TOKEN_LATENCY: トークンごとの秒数
+# - FAKE_MODEL_TOOLS: ユーザの発言ごとに順に呼び出すツール名(カンマ区切り). 空ならツールを使わない
+# - FAKE_MODEL_RESPONSE_TOKENS: 最終応答のトークン数
+import asyncio
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Iterator, Sequence
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+RESPONSE_TOKEN = "ピラティス"
+
+
+class FakeChatModel(BaseChatModel):
+  latency: float = 0.5
+  token_latency: float = 0.01
+  tool_sequence: list[str] = []
+  response_tokens: int = 50
+  # bind_toolsで渡されたツールの引数のJSON Schema
+  tool_parameters: dict[str, dict[str, Any]] = {}
+
+  @classmethod
+  def from_env(cls, **kwargs: Any) -> "FakeChatModel":
+    tools = os.getenv("FAKE_MODEL_TOOLS", "")
+    return cls(
+      latency=float(os.getenv("FAKE_MODEL_LATENCY", "0.5")),
+      token_latency=float(os.getenv("FAKE_MODEL_TOKEN_LATENCY", "0.01")),
+      tool_sequence=[name for name in tools.split(",") if name],
+      response_tokens=int(os.getenv("FAKE_MODEL_RESPONSE_TOKENS", "50")),
+      **kwargs,
+    )
+
+  @property
+  def _llm_type(self) -> str:
+    return "fake"
+
+  def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> "FakeChatModel":
+    parameters = {}
+    for tool in tools:
+      function = convert_to_openai_tool(tool)["function"]
+      parameters[function["name"]] = function.get("parameters", {})
+    return self.model_copy(update={"tool_parameters": parameters})
+
+  def _tool_args(self, name: str) -> dict[str, Any]:
+    args = {}
+    for key, schema in self.tool_parameters[name].get("properties", {}).items():
+      if schema.get("type") == "integer":
+        args[key] = 3
+      elif schema.get("type") == "number":
+        args[key] = 1.0
+      elif schema.get("type") == "boolean":
+        args[key] = True
+      else:
+        args[key] = RESPONSE_TOKEN
+    return args
+
+  def _reply(self, messages: list[BaseMessage]) -> AIMessage:
+    # 最後のユーザの発言以降に実行したツールの数で、次に呼ぶツールを決める
+    tool_results = 0
+    for message in reversed(messages):
+      if isinstance(message, HumanMessage):
+        break
+      if isinstance(message, ToolMessage):
+        tool_results += 1
+
+    tool_sequence = [name for name in self.tool_sequence if name in self.tool_parameters]
+    if tool_results < len(tool_sequence):
+      name = tool_sequence[tool_results]
+      tool_call = {"id": f"call_{len(messages)}", "name": name, "args": self._tool_args(name)}
+      return AIMessage(content="", tool_calls=[tool_call])
+    return AIMessage(content=" ".join([RESPONSE_TOKEN] * self.response_tokens))
+
+  def _chunks(self, message: AIMessage) -> list[AIMessageChunk]:
+    if message.tool_calls:
+      tool_call = message.tool_calls[0]
+      tool_call_chunk = {
+        "id": tool_call["id"],
+        "name": tool_call["name"],
+        "args": json.dumps(tool_call["args"]),
+        "index": 0,
+      }
+      return [AIMessageChunk(content="", tool_call_chunks=[tool_call_chunk])]
+    return [AIMessageChunk(content=token + " ") for token in message.content.split(" ")]
+
+  def _generate(
+    self, messages: list[BaseMessage], stop: Any = None, run_manager: Any = None, **kwargs: Any
+  ) -> ChatResult:
+    message = self._reply(messages)
+    time.sleep(self.latency + self.token_latency * len(self._chunks(message)))
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+  async def _agenerate(
+    self, messages: list[BaseMessage], stop: Any = None, run_manager: Any = None, **kwargs: Any
+  ) -> ChatResult:
+    message = self._reply(messages)
+    await asyncio.sleep(self.latency + self.token_latency * len(self._chunks(message)))
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+  def _stream(
+    self, messages: list[BaseMessage], stop: Any = None, run_manager: Any = None, **kwargs: Any
+  ) -> Iterator[ChatGenerationChunk]:
+    time.sleep(self.latency)
+    for chunk in self._chunks(self._reply(messages)):
+      time.sleep(self.token_latency)
+      generation = ChatGenerationChunk(message=chunk)
+      if run_manager is not None and chunk.content:
+        run_manager.on_llm_new_token(chunk.content, chunk=generation)
+      yield generation
+
+  async def _astream(
+    self, messages: list[BaseMessage], stop: Any = None, run_manager: Any = None, **kwargs: Any
+  ) -> AsyncIterator[ChatGenerationChunk]:
+    await asyncio.sleep(self.latency)
+    for chunk in self._chunks(self._reply(messages)):
+      await asyncio.sleep(self.token_latency)
+      generation = ChatGenerationChunk(message=chunk)
+      if run_manager is not None and chunk.content:
+        await run_manager.on_llm_new_token(chunk.content, chunk=generation)
+      yield generation
@@ -0,0 +1,141 @@
+# UIから推論サーバへのリクエストを、毎回新しい接続で送る場合(fresh)と共有のInferClientで送る場合(pooled)で比べる
+# 偽のチャットモデルでllm_serverを起動し、Streamlitのセッションを模したスレッドから/toolsと/v2/inferを呼ぶ
+# appディレクトリで実行する: uv run python -m benchmark.http_client_bench --sessions 8 --reruns 50 --output http.json
+#
+# - fresh: 変更前のcommon/inference.pyと同じく、requests.get/requests.postで呼ぶ
+# - pooled: keep-aliveの接続を使い回し、1KB以上の本文はgzipで圧縮する
+import argparse
+import asyncio
+import gzip
+import json
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+import httpx
+import requests
+from benchmark.load_test import free_port, percentile, start_server, wait_ready
+from benchmark.wire_format_bench import create_history
+from common.http_client import GZIP_LEVEL, InferClient
+from common.wire import InferRequestV2, to_wire
+
+
+def fresh_rerun(base_url: str, body: bytes | None) -> None:
+  requests.get(base_url + "/tools").raise_for_status()
+  if body is not None:
+    response = requests.post(base_url + "/v2/infer", data=body, headers={"Content-Type": "application/json"})
+    response.raise_for_status()
+
+
+def pooled_rerun(client: InferClient, body: bytes | None) -> None:
+  client.request("GET", "/tools", retry=True).raise_for_status()
+  if body is not None:
+    response = client.request("POST", "/v2/infer", data=body, headers={"Content-Type": "application/json"})
+    response.raise_for_status()
+
+
+def run_reruns(rerun: Callable[[], None], sessions: int, reruns: int) -> dict[str, Any]:
+  def session(_: int) -> list[float]:
+    latencies = []
+    for _ in range(reruns):
+      started_at = time.perf_counter()
+      rerun()
+      latencies.append(time.perf_counter() - started_at)
+    return latencies
+
+  started_at = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=sessions) as executor:
+    latencies = [latency for result in executor.map(session, range(sessions)) for latency in result]
+  return {
+    "reruns": len(latencies),
+    "elapsed_seconds": time.perf_counter() - started_at,
+    "mean_seconds": statistics.mean(latencies),
+    "latency_seconds": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+  }
+
+
+async def wait_server(port: int, process: Any, timeout: float) -> None:
+  async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+    await wait_ready(client, process, timeout)
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+  history = create_history(args.history)
+  body = InferRequestV2(messages=[to_wire(message) for message in history]).model_dump_json(exclude_defaults=True)
+  body = body.encode()
+  port = free_port()
+  base_url = f"http://127.0.0.1:{port}"
+  results: dict[str, Any] = {
+    "request_bytes": len(body),
+    "compressed_request_bytes": len(gzip.compress(body, compresslevel=GZIP_LEVEL)),
+  }
+  with tempfile.TemporaryDirectory() as work_dir:
+    process = start_server(args, work_dir, port)
+    try:
+      asyncio.run(wait_server(port, process, args.startup_timeout))
+      # tools: 通信のコストが目立つ軽いリクエストだけ, infer: /toolsと履歴付きの/v2/infer
+      for scenario, scenario_body in (("tools", None), ("infer", body)):
+        results[f"fresh_{scenario}"] = run_reruns(
+          partial(fresh_rerun, base_url, scenario_body), args.sessions, args.reruns
+        )
+
+      client = InferClient(
+        base_url,
+        pool_size=args.sessions,
+        connect_timeout=5,
+        read_timeout=args.timeout,
+        retries=2,
+        retry_backoff=0.2,
+        gzip_min_bytes=args.gzip_min_bytes,
+      )
+      for scenario, scenario_body in (("tools", None), ("infer", body)):
+        results[f"pooled_{scenario}"] = run_reruns(
+          partial(pooled_rerun, client, scenario_body), args.sessions, args.reruns
+        )
+      results["client_stats"] = client.stats()
+    finally:
+      process.terminate()
+      process.wait()
+  return results
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sessions", type=int, default=8, help="concurrent Streamlit sessions")
+  parser.add_argument("--reruns", type=int, default=50, help="reruns per session")
+  # ツールの呼び出しと結果が揃うよう4の倍数にする(create_historyは4件で1往復)
+  parser.add_argument("--history", type=int, default=32, help="messages sent to /v2/infer")
+  parser.add_argument("--gzip-min-bytes", type=int, default=1024)
+  # load_test.start_serverが使う偽のモデルの設定. 通信のコストを比べるのでモデルの待ち時間は0にする
+  parser.add_argument("--model-latency", type=float, default=0.0)
+  parser.add_argument("--token-latency", type=float, default=0.0)
+  parser.add_argument("--response-tokens", type=int, default=20)
+  parser.add_argument("--tools", type=str, default="")
+  parser.add_argument("--tool-latency", type=float, default=0.0)
+  parser.add_argument("--pool-size", type=int, default=1)
+  parser.add_argument("--timeout", type=float, default=60)
+  parser.add_argument("--startup-timeout", type=float, default=60)
+  parser.add_argument("--output", type=str, default="")
+  args = parser.parse_args()
+
+  results = run(args)
+  for name in ("fresh_tools", "pooled_tools", "fresh_infer", "pooled_infer"):
+    summary = results[name]
+    latency = " ".join(f"{p}={v * 1000:.2f}ms" for p, v in summary["latency_seconds"].items())
+    print(f"{name}: {summary['reruns']} reruns in {summary['elapsed_seconds']:.2f}s, {latency}")
+  stats = results["client_stats"]
+  print(
+    f"pooled connections: new={stats['new_connections']} reused={stats['reused_connections']}, "
+    f"request body {results['request_bytes']}B -> {results['compressed_request_bytes']}B"
+  )
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({"benchmark": "http_client_bench", "config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,245 @@
+# 偽のチャットモデルとスタブのMCPサーバでllm_serverを起動し、並列にリクエストを送ってレイテンシを測る
+# Geminiのクォータを使わずにスループットの変化を比較できる
+# appディレクトリで実行する: uv run python -m benchmark.load_test --concurrency 16 --requests 200 --output load.json
+#
+# 1つの仮想ユーザは1つのセッション(/session/infer/stream)で会話を続ける
+# 最初のリクエストは履歴とシステムプロンプトを送り、以降は新しい発言だけを送る
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any
+
+import httpx
+from common.wire import InferRequestV2, to_wire
+from langchain_core.messages import HumanMessage
+from langchain_core.messages.base import messages_to_dict
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_SERVER_PATH = os.path.join(APP_DIR, "benchmark", "stub_mcp_server.py")
+SYSTEM_PROMPT = (
+  "あなたはピラティスの習慣化をサポートするコーチです。生徒の目標と実施履歴を踏まえて助言してください。\n" * 40
+)
+
+
+def percentile(values: list[float], p: float) -> float:
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def free_port() -> int:
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+
+def write_config(work_dir: str, pool_size: int) -> str:
+  # create_server_paramsはenvの値を環境変数名として読むので、サーバ側の環境変数に種類を入れておく
+  config = {
+    "mcpServers": {
+      kind: {
+        "command": sys.executable,
+        "args": [STUB_SERVER_PATH],
+        "env": {"STUB_MCP_KIND": f"BENCH_{kind.upper()}_KIND", "STUB_MCP_LATENCY": "BENCH_TOOL_LATENCY"},
+        "poolSize": pool_size,
+      }
+      for kind in ("video", "web")
+    }
+  }
+  config_path = os.path.join(work_dir, "config.json")
+  with open(config_path, "w") as f:
+    json.dump(config, f)
+  return config_path
+
+
+def start_server(
+  args: argparse.Namespace, work_dir: str, port: int, config_path: str = "", workers: int = 1
+) -> subprocess.Popen:
+  env = dict(os.environ)
+  env.update(
+    {
+      "LLM_BACKEND": "fake",
+      "FAKE_MODEL_LATENCY": str(args.model_latency),
+      "FAKE_MODEL_TOKEN_LATENCY": str(args.token_latency),
+      "FAKE_MODEL_TOOLS": args.tools,
+      "FAKE_MODEL_RESPONSE_TOKENS": str(args.response_tokens),
+      "BENCH_VIDEO_KIND": "video",
+      "BENCH_WEB_KIND": "web",
+      "BENCH_TOOL_LATENCY": str(args.tool_latency),
+      "MCP_CONFIG_PATH": config_path or write_config(work_dir, args.pool_size),
+      "MCP_MANIFEST_PATH": os.path.join(work_dir, "mcp_manifest.json"),
+      "SESSION_DB_PATH": os.path.join(work_dir, "sessions.sqlite"),
+      "LANGCHAIN_TRACING": "false",
+      # 偽のモデルはトークン数を数えられないので文字数から見積もる
+      "HISTORY_TOKEN_COUNTER": "estimate",
+    }
+  )
+  # 実際のキーは使わないが、llm_serverの起動に必要
+  for key in ("GOOGLE_API_KEY", "GOOGLE_CUSTOM_SEARCH_API_KEY", "GOOGLE_CUSTOM_SEARCH_ENGINE_ID"):
+    env.setdefault(key, "benchmark")
+  # ユーザごとのレート制限は測定の邪魔になるので、指定が無ければ実質無効にする
+  env.setdefault("USER_REQUESTS_PER_MINUTE", "1000000")
+  env.setdefault("USER_BURST", "1000000")
+
+  command = [sys.executable, "-m", "uvicorn", "llm_server:app", "--port", str(port), "--log-level", "warning"]
+  if workers > 1:
+    command += ["--workers", str(workers)]
+  log = open(os.path.join(work_dir, "server.log"), "w")
+  return subprocess.Popen(command, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(client: httpx.AsyncClient, process: subprocess.Popen, timeout: float) -> None:
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError("llm_server exited during startup")
+    try:
+      response = await client.get("/ready")
+      if response.status_code == 200:
+        return
+    except httpx.TransportError:
+      pass
+    await asyncio.sleep(0.2)
+  raise RuntimeError(f"llm_server was not ready within {timeout}s")
+
+
+async def session_turn(client: httpx.AsyncClient, user: str, first: bool, result: dict[str, Any]) -> None:
+  message = HumanMessage(content="今日は朝にピラティスを10分やりました。首が少し痛いです。", id=str(uuid.uuid4()))
+  payload: dict[str, Any] = {"session_id": f"bench/{user}"}
+  if first:
+    payload["history"] = messages_to_dict([message])
+    payload["system_prompt"] = SYSTEM_PROMPT
+  else:
+    payload["messages"] = messages_to_dict([message])
+
+  started_at = time.perf_counter()
+  async with client.stream("POST", "/session/infer/stream", json=payload, headers={"X-User-Name": user}) as response:
+    result["status"] = response.status_code
+    if response.status_code != 200:
+      await response.aread()
+      return
+    async for line in response.aiter_lines():
+      if not line:
+        continue
+      event = json.loads(line)
+      if event["type"] == "token" and "ttft" not in result:
+        result["ttft"] = time.perf_counter() - started_at
+      elif event["type"] == "error":
+        result["error"] = event.get("detail", "")
+
+
+async def v2_turn(client: httpx.AsyncClient, user: str, first: bool, result: dict[str, Any]) -> None:
+  message = HumanMessage(content="今日は朝にピラティスを10分やりました。首が少し痛いです。")
+  body = InferRequestV2(messages=[to_wire(message)]).model_dump_json(exclude_defaults=True)
+  headers = {"Content-Type": "application/json", "X-User-Name": user}
+  response = await client.post("/v2/infer", content=body, headers=headers)
+  result["status"] = response.status_code
+
+
+async def run_load(client: httpx.AsyncClient, args: argparse.Namespace) -> tuple[list[dict[str, Any]], float]:
+  turn = session_turn if args.endpoint == "session" else v2_turn
+  remaining = [args.requests]
+  results: list[dict[str, Any]] = []
+
+  async def virtual_user(index: int) -> None:
+    user = f"user{index}"
+    first = True
+    while remaining[0] > 0:
+      remaining[0] -= 1
+      result: dict[str, Any] = {}
+      started_at = time.perf_counter()
+      try:
+        await turn(client, user, first, result)
+      except httpx.HTTPError as e:
+        result["error"] = str(e)
+      result["latency"] = time.perf_counter() - started_at
+      results.append(result)
+      # 失敗した場合はセッションが作られていないことがあるので、次も履歴から送る
+      first = result.get("status") != 200 or "error" in result
+
+  started_at = time.perf_counter()
+  await asyncio.gather(*(virtual_user(i) for i in range(args.concurrency)))
+  return results, time.perf_counter() - started_at
+
+
+def summarize_results(results: list[dict[str, Any]], elapsed: float) -> dict[str, Any]:
+  succeeded = [r for r in results if r.get("status") == 200 and "error" not in r]
+  latencies = [r["latency"] for r in succeeded]
+  ttfts = [r["ttft"] for r in succeeded if "ttft" in r]
+  statuses: dict[str, int] = {}
+  for r in results:
+    status = str(r.get("status", "transport_error"))
+    statuses[status] = statuses.get(status, 0) + 1
+  return {
+    "requests": len(results),
+    "errors": len(results) - len(succeeded),
+    "error_rate": (len(results) - len(succeeded)) / len(results) if results else 0.0,
+    "statuses": statuses,
+    "elapsed_seconds": elapsed,
+    "throughput_rps": len(succeeded) / elapsed if elapsed else 0.0,
+    "latency_seconds": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+    "ttft_seconds": {f"p{p}": percentile(ttfts, p) for p in (50, 95, 99)},
+  }
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+  port = args.port or free_port()
+  with tempfile.TemporaryDirectory() as work_dir:
+    process = start_server(args, work_dir, port)
+    try:
+      limits = httpx.Limits(max_connections=args.concurrency)
+      async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=args.timeout, limits=limits) as client:
+        await wait_ready(client, process, args.startup_timeout)
+        results, elapsed = await run_load(client, args)
+    except Exception:
+      with open(os.path.join(work_dir, "server.log")) as f:
+        print(f.read()[-4000:], file=sys.stderr)
+      raise
+    finally:
+      process.terminate()
+      process.wait()
+  return summarize_results(results, elapsed)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--endpoint", choices=["session", "v2"], default="session")
+  parser.add_argument("--concurrency", type=int, default=8)
+  parser.add_argument("--requests", type=int, default=100)
+  parser.add_argument("--model-latency", type=float, default=0.5)
+  parser.add_argument("--token-latency", type=float, default=0.01)
+  parser.add_argument("--response-tokens", type=int, default=50)
+  parser.add_argument("--tools", type=str, default="video_search", help="comma separated tool names per turn")
+  parser.add_argument("--tool-latency", type=float, default=0.2)
+  parser.add_argument("--pool-size", type=int, default=1)
+  parser.add_argument("--timeout", type=float, default=120)
+  parser.add_argument("--startup-timeout", type=float, default=60)
+  parser.add_argument("--port", type=int, default=0)
+  parser.add_argument("--output", type=str, default="")
+  args = parser.parse_args()
+
+  summary = asyncio.run(run(args))
+  print(f"requests: {summary['requests']} (errors: {summary['errors']}, statuses: {summary['statuses']})")
+  print(f"throughput: {summary['throughput_rps']:.2f} req/s")
+  # /v2/inferはストリーミングしないので最初のトークンまでの時間は無い
+  names = ("latency_seconds", "ttft_seconds") if args.endpoint == "session" else ("latency_seconds",)
+  for name in names:
+    values = " ".join(f"{p}={v * 1000:.1f}ms" for p, v in summary[name].items())
+    print(f"{name.split('_')[0]}: {values}")
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({"benchmark": "load_test", "config": vars(args), "results": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,190 @@
+# Streamlitの再実行ごとにプロンプトのCSVを取得する場合(legacy)と、PromptStoreで共有する場合(store)を比べる
+# Googleスプレッドシートの代わりにローカルのHTTPサーバで遅延を入れてCSVを返す
+# appディレクトリで実行する: uv run python -m benchmark.prompt_store_bench --sessions 8 --reruns 50 --output prompt.json
+#
+# - legacy: pd.read_csvでダウンロードし、iterrowsでシステムプロンプトを組み立ててstr.formatで値を埋め込む(変更前のui.pyの処理)
+# - store: PromptStore.getで共有のシートを取り、コンパイル済みのテンプレートに値を埋め込む
+# 最後にHTTPサーバを止め、スナップショットから読み込めることを確認する
+import argparse
+import hashlib
+import json
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+
+import pandas as pd
+from benchmark.load_test import free_port, percentile
+from common.prompt_store import PromptStore
+
+GID = 0
+VALUES = {
+  "user_name": "テスト",
+  "habit_goal": "週に3回、朝にピラティスを10分行う",
+  "activity_history": "\n".join(f"2025-01-{day:02d}" for day in range(1, 29)),
+  "teacher_agent_chat": "首に負担をかけないように注意してください。",
+}
+
+
+def create_csv(rows: int) -> str:
+  lines = []
+  for i in range(rows):
+    key = f"phase{i % 2 + 1}_{i}" if i % 3 else f"common_{i}"
+    lines.append(
+      f'{key},"あなたはピラティスの習慣化をサポートするコーチです。{{user_name}}さんの目標は{{habit_goal}}です。({i})"'
+    )
+  lines.append('history,"実施履歴:\n{activity_history}\n先生からの伝言: {teacher_agent_chat}"')
+  for level in ("summarize_level1", "summarize_level2"):
+    lines.append(f'{level},"生徒との会話を要約してください。({level})"')
+  return "\n".join(lines) + "\n"
+
+
+class SheetServer:
+  def __init__(self, text: str, latency: float):
+    body = text.encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()}"'
+    self.counts = {"200": 0, "304": 0}
+    counts = self.counts
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self) -> None:
+        time.sleep(latency)
+        not_modified = self.headers.get("If-None-Match") == etag
+        with lock:
+          counts["304" if not_modified else "200"] += 1
+        if not_modified:
+          self.send_response(304)
+          self.send_header("ETag", etag)
+          self.end_headers()
+          return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    self.port = free_port()
+    self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+
+  @property
+  def url(self) -> str:
+    return f"http://127.0.0.1:{self.port}/export?format=csv"
+
+  def stop(self) -> None:
+    self.server.shutdown()
+    self.server.server_close()
+
+
+def legacy_system_prompt(phase: int, df: pd.DataFrame) -> str:
+  prompt = ""
+  for _, row in df.iterrows():
+    if "phase" in row.iloc[0] and f"phase{phase}" not in row.iloc[0]:
+      continue
+    if "summarize_level" in row.iloc[0]:
+      continue
+    prompt += row.iloc[1]
+    prompt += "\n-------------------------\n"
+  return prompt
+
+
+def legacy_rerun(url: str, phase: int) -> str:
+  df = pd.read_csv(f"{url}&gid={GID}", header=None)
+  return legacy_system_prompt(phase, df).format(**VALUES)
+
+
+def store_rerun(store: PromptStore, phase: int) -> str:
+  return store.get(GID).system_template(phase).render(VALUES).text
+
+
+def run_reruns(rerun: Callable[[int], str], sessions: int, reruns: int, think_time: float) -> dict[str, Any]:
+  def session(index: int) -> list[float]:
+    latencies = []
+    for i in range(reruns):
+      started_at = time.perf_counter()
+      rerun(1 + (index + i) % 2)
+      latencies.append(time.perf_counter() - started_at)
+      # ユーザの操作の間隔. ttlを過ぎるとstoreはバックグラウンドで取得し直す
+      time.sleep(think_time)
+    return latencies
+
+  started_at = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=sessions) as executor:
+    latencies = [latency for result in executor.map(session, range(sessions)) for latency in result]
+  elapsed = time.perf_counter() - started_at
+  return {
+    "reruns": len(latencies),
+    "elapsed_seconds": elapsed,
+    "mean_seconds": statistics.mean(latencies),
+    "latency_seconds": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+  }
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+  text = create_csv(args.rows)
+  results: dict[str, Any] = {}
+  with tempfile.TemporaryDirectory() as snapshot_dir:
+    server = SheetServer(text, args.latency)
+    try:
+      expected = legacy_rerun(server.url, 1)
+      results["legacy"] = run_reruns(
+        lambda phase: legacy_rerun(server.url, phase), args.sessions, args.reruns, args.think_time
+      )
+      results["legacy"]["http_requests"] = dict(server.counts)
+
+      server.counts.update({"200": 0, "304": 0})
+      store = PromptStore(server.url, args.ttl, snapshot_dir)
+      assert store_rerun(store, 1) == expected
+      results["store"] = run_reruns(
+        lambda phase: store_rerun(store, phase), args.sessions, args.reruns, args.think_time
+      )
+      results["store"]["http_requests"] = dict(server.counts)
+    finally:
+      server.stop()
+
+    # スプレッドシートに繋がらない状態で新しいプロセスが起動した場合
+    offline = PromptStore(server.url, args.ttl, snapshot_dir)
+    started_at = time.perf_counter()
+    prompt = store_rerun(offline, 1)
+    results["snapshot_fallback"] = {"seconds": time.perf_counter() - started_at, "matches": prompt == expected}
+  return results
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sessions", type=int, default=8, help="concurrent Streamlit sessions")
+  parser.add_argument("--reruns", type=int, default=50, help="reruns per session")
+  parser.add_argument("--rows", type=int, default=30)
+  parser.add_argument("--latency", type=float, default=0.3, help="seconds per spreadsheet request")
+  parser.add_argument("--ttl", type=float, default=1.0)
+  parser.add_argument("--think-time", type=float, default=0.05, help="seconds between reruns")
+  parser.add_argument("--output", type=str, default="")
+  args = parser.parse_args()
+
+  results = run(args)
+  for name in ("legacy", "store"):
+    summary = results[name]
+    latency = " ".join(f"{p}={v * 1000:.2f}ms" for p, v in summary["latency_seconds"].items())
+    print(
+      f"{name}: {summary['reruns']} reruns in {summary['elapsed_seconds']:.2f}s, {latency}, "
+      f"http={summary['http_requests']}"
+    )
+  fallback = results["snapshot_fallback"]
+  print(f"snapshot fallback: {fallback['seconds'] * 1000:.1f}ms, matches={fallback['matches']}")
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({"benchmark": "prompt_store_bench", "config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
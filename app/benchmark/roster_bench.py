@@ -0,0 +1,123 @@
+# 先生の画面の生徒のリストの取得を、変更前(usersのドキュメントを全て取得)とIDだけの取得、StudentRosterのキャッシュで比べる
+# Firestoreのエミュレータを起動してから、appディレクトリで実行する
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 uv run python -m benchmark.roster_bench --students 500 --output roster.json
+#
+# - legacy: users_ref.stream()でドキュメント全体(チャット履歴を含む)を取得してIDだけを使う
+# - keys_only: select([])でIDだけをpage_size件ずつ取得する
+# - cached: StudentRoster.getで共有のリストを使い、ttl秒ごとにバックグラウンドでkeys_onlyと同じ取得をする
+import argparse
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import requests
+from benchmark.load_test import percentile
+from common.firestore import StudentRoster, _fetch_student_names
+from google.cloud.firestore import Client as FirestoreClient
+
+BATCH_SIZE = 500
+
+
+def clear_emulator(host: str, project: str) -> None:
+  requests.delete(f"http://{host}/emulator/v1/projects/{project}/databases/(default)/documents", timeout=30)
+
+
+def seed(db: FirestoreClient, students: int, chat_bytes: int) -> None:
+  # 実際の生徒のドキュメントと同じく、シリアライズしたチャット履歴を文字列で持たせる
+  chat_history = json.dumps([{"type": "human", "data": {"content": "あ" * 100}}] * max(1, chat_bytes // 300))
+  users_ref = db.collection("users")
+  for start in range(0, students, BATCH_SIZE):
+    batch = db.batch()
+    for i in range(start, min(start + BATCH_SIZE, students)):
+      batch.set(
+        users_ref.document(f"student{i:05d}"),
+        {"user_name": f"student{i:05d}", "goal": "週に3回ピラティスをやります！", "chat_history": chat_history},
+      )
+    batch.commit()
+
+
+def legacy_student_list(db: FirestoreClient) -> list[str]:
+  return [doc.id for doc in db.collection("users").stream()]
+
+
+def run_reruns(rerun: Callable[[], list[str]], sessions: int, reruns: int, think_time: float) -> dict[str, Any]:
+  def session(_: int) -> list[float]:
+    latencies = []
+    for _ in range(reruns):
+      started_at = time.perf_counter()
+      rerun()
+      latencies.append(time.perf_counter() - started_at)
+      time.sleep(think_time)
+    return latencies
+
+  started_at = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=sessions) as executor:
+    latencies = [latency for result in executor.map(session, range(sessions)) for latency in result]
+  return {
+    "reruns": len(latencies),
+    "elapsed_seconds": time.perf_counter() - started_at,
+    "mean_seconds": statistics.mean(latencies),
+    "latency_seconds": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+  }
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+  host = os.environ.get("FIRESTORE_EMULATOR_HOST")
+  if not host:
+    raise SystemExit("FIRESTORE_EMULATOR_HOST is not set. start the Firestore emulator first")
+  project = f"roster-bench-{os.getpid()}"
+  db = FirestoreClient(project=project)
+  clear_emulator(host, project)
+  try:
+    seed(db, args.students, args.chat_bytes)
+    expected = legacy_student_list(db)
+    assert _fetch_student_names(db, args.page_size) == expected
+    # 変更前に1回の再実行で受け取っていたドキュメントの大きさの目安
+    payload_bytes = sum(
+      len(json.dumps(doc.to_dict(), ensure_ascii=False).encode()) for doc in db.collection("users").stream()
+    )
+
+    roster = StudentRoster(args.ttl, args.page_size)
+    assert roster.get(db) == expected
+    results: dict[str, Any] = {"students": len(expected), "legacy_payload_bytes": payload_bytes}
+    for name, rerun in (
+      ("legacy", lambda: legacy_student_list(db)),
+      ("keys_only", lambda: _fetch_student_names(db, args.page_size)),
+      ("cached", lambda: roster.get(db)),
+    ):
+      results[name] = run_reruns(rerun, args.sessions, args.reruns, args.think_time)
+  finally:
+    clear_emulator(host, project)
+  return results
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--students", type=int, default=500)
+  parser.add_argument("--chat-bytes", type=int, default=30000, help="size of chat_history per student")
+  parser.add_argument("--page-size", type=int, default=300)
+  parser.add_argument("--sessions", type=int, default=4, help="concurrent teacher sessions")
+  parser.add_argument("--reruns", type=int, default=20, help="reruns per session")
+  parser.add_argument("--ttl", type=float, default=1.0)
+  parser.add_argument("--think-time", type=float, default=0.05, help="seconds between reruns")
+  parser.add_argument("--output", type=str, default="")
+  args = parser.parse_args()
+
+  results = run(args)
+  print(f"students={results['students']}, legacy payload per rerun={results['legacy_payload_bytes'] / 1024:.0f}KB")
+  for name in ("legacy", "keys_only", "cached"):
+    summary = results[name]
+    latency = " ".join(f"{p}={v * 1000:.2f}ms" for p, v in summary["latency_seconds"].items())
+    print(f"{name}: {summary['reruns']} reruns in {summary['elapsed_seconds']:.2f}s, {latency}")
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({"benchmark": "roster_bench", "config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,81 @@
+# ベンチマーク用のMCPサーバ
+# video_search_mcp_server.py / web_search_mcp_server.pyと同じツールをstdioで提供し、
+# FAISSや外部APIを使わずに決まった結果を返す
+#
+# 環境変数
+# - STUB_MCP_KIND: video または web
+# - STUB_MCP_LATENCY: ツール呼び出しごとの秒数
+import asyncio
+import os
+from typing import Any
+
+from mcp.server.fastmcp import FastMCP
+
+KIND = os.getenv("STUB_MCP_KIND", "video")
+LATENCY = float(os.getenv("STUB_MCP_LATENCY", "0.2"))
+
+mcp = FastMCP(f"{KIND}_search")
+
+
+if KIND == "video":
+
+  @mcp.tool()
+  async def video_search(search_query: str, result_num: int) -> list[Any]:
+    """
+    Search for information on videos similar to query from a database
+    containing vector data of videos.
+
+    Args:
+      search_query: Search keyword.
+      result_num: Number of search results.
+
+    Returns:
+      Top search results.
+    """
+    await asyncio.sleep(LATENCY)
+    return [
+      {
+        "url": f"https://www.youtube.com/watch?v=stub{i}",
+        "description": f"{search_query}のための10分間ピラティス" * 10,
+        "similarity": 0.1 * (i + 1),
+      }
+      for i in range(min(result_num, 3))
+    ]
+
+else:
+
+  @mcp.tool()
+  async def search_and_pickup_top_results(search_query: str) -> list[Any]:
+    """
+    Search for articles on the internet using
+    google custom web search api.
+
+    Args:
+      search_query: Search keyword.
+
+    Returns:
+      Overview of top search results.
+    """
+    await asyncio.sleep(LATENCY)
+    return [
+      {"title": f"{search_query} ({i})", "url": f"https://example.com/{i}", "description": search_query * 20}
+      for i in range(5)
+    ]
+
+  @mcp.tool()
+  async def get_url_contents(url: str) -> str:
+    """
+    Returns the contents of the page at the given URL as a string.
+
+    Args:
+      url: Web page URL.
+
+    Returns:
+      Contents of the page at the given URL.
+    """
+    await asyncio.sleep(LATENCY)
+    return f"{url}の内容\n" * 100
+
+
+if __name__ == "__main__":
+  mcp.run(transport=os.getenv("MCP_TRANSPORT", "stdio"))
@@ -0,0 +1,123 @@
+# /inferと/v2/inferのシリアライズ/パースのコストを1ターン分比較する
+# appディレクトリで実行する: uv run python -m benchmark.wire_format_bench --output wire_format.json
+#
+# 1ターンは「UIが履歴を送る -> サーバがパースする -> サーバが応答を送る -> UIがパースする」とする
+# - legacy: JSONの文字列をJSONに埋め込み(indent=2)、応答は全履歴 + 追加分
+# - v2_json: 型付きのメッセージをそのままJSONで送り、応答は追加分のみ
+# - v2_msgpack: v2_jsonと同じ内容をmsgpackで送る
+import argparse
+import json
+import statistics
+import time
+from typing import Any, Callable
+
+from common.wire import InferRequestV2, InferResponseV2, from_wire, msgpack, pack, to_wire, unpack
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.base import messages_to_dict
+from langchain_core.messages.utils import messages_from_dict
+
+HISTORY_SIZES = [10, 30, 100]
+SYSTEM_PROMPT = (
+  "あなたはピラティスの習慣化をサポートするコーチです。生徒の目標と実施履歴を踏まえて助言してください。\n" * 40
+)
+
+
+def create_history(size: int) -> list[BaseMessage]:
+  messages: list[BaseMessage] = [SystemMessage(content=SYSTEM_PROMPT, id="0")]
+  for i in range(size):
+    if i % 4 == 0:
+      messages.append(
+        HumanMessage(content=f"今日は朝食の後にピラティスを10分やりました。首が少し痛いです。({i})", id=f"h{i}")
+      )
+    elif i % 4 == 1:
+      messages.append(
+        AIMessage(
+          content="",
+          id=f"a{i}",
+          tool_calls=[
+            {"id": f"c{i}", "name": "video_search", "args": {"search_query": "首 ピラティス", "result_num": 3}}
+          ],
+        )
+      )
+    elif i % 4 == 2:
+      videos = [
+        json.dumps({"url": f"https://www.youtube.com/watch?v={i}{j}", "description": "首と肩のストレッチ" * 5})
+        for j in range(3)
+      ]
+      messages.append(ToolMessage(content=str(videos), id=f"t{i}", name="video_search", tool_call_id=f"c{i - 1}"))
+    else:
+      messages.append(AIMessage(content="首に負担をかけない動きを中心にした動画を見つけました。" * 4, id=f"a{i}"))
+  return messages
+
+
+def create_new_messages() -> list[BaseMessage]:
+  return [AIMessage(content="無理せず続けられていて素晴らしいです！" * 4, id="new")]
+
+
+def legacy_turn(history: list[BaseMessage], new_messages: list[BaseMessage]) -> int:
+  request_body = json.dumps({"message": json.dumps(messages_to_dict(history), indent=2)})
+  received = messages_from_dict(json.loads(json.loads(request_body)["message"]))
+  response_body = json.dumps({"response": json.dumps(messages_to_dict(received + new_messages), indent=2)})
+  messages_from_dict(json.loads(json.loads(response_body)["response"]))
+  return len(request_body.encode()) + len(response_body.encode())
+
+
+def v2_json_turn(history: list[BaseMessage], new_messages: list[BaseMessage]) -> int:
+  request_body = InferRequestV2(messages=[to_wire(m) for m in history]).model_dump_json(exclude_defaults=True)
+  [from_wire(m) for m in InferRequestV2.model_validate_json(request_body).messages]
+  response_body = InferResponseV2(messages=[to_wire(m) for m in new_messages]).model_dump_json(exclude_defaults=True)
+  [from_wire(m) for m in InferResponseV2.model_validate_json(response_body).messages]
+  return len(request_body.encode()) + len(response_body.encode())
+
+
+def v2_msgpack_turn(history: list[BaseMessage], new_messages: list[BaseMessage]) -> int:
+  request_body = pack(InferRequestV2(messages=[to_wire(m) for m in history]).model_dump(exclude_defaults=True))
+  [from_wire(m) for m in InferRequestV2.model_validate(unpack(request_body)).messages]
+  response_body = pack(InferResponseV2(messages=[to_wire(m) for m in new_messages]).model_dump(exclude_defaults=True))
+  [from_wire(m) for m in InferResponseV2.model_validate(unpack(response_body)).messages]
+  return len(request_body) + len(response_body)
+
+
+def measure(turn: Callable[..., int], history: list[BaseMessage], iterations: int) -> dict[str, Any]:
+  new_messages = create_new_messages()
+  payload_bytes = turn(history, new_messages)
+  elapsed = []
+  for _ in range(iterations):
+    start = time.perf_counter()
+    turn(history, new_messages)
+    elapsed.append(time.perf_counter() - start)
+  return {
+    "payload_bytes": payload_bytes,
+    "median_us": statistics.median(elapsed) * 1e6,
+    "p95_us": sorted(elapsed)[int(len(elapsed) * 0.95) - 1] * 1e6,
+  }
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--iterations", type=int, default=200)
+  parser.add_argument("--output", type=str, default="")
+  args = parser.parse_args()
+
+  formats = {"legacy": legacy_turn, "v2_json": v2_json_turn}
+  if msgpack is not None:
+    formats["v2_msgpack"] = v2_msgpack_turn
+
+  results = []
+  print(f"{'history':>8} {'format':>12} {'bytes':>10} {'median[us]':>12} {'p95[us]':>12}")
+  for size in HISTORY_SIZES:
+    history = create_history(size)
+    for name, turn in formats.items():
+      result = {"history_size": size, "format": name, **measure(turn, history, args.iterations)}
+      results.append(result)
+      print(
+        f"{size:>8} {name:>12} {result['payload_bytes']:>10} {result['median_us']:>12.1f} {result['p95_us']:>12.1f}"
+      )
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({"benchmark": "wire_format", "iterations": args.iterations, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
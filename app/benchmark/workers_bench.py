@@ -0,0 +1,169 @@
+# llm_serverのワーカー数ごとに、MCPサーバをワーカーごとに起動する場合(stdio)と
+# 共有のプロセスに接続する場合(shared, mcp_server/run_shared.py)のメモリとスループットを比べる
+# appディレクトリで実行する: uv run python -m benchmark.workers_bench --workers 1,4,8 --output workers.json
+#
+# メモリはllm_serverとMCPサーバの全プロセスのRSSの合計(/procから読むのでLinuxのみ)
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import httpx
+from benchmark.load_test import free_port, run_load, start_server, summarize_results, write_config
+
+READY_CHECKS = 10
+
+
+def process_tree_rss(pid: int) -> int:
+  # 子孫のプロセスを含めたRSSの合計(バイト)
+  children: dict[int, list[int]] = {}
+  for entry in os.listdir("/proc"):
+    if not entry.isdigit():
+      continue
+    try:
+      with open(f"/proc/{entry}/stat") as f:
+        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+    except (OSError, IndexError, ValueError):
+      continue
+    children.setdefault(ppid, []).append(int(entry))
+
+  total = 0
+  stack = [pid]
+  while stack:
+    current = stack.pop()
+    stack.extend(children.get(current, []))
+    try:
+      with open(f"/proc/{current}/statm") as f:
+        total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+      pass
+  return total
+
+
+async def wait_all_workers_ready(client: httpx.AsyncClient, process: subprocess.Popen, timeout: float) -> None:
+  # /readyはどのワーカーが応答するか分からないので、続けて何回か200が返るまで待つ
+  deadline = time.monotonic() + timeout
+  consecutive = 0
+  while time.monotonic() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError("llm_server exited during startup")
+    try:
+      response = await client.get("/ready")
+      consecutive = consecutive + 1 if response.status_code == 200 else 0
+      if consecutive >= READY_CHECKS:
+        return
+    except httpx.TransportError:
+      consecutive = 0
+    await asyncio.sleep(0.1)
+  raise RuntimeError(f"llm_server was not ready within {timeout}s")
+
+
+def start_shared_mcp(work_dir: str, args: argparse.Namespace) -> tuple[subprocess.Popen, str]:
+  source_path = write_config(work_dir, args.pool_size)
+  shared_path = os.path.join(work_dir, "config.shared.json")
+  env = dict(os.environ, BENCH_VIDEO_KIND="video", BENCH_WEB_KIND="web", BENCH_TOOL_LATENCY=str(args.tool_latency))
+  command = [
+    sys.executable,
+    "-m",
+    "mcp_server.run_shared",
+    "--config",
+    source_path,
+    "--output",
+    shared_path,
+    "--base-port",
+    str(free_port()),
+  ]
+  log = open(os.path.join(work_dir, "mcp.log"), "w")
+  app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  process = subprocess.Popen(command, cwd=app_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+  deadline = time.monotonic() + args.startup_timeout
+  while not os.path.exists(shared_path):
+    if process.poll() is not None or time.monotonic() > deadline:
+      raise RuntimeError("shared MCP servers failed to start")
+    time.sleep(0.2)
+  return process, shared_path
+
+
+async def run_case(args: argparse.Namespace, workers: int, mode: str) -> dict[str, Any]:
+  port = free_port()
+  with tempfile.TemporaryDirectory() as work_dir:
+    processes: list[subprocess.Popen] = []
+    try:
+      config_path = ""
+      if mode == "shared":
+        mcp_process, config_path = start_shared_mcp(work_dir, args)
+        processes.append(mcp_process)
+      process = start_server(args, work_dir, port, config_path=config_path, workers=workers)
+      processes.append(process)
+
+      limits = httpx.Limits(max_connections=args.concurrency)
+      async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=args.timeout, limits=limits) as client:
+        await wait_all_workers_ready(client, process, args.startup_timeout)
+        idle_rss = sum(process_tree_rss(p.pid) for p in processes)
+        results, elapsed = await run_load(client, args)
+        loaded_rss = sum(process_tree_rss(p.pid) for p in processes)
+    except Exception:
+      for name in ("server.log", "mcp.log"):
+        path = os.path.join(work_dir, name)
+        if os.path.exists(path):
+          with open(path) as f:
+            print(f.read()[-4000:], file=sys.stderr)
+      raise
+    finally:
+      for p in reversed(processes):
+        p.terminate()
+        p.wait()
+
+  summary = summarize_results(results, elapsed)
+  summary.update({"workers": workers, "mode": mode, "idle_rss_bytes": idle_rss, "loaded_rss_bytes": loaded_rss})
+  return summary
+
+
+async def run(args: argparse.Namespace) -> list[dict[str, Any]]:
+  cases = []
+  for workers in (int(w) for w in args.workers.split(",")):
+    for mode in args.modes.split(","):
+      summary = await run_case(args, workers, mode)
+      latency = summary["latency_seconds"]
+      print(
+        f"workers={workers} mode={mode}: {summary['throughput_rps']:.2f} req/s, "
+        f"p50={latency['p50'] * 1000:.1f}ms p95={latency['p95'] * 1000:.1f}ms, "
+        f"rss idle={summary['idle_rss_bytes'] / 2**20:.0f}MiB loaded={summary['loaded_rss_bytes'] / 2**20:.0f}MiB, "
+        f"errors={summary['errors']}"
+      )
+      cases.append(summary)
+  return cases
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--workers", type=str, default="1,4,8")
+  parser.add_argument("--modes", type=str, default="stdio,shared")
+  # セッションのsqliteへの書き込みの待ちがワーカー数の比較に混ざらないよう、状態を持たない/v2/inferで測る
+  parser.add_argument("--endpoint", choices=["session", "v2"], default="v2")
+  parser.add_argument("--concurrency", type=int, default=32)
+  parser.add_argument("--requests", type=int, default=400)
+  parser.add_argument("--model-latency", type=float, default=0.5)
+  parser.add_argument("--token-latency", type=float, default=0.01)
+  parser.add_argument("--response-tokens", type=int, default=50)
+  parser.add_argument("--tools", type=str, default="video_search", help="comma separated tool names per turn")
+  parser.add_argument("--tool-latency", type=float, default=0.2)
+  parser.add_argument("--pool-size", type=int, default=1)
+  parser.add_argument("--timeout", type=float, default=120)
+  parser.add_argument("--startup-timeout", type=float, default=120)
+  parser.add_argument("--output", type=str, default="")
+  args = parser.parse_args()
+
+  cases = asyncio.run(run(args))
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({"benchmark": "workers_bench", "config": vars(args), "results": cases}, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
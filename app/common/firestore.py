@@ -1,13 +1,16 @@
 import json
-from collections import deque
+import threading
+import time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta, timezone
 from typing import Any, Deque
 
-from common.params import JST, MAX_HISTORY_NUM
+from common.params import ACTIVITY_CACHE_SIZE, JST, MAX_HISTORY_NUM, ROSTER_CACHE_TTL, ROSTER_PAGE_SIZE
 from firebase_admin import firestore
 from google.api_core.exceptions import GoogleAPICallError, PermissionDenied
 from google.cloud.firestore import Client as FirestoreClient
 from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
 from langchain_core.messages import BaseMessage
 from langchain_core.messages.base import messages_to_dict
 from langchain_core.messages.utils import messages_from_dict
@@ -38,14 +41,88 @@ def create_timing_str(
   return goal_str
 
 
+def _fetch_student_names(firebase_db: FirestoreClient, page_size: int) -> list[str]:
+  # usersのドキュメントにはチャット履歴などが入っていて大きいので、IDだけを取得する(select([])は__name__だけを返す)
+  # 生徒の数が多くても1回の応答が大きくならないよう、ID順にpage_size件ずつ取得する
+  query = firebase_db.collection("users").select([]).order_by(FieldPath.document_id()).limit(page_size)
+  user_names: list[str] = []
+  last_doc = None
+  while True:
+    page = list((query if last_doc is None else query.start_after(last_doc)).stream())
+    user_names.extend(doc.id for doc in page)
+    if len(page) < page_size:
+      return user_names
+    last_doc = page[-1]
+
+
+# 先生用
+# 生徒のリスト(usersのドキュメントID)をプロセス全体で共有する
+# 先生の画面の再実行のたびに取得せず、ttl秒を過ぎたら古いリストを返しつつバックグラウンドで取得し直す
+# このプロセスで追加された生徒(save_student_info)はすぐにリストに加える
+# スナップショットリスナーは変更のたびにドキュメント全体を受け取るため使わない
+class StudentRoster:
+  def __init__(self, ttl: float, page_size: int):
+    self.ttl = ttl
+    self.page_size = page_size
+    self.user_names: tuple[str, ...] | None = None
+    self.fetched_at = 0.0
+    self.refreshing = False
+    # このプロセスで追加した生徒と追加した時刻. 取得中に追加された生徒を取得結果で消さないために使う
+    self._added_at: dict[str, float] = {}
+    self._lock = threading.Lock()
+    # 最初の取得は1回だけ行い、同時に来た他のセッションはそれを待つ
+    self._load_lock = threading.Lock()
+
+  def _fetch(self, firebase_db: FirestoreClient) -> None:
+    started_at = time.perf_counter()
+    fetched_at = time.monotonic()
+    user_names = _fetch_student_names(firebase_db, self.page_size)
+    with self._lock:
+      self._added_at = {name: added_at for name, added_at in self._added_at.items() if added_at >= fetched_at}
+      self.user_names = tuple(sorted({*user_names, *self._added_at}))
+      self.fetched_at = fetched_at
+    print(f"[student roster]: loaded {len(user_names)} students in {(time.perf_counter() - started_at) * 1000:.0f}ms")
+
+  def _refresh(self, firebase_db: FirestoreClient) -> None:
+    try:
+      self._fetch(firebase_db)
+    except GoogleAPICallError as e:
+      # 取得できなければ今のリストを使い続け、ttl後にもう一度試す
+      print(f"[student roster]: failed to refresh: {e}")
+      with self._lock:
+        self.fetched_at = time.monotonic()
+    finally:
+      self.refreshing = False
+
+  def get(self, firebase_db: FirestoreClient) -> list[str]:
+    if self.user_names is None:
+      with self._load_lock:
+        if self.user_names is None:
+          self._fetch(firebase_db)
+      return list(self.user_names or ())
+
+    if time.monotonic() - self.fetched_at > self.ttl:
+      with self._lock:
+        start = not self.refreshing
+        self.refreshing = True
+      if start:
+        threading.Thread(target=self._refresh, args=(firebase_db,), daemon=True).start()
+    return list(self.user_names)
+
+  def add(self, user_name: str) -> None:
+    with self._lock:
+      self._added_at[user_name] = time.monotonic()
+      if self.user_names is not None and user_name not in self.user_names:
+        self.user_names = tuple(sorted({*self.user_names, user_name}))
+
+
+student_roster = StudentRoster(ROSTER_CACHE_TTL, ROSTER_PAGE_SIZE)
+
+
 # 先生用
 # 生徒のリストを取得する
 def get_student_list(firebase_db: FirestoreClient) -> list[str]:
-  users_ref = firebase_db.collection("users")
-  docs = users_ref.stream()
-  user_names = [doc.id for doc in docs]
-
-  return user_names
+  return student_roster.get(firebase_db)
 
 
 SHARE_LEVEL = {
@@ -70,6 +147,9 @@ class StudentInfo(BaseModel):
   share_level: str
   chat_history: Deque[BaseMessage] = Field(default_factory=lambda: deque(maxlen=MAX_HISTORY_NUM))
   chat_summary: str
+  # サマリに反映済みの最後のメッセージIDと、サマリ作成に使ったプロンプトのハッシュ
+  chat_summary_watermark: str = ""
+  chat_summary_prompt_hash: str = ""
   created_at: datetime
   updated_at: datetime
 
@@ -84,6 +164,8 @@ class StudentInfo(BaseModel):
       "share_level": self.share_level,
       "chat_history": chat_history_to_str(self.chat_history),
       "chat_summary": self.chat_summary,
+      "chat_summary_watermark": self.chat_summary_watermark,
+      "chat_summary_prompt_hash": self.chat_summary_prompt_hash,
       # 時刻はunix time(UTC)で保存
       "created_at": self.created_at.timestamp(),
       "updated_at": self.updated_at.timestamp(),
@@ -101,11 +183,38 @@ class StudentInfo(BaseModel):
       share_level=data.get("share_level", "level1"),
       chat_history=str_to_chat_history(data.get("chat_history", "")),
       chat_summary=data.get("chat_summary", ""),
+      chat_summary_watermark=data.get("chat_summary_watermark", ""),
+      chat_summary_prompt_hash=data.get("chat_summary_prompt_hash", ""),
       created_at=datetime.fromtimestamp(data.get("created_at", 0), tz=JST),
       updated_at=datetime.fromtimestamp(data.get("updated_at", 0), tz=JST),
     )
 
 
+# 推論サーバが書き込むサマリ関連のフィールド
+CHAT_SUMMARY_FIELDS = ("chat_summary", "chat_summary_watermark", "chat_summary_prompt_hash")
+
+
+class ChatSummaryState(BaseModel):
+  summary: str = ""
+  watermark: str = ""
+  prompt_hash: str = ""
+
+  def dump(self) -> dict[str, Any]:
+    return {
+      "chat_summary": self.summary,
+      "chat_summary_watermark": self.watermark,
+      "chat_summary_prompt_hash": self.prompt_hash,
+    }
+
+  @classmethod
+  def from_dict(cls, data: dict[str, Any]) -> "ChatSummaryState":
+    return cls(
+      summary=data.get("chat_summary", ""),
+      watermark=data.get("chat_summary_watermark", ""),
+      prompt_hash=data.get("chat_summary_prompt_hash", ""),
+    )
+
+
 class ActivityData(BaseModel):
   start_time: datetime
   duration: int
@@ -145,8 +254,12 @@ def save_student_activity_data(
   activity_data: ActivityData,
 ) -> dict[str, Any]:
   try:
-    firebase_db.collection("users").document(user_name).collection("activity_logs").add(activity_data.dump())
+    _, doc_ref = (
+      firebase_db.collection("users").document(user_name).collection("activity_logs").add(activity_data.dump())
+    )
     print(f"Data of activity successfully added({user_name}): {activity_data}")
+    # キャッシュには読み込み直さずにそのまま追加し、スナップショットには次に使うときにキャッシュから取り直させる
+    activity_cache.add(user_name, doc_ref.id, activity_data)
   except PermissionDenied as e:
     print(f"Permission error: {e}")
   except GoogleAPICallError as e:
@@ -156,35 +269,163 @@ def save_student_activity_data(
   return activity_data
 
 
-# 先生と生徒用
-# get_activity_historyを通して、生徒のアクティビティの実施履歴を取得する
-def load_student_activity_history(firebase_db: FirestoreClient, user_name: str, days: int = 30) -> list[Any]:
-  # DBにはUTCで保存されている
-  now_utc = datetime.now(tz=timezone.utc)
-  one_month_ago = now_utc - timedelta(days=days)
-  month_ago_ts = one_month_ago.timestamp()
-
+def _query_activity_logs(
+  firebase_db: FirestoreClient, user_name: str, since_ts: float
+) -> list[tuple[str, ActivityData]]:
+  # start_timeがsince_ts以降の記録を(ドキュメントID, 実施記録)で新しい順に返す
   logs_ref = firebase_db.collection("users").document(user_name).collection("activity_logs")
-  query = logs_ref.where(filter=FieldFilter("start_time", ">=", month_ago_ts)).order_by(
+  query = logs_ref.where(filter=FieldFilter("start_time", ">=", since_ts)).order_by(
     "start_time", direction=firestore.Query.DESCENDING
   )
-  docs = query.stream()
+  return [(doc.id, ActivityData.from_dict(doc.to_dict())) for doc in query.stream()]
+
+
+class _ActivityCacheEntry:
+  def __init__(self, logs: list[tuple[str, ActivityData]]):
+    self.logs: dict[str, ActivityData] = dict(logs)
+    self.history: list[ActivityData] | None = None
 
-  activity_history = []
-  for doc in docs:
-    doc = doc.to_dict()
-    activity_history.append(ActivityData.from_dict(doc))
-  return activity_history
+  def newest_ts(self) -> float | None:
+    return max((data.start_time.timestamp() for data in self.logs.values()), default=None)
+
+  def merge(self, logs: list[tuple[str, ActivityData]], cutoff_ts: float) -> None:
+    # 同じ時刻の記録を取りこぼさないよう取得は最新の時刻を含めて行うので、ドキュメントIDで重複を除く
+    added = [(doc_id, data) for doc_id, data in logs if doc_id not in self.logs]
+    expired = [doc_id for doc_id, data in self.logs.items() if data.start_time.timestamp() < cutoff_ts]
+    if not added and not expired:
+      return
+    self.logs.update(added)
+    for doc_id in expired:
+      del self.logs[doc_id]
+    self.history = None
+
+  def activity_history(self) -> list[ActivityData]:
+    if self.history is None:
+      self.history = sorted(self.logs.values(), key=lambda data: data.start_time, reverse=True)
+    return self.history
+
+
+# 先生と生徒用
+# 生徒と期間(日数)ごとの実施履歴のキャッシュ
+# プロセス全体で共有するので、再実行やセッションをまたいで、生徒と先生の画面で同じものを使う
+# 2回目以降はキャッシュしている最新のstart_time以降の記録だけを取得し、期間を過ぎた記録は捨てる
+# 実施記録はstart_activityで現在時刻で保存されるので、それより前の時刻の記録が後から追加されることは考えない
+class ActivityCache:
+  def __init__(self, max_entries: int):
+    self.max_entries = max_entries
+    self._entries: OrderedDict[tuple[str, int], _ActivityCacheEntry] = OrderedDict()
+    # 生徒ごとの実施履歴の保存回数. ActivitySnapshotが古くなったかどうかの判定に使う
+    self._versions: dict[str, int] = {}
+    self._lock = threading.Lock()
+    self._counts = {"full_loads": 0, "incremental_loads": 0, "fetched_logs": 0, "write_through": 0}
+
+  def get(self, firebase_db: FirestoreClient, user_name: str, days: int) -> list[ActivityData]:
+    # DBにはUTCで保存されている
+    cutoff_ts = (datetime.now(tz=timezone.utc) - timedelta(days=days)).timestamp()
+    key = (user_name, days)
+    with self._lock:
+      entry = self._entries.get(key)
+      since_ts = entry.newest_ts() if entry is not None else None
+
+    # クエリは他のセッションを待たせないよう、ロックの外で行う
+    logs = _query_activity_logs(firebase_db, user_name, cutoff_ts if since_ts is None else max(since_ts, cutoff_ts))
+
+    with self._lock:
+      self._counts["full_loads" if entry is None else "incremental_loads"] += 1
+      self._counts["fetched_logs"] += len(logs)
+      # 他のスレッドが先に作っていればそれに追加する
+      entry = self._entries.get(key)
+      if entry is None:
+        entry = self._entries[key] = _ActivityCacheEntry(logs)
+      else:
+        entry.merge(logs, cutoff_ts)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+      return list(entry.activity_history())
+
+  def add(self, user_name: str, doc_id: str, activity_data: ActivityData) -> None:
+    # 保存した記録をこの生徒の全ての期間のキャッシュに追加する. まだ読み込んでいない期間は次のgetで全て読み込む
+    start_ts = activity_data.start_time.timestamp()
+    now = datetime.now(tz=timezone.utc)
+    with self._lock:
+      for (name, days), entry in self._entries.items():
+        if name == user_name and start_ts >= (now - timedelta(days=days)).timestamp():
+          entry.merge([(doc_id, activity_data)], 0)
+      self._counts["write_through"] += 1
+      self._versions[user_name] = self._versions.get(user_name, 0) + 1
+
+  def version(self, user_name: str) -> int:
+    with self._lock:
+      return self._versions.get(user_name, 0)
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {**self._counts, "entries": len(self._entries)}
+
+
+activity_cache = ActivityCache(ACTIVITY_CACHE_SIZE)
+
+
+# 先生と生徒用
+# 生徒のアクティビティの実施履歴を新しい順に取得する
+def load_student_activity_history(firebase_db: FirestoreClient, user_name: str, days: int = 30) -> list[ActivityData]:
+  return activity_cache.get(firebase_db, user_name, days)
+
+
+# 先生と生徒用
+# 1回の再実行の間で共有する生徒の実施履歴
+# 画面の読み込み時に1回だけクエリし、カレンダーの描画やプロンプトの作成ではこれを使う
+# save_student_activity_dataで同じ生徒の実施履歴が保存された後は、次に使うときにActivityCacheから取り直す
+class ActivitySnapshot:
+  def __init__(self, firebase_db: FirestoreClient, user_name: str, days: int = 30):
+    self.firebase_db = firebase_db
+    self.user_name = user_name
+    self.days = days
+    self._version = -1
+    self._activity_history: list[ActivityData] = []
+    self._calendar_json: str | None = None
+
+  def load(self) -> "ActivitySnapshot":
+    version = activity_cache.version(self.user_name)
+    self._activity_history = load_student_activity_history(self.firebase_db, self.user_name, self.days)
+    self._calendar_json = None
+    self._version = version
+    return self
+
+  def _is_stale(self) -> bool:
+    return self._version != activity_cache.version(self.user_name)
+
+  @property
+  def activity_history(self) -> list[ActivityData]:
+    if self._is_stale():
+      self.load()
+    return self._activity_history
+
+  def calendar_json(self) -> str:
+    activity_history = self.activity_history
+    if self._calendar_json is None:
+      self._calendar_json = json.dumps([data.dump_for_calendar() for data in activity_history])
+    return self._calendar_json
 
 
 # 生徒用
 # 生徒の習慣化目標、チャット履歴などを保存する
 # TODO: 共有レベルを保存するように改造する
 # TODO: 任意ゴールも保存できるようにする
-def save_student_info(firebase_db: FirestoreClient, student_info: StudentInfo) -> bool:
+# chat_summaryは推論サーバが非同期に書き込むため、include_summary=Trueのとき(リセットなど)以外は上書きしない
+def save_student_info(firebase_db: FirestoreClient, student_info: StudentInfo, include_summary: bool = False) -> bool:
   try:
-    firebase_db.collection("users").document(student_info.user_name).set(student_info.dump())
+    ref = firebase_db.collection("users").document(student_info.user_name)
+    if include_summary:
+      ref.set(student_info.dump())
+    else:
+      data = student_info.dump()
+      for key in CHAT_SUMMARY_FIELDS:
+        data.pop(key)
+      ref.set(data, merge=True)
     print(f"Data of student info successfully added({student_info.user_name})")
+    student_roster.add(student_info.user_name)
   except PermissionDenied as e:
     print(f"Permission error: {e}")
     return False
@@ -227,12 +468,16 @@ def save_teacher_info(
   teacher_name: str,
   student_name: str,
   chat_history: str,
-  chat_summary: str,
+  chat_summary: str | None,
   instruction: str,
 ) -> None:
+  # chat_summaryがNoneのときは推論サーバが書き込んだサマリを残す
   try:
     doc_ref = firebase_db.collection("teachers").document(teacher_name).collection(student_name).document("info")
-    doc_ref.set({"chat_history": chat_history, "chat_summary": chat_summary, "instruction": instruction})
+    if chat_summary is None:
+      doc_ref.set({"chat_history": chat_history, "instruction": instruction}, merge=True)
+    else:
+      doc_ref.set({"chat_history": chat_history, "chat_summary": chat_summary, "instruction": instruction})
     print(f"Data of teacher chat info successfully added({teacher_name=}, {student_name=})")
   except PermissionDenied as e:
     print(f"Permission error: {e}")
@@ -242,6 +487,66 @@ def save_teacher_info(
     print(f"Unexpected error: {e}")
 
 
+# 推論サーバ用
+# 生徒とAI間の会話のサマリを取得する
+def load_student_chat_summary(firebase_db: FirestoreClient, user_name: str) -> ChatSummaryState:
+  doc = firebase_db.collection("users").document(user_name).get()
+  if doc.exists:
+    return ChatSummaryState.from_dict(doc.to_dict())
+  return ChatSummaryState()
+
+
+# 推論サーバ用
+# 生徒とAI間の会話のサマリを保存する
+def save_student_chat_summary(firebase_db: FirestoreClient, user_name: str, state: ChatSummaryState) -> bool:
+  try:
+    firebase_db.collection("users").document(user_name).set(state.dump(), merge=True)
+    print(f"Data of student chat summary successfully added({user_name})")
+  except PermissionDenied as e:
+    print(f"Permission error: {e}")
+    return False
+  except GoogleAPICallError as e:
+    print(f"Firestore API error: {e}")
+    return False
+  except Exception as e:
+    print(f"Unexpected error: {e}")
+    return False
+  return True
+
+
+# 推論サーバ用
+# 先生とAI間の会話のサマリ(生徒への伝言)を取得する
+def load_teacher_chat_summary(firebase_db: FirestoreClient, teacher_name: str, student_name: str) -> ChatSummaryState:
+  doc = firebase_db.collection("teachers").document(teacher_name).collection(student_name).document("info").get()
+  if doc.exists:
+    return ChatSummaryState.from_dict(doc.to_dict())
+  return ChatSummaryState()
+
+
+# 推論サーバ用
+# 先生とAI間の会話のサマリ(生徒への伝言)を保存する
+def save_teacher_chat_summary(
+  firebase_db: FirestoreClient,
+  teacher_name: str,
+  student_name: str,
+  state: ChatSummaryState,
+) -> bool:
+  try:
+    doc_ref = firebase_db.collection("teachers").document(teacher_name).collection(student_name).document("info")
+    doc_ref.set(state.dump(), merge=True)
+    print(f"Data of teacher chat summary successfully added({teacher_name=}, {student_name=})")
+  except PermissionDenied as e:
+    print(f"Permission error: {e}")
+    return False
+  except GoogleAPICallError as e:
+    print(f"Firestore API error: {e}")
+    return False
+  except Exception as e:
+    print(f"Unexpected error: {e}")
+    return False
+  return True
+
+
 # 先生と生徒用
 # 先生とAI間のチャット履歴を取得する
 def load_teacher_info(firebase_db: FirestoreClient, teacher_name: str, student_name: str) -> tuple[str, str]:
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+
+# 会話履歴から、トークン数の上限に収まる直近のメッセージを選ぶ
+# メッセージごとのトークン数はキャッシュし、同じメッセージを毎ターン数え直さない
+# 初めて見るメッセージは文字数で見積もり、モデルで数える場合はバックグラウンドで正確な値に置き換える
+
+CACHE_SIZE = 10000
+REFINE_WORKERS = 2
+
+
+def message_text(message: BaseMessage) -> str:
+  text = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+  if isinstance(message, AIMessage) and message.tool_calls:
+    text += json.dumps(message.tool_calls, ensure_ascii=False)
+  return text
+
+
+def estimate_tokens(message: BaseMessage) -> int:
+  # モデルを使わずに数える場合の目安. 日本語はおおよそ1文字1トークンなので文字数で多めに見積もる
+  return len(message_text(message)) + 4
+
+
+class HistoryWindow:
+  def __init__(
+    self,
+    budget: int,
+    count_tokens: Callable[[BaseMessage], int] | None = None,
+    refine_tokens: Callable[[BaseMessage], int] | None = None,
+    max_refines: int = 8,
+  ):
+    # count_tokensは履歴を選ぶときにその場で数える. 推論サーバのイベントループで呼ぶので通信するものは渡さない
+    # refine_tokens(モデルのAPIなど)を渡すと、まだ数えていないメッセージをバックグラウンドで数え直してキャッシュを更新する
+    # 1回のselectで数え直しを頼むのはmax_refines件まで
+    self.budget = budget
+    self.count_tokens = count_tokens or estimate_tokens
+    self.refine_tokens = refine_tokens
+    self.max_refines = max_refines
+    # キー -> (トークン数, 数え直し済みか)
+    self._cache: OrderedDict[str, tuple[int, bool]] = OrderedDict()
+    self._refining: set[str] = set()
+    self._lock = threading.Lock()
+    self._executor = (
+      ThreadPoolExecutor(max_workers=REFINE_WORKERS, thread_name_prefix="token-count")
+      if refine_tokens is not None
+      else None
+    )
+
+  def _key(self, message: BaseMessage) -> str:
+    # idが無いメッセージは内容から作る
+    if message.id:
+      return message.id
+    return hashlib.sha1(f"{message.type}:{message_text(message)}".encode()).hexdigest()
+
+  def _lookup(self, message: BaseMessage) -> tuple[str, int, bool]:
+    key = self._key(message)
+    with self._lock:
+      if key in self._cache:
+        self._cache.move_to_end(key)
+        return key, *self._cache[key]
+
+    try:
+      num_tokens = self.count_tokens(message)
+    except Exception as e:
+      print(f"[history window]: failed to count tokens, using estimate: {e}")
+      num_tokens = estimate_tokens(message)
+    refined = self.refine_tokens is None
+    self._store(key, num_tokens, refined)
+    return key, num_tokens, refined
+
+  def _store(self, key: str, num_tokens: int, refined: bool) -> None:
+    with self._lock:
+      self._cache[key] = (num_tokens, refined)
+      self._cache.move_to_end(key)
+      if len(self._cache) > CACHE_SIZE:
+        self._cache.popitem(last=False)
+
+  def _refine(self, key: str, message: BaseMessage) -> None:
+    try:
+      num_tokens = self.refine_tokens(message)
+    except Exception as e:
+      # 失敗したメッセージは見積もりのまま使い、数え直さない
+      print(f"[history window]: failed to refine token count: {e}")
+      num_tokens = None
+    with self._lock:
+      self._refining.discard(key)
+      current = self._cache.get(key)
+      if current is not None:
+        self._cache[key] = (current[0] if num_tokens is None else num_tokens, True)
+
+  def _schedule_refine(self, key: str, message: BaseMessage) -> bool:
+    with self._lock:
+      if self._executor is None or key in self._refining:
+        return False
+      self._refining.add(key)
+    self._executor.submit(self._refine, key, message)
+    return True
+
+  def tokens(self, message: BaseMessage) -> int:
+    return self._lookup(message)[1]
+
+  def select(self, messages: list[BaseMessage]) -> list[BaseMessage]:
+    # 新しい方から、ツール呼び出しとその結果を1つのまとまりとして上限まで追加する
+    # 最新のまとまりは上限を超えていても必ず含める
+    messages = list(messages)
+    units: list[list[BaseMessage]] = []
+    used = 0
+    refines = 0
+    end = len(messages)
+    while end > 0:
+      start = end - 1
+      while start > 0 and isinstance(messages[start], ToolMessage):
+        start -= 1
+      unit = messages[start:end]
+      if isinstance(unit[0], ToolMessage):
+        # 対応するツール呼び出しが履歴に残っていない
+        break
+      cost = 0
+      for message in unit:
+        key, num_tokens, refined = self._lookup(message)
+        cost += num_tokens
+        if not refined and refines < self.max_refines and self._schedule_refine(key, message):
+          refines += 1
+      if units and used + cost > self.budget:
+        break
+      units.append(unit)
+      used += cost
+      end = start
+    return [message for unit in reversed(units) for message in unit]
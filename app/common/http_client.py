@@ -0,0 +1,154 @@
+import gzip
+import json
+import random
+import threading
+import time
+from collections import deque
+from typing import Any
+
+import requests
+from common.params import (
+  INF_CONNECT_TIMEOUT,
+  INF_GZIP_MIN_BYTES,
+  INF_POOL_SIZE,
+  INF_READ_TIMEOUT,
+  INF_RETRIES,
+  INF_RETRY_BACKOFF,
+  INF_SERVER_URL,
+)
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# UIから推論サーバへのHTTPクライアント
+# プロセス全体で1つのセッションを共有し、Streamlitの再実行やセッションをまたいでkeep-aliveの接続を使い回す
+# 推論サーバ(uvicorn)はHTTP/1.1のみなので、HTTP/2は使わない
+
+LATENCY_SAMPLES = 500
+GZIP_LEVEL = 5
+
+
+def _not_sent(e: requests.RequestException) -> bool:
+  # 接続できずにリクエストを送っていない場合は、冪等でないリクエストでも再送できる
+  if isinstance(e, requests.ConnectTimeout):
+    return True
+  reason = getattr(e.args[0], "reason", None) if e.args else None
+  return isinstance(reason, NewConnectionError)
+
+
+class InferClient:
+  def __init__(
+    self,
+    base_url: str,
+    pool_size: int,
+    connect_timeout: float,
+    read_timeout: float,
+    retries: int,
+    retry_backoff: float,
+    gzip_min_bytes: int,
+  ):
+    self.base_url = base_url
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.retries = retries
+    self.retry_backoff = retry_backoff
+    self.gzip_min_bytes = gzip_min_bytes
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    self._lock = threading.Lock()
+    self._latencies: dict[str, deque[float]] = {}
+    self._counts = {"requests": 0, "errors": 0, "retries": 0, "gzip_requests": 0, "gzip_saved_bytes": 0}
+
+  def _encode(self, body: bytes, headers: dict[str, str]) -> bytes:
+    if len(body) < self.gzip_min_bytes:
+      return body
+    compressed = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    headers["Content-Encoding"] = "gzip"
+    with self._lock:
+      self._counts["gzip_requests"] += 1
+      self._counts["gzip_saved_bytes"] += len(body) - len(compressed)
+    return compressed
+
+  def request(
+    self,
+    method: str,
+    path: str,
+    json_body: Any = None,
+    data: bytes | str | None = None,
+    headers: dict[str, str] | None = None,
+    read_timeout: float | None = None,
+    stream: bool = False,
+    retry: bool = False,
+  ) -> requests.Response:
+    # retry=Trueは冪等なリクエスト(GETやIdempotency-Key付き)で、送信後に接続が切れた場合も再送する
+    # それ以外は接続できなかった場合だけ再送する
+    headers = dict(headers or {})
+    if json_body is not None:
+      data = json.dumps(json_body, ensure_ascii=False)
+      headers.setdefault("Content-Type", "application/json")
+    if isinstance(data, str):
+      data = data.encode()
+    if data is not None:
+      data = self._encode(data, headers)
+    timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+
+    attempt = 0
+    while True:
+      started_at = time.perf_counter()
+      try:
+        response = self.session.request(
+          method, self.base_url + path, data=data, headers=headers, timeout=timeout, stream=stream
+        )
+      except requests.ConnectionError as e:
+        if attempt >= self.retries or not (retry or _not_sent(e)):
+          self._record(path, None)
+          raise
+        attempt += 1
+        with self._lock:
+          self._counts["retries"] += 1
+        # 同時に失敗したクライアントが一斉に再送しないよう、待ち時間をばらつかせる
+        time.sleep(random.uniform(0, self.retry_backoff * 2**attempt))
+        continue
+      # ストリーミングの場合はヘッダを受け取るまでの時間
+      self._record(path, time.perf_counter() - started_at)
+      return response
+
+  def _record(self, path: str, latency: float | None) -> None:
+    with self._lock:
+      self._counts["requests"] += 1
+      if latency is None:
+        self._counts["errors"] += 1
+        return
+      self._latencies.setdefault(path, deque(maxlen=LATENCY_SAMPLES)).append(latency)
+
+  def stats(self) -> dict[str, Any]:
+    # 接続の使い回しの状況とパスごとのレイテンシ
+    pools = self.session.get_adapter(self.base_url).poolmanager.pools
+    connection_pools = [pool for pool in (pools.get(key) for key in pools.keys()) if pool is not None]
+    with self._lock:
+      latencies = {path: sorted(values) for path, values in self._latencies.items()}
+      counts = dict(self._counts)
+    new_connections = sum(pool.num_connections for pool in connection_pools)
+    counts["new_connections"] = new_connections
+    counts["reused_connections"] = max(0, sum(pool.num_requests for pool in connection_pools) - new_connections)
+    counts["latency_seconds"] = {
+      path: {
+        "count": len(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+      }
+      for path, values in latencies.items()
+    }
+    return counts
+
+
+infer_client = InferClient(
+  INF_SERVER_URL,
+  pool_size=INF_POOL_SIZE,
+  connect_timeout=INF_CONNECT_TIMEOUT,
+  read_timeout=INF_READ_TIMEOUT,
+  retries=INF_RETRIES,
+  retry_backoff=INF_RETRY_BACKOFF,
+  gzip_min_bytes=INF_GZIP_MIN_BYTES,
+)
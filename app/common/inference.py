@@ -0,0 +1,297 @@
+import hashlib
+import json
+import uuid
+from typing import Any, Iterator
+from urllib.parse import quote
+
+import requests
+from common.history_window import HistoryWindow
+from common.http_client import infer_client
+from common.params import HISTORY_TOKEN_BUDGET, INFER_TIMEOUT, TOOL_CALL_TIMEOUT
+from common.wire import (
+  MSGPACK_MEDIA_TYPE,
+  InferRequestV2,
+  InferResponseV2,
+  SummarizeRequest,
+  SummarizeResponse,
+  SummaryJobRequest,
+  ToolCallRequest,
+  WireMessage,
+  from_wire,
+  pack,
+  to_wire,
+  unpack,
+)
+from langchain_core.messages import BaseMessage, ToolMessage
+from langchain_core.messages.base import messages_to_dict
+
+VIDEO_SEARCH_TOOL = "video_search"
+
+# UI側ではモデルを呼ばずに文字数からトークン数を見積もる
+history_window = HistoryWindow(HISTORY_TOKEN_BUDGET)
+
+
+class SessionNotFoundError(Exception):
+  pass
+
+
+class ServerBusyError(Exception):
+  # 推論サーバが混雑している(429/503). retry_after秒後に再送できる
+  def __init__(self, detail: str, retry_after: int):
+    super().__init__(detail)
+    self.retry_after = retry_after
+
+
+def _post_stream(
+  path: str, payload: dict[str, Any], user_name: str = "", idempotency_key: str = ""
+) -> Iterator[dict[str, Any]]:
+  # ヘッダには日本語を入れられないのでパーセントエンコードする
+  headers = {"X-User-Name": quote(user_name)} if user_name else {}
+  if idempotency_key:
+    headers["Idempotency-Key"] = idempotency_key
+  headers["X-Request-Timeout"] = str(INFER_TIMEOUT)
+  # 諦めて接続を切った場合は推論サーバ側の処理も止まる
+  # Idempotency-Keyがあれば再送しても推論サーバで1回の実行にまとめられる
+  with infer_client.request(
+    "POST",
+    path,
+    json_body=payload,
+    headers=headers,
+    read_timeout=INFER_TIMEOUT + 10,
+    stream=True,
+    retry=bool(idempotency_key),
+  ) as response:
+    if response.status_code == 409:
+      raise SessionNotFoundError(response.text)
+    if response.status_code in (429, 503):
+      raise ServerBusyError(response.text, int(response.headers.get("Retry-After", "1")))
+    response.raise_for_status()
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+      if not line:
+        continue
+      yield json.loads(line)
+
+
+# 推論サーバの/infer/streamを呼び出し、NDJSONのイベントを届いた順に返す
+# イベントの種類: token, tool_start, tool_end, done, error
+def stream_infer(messages: list[BaseMessage]) -> Iterator[dict[str, Any]]:
+  json_str = json.dumps(messages_to_dict(messages))
+  try:
+    yield from _post_stream("/infer/stream", {"message": json_str})
+  except ServerBusyError as e:
+    print(f"infer server is busy: {e}")
+    yield {"type": "error", "detail": str(e), "retry_after": e.retry_after}
+  except (requests.RequestException, json.decoder.JSONDecodeError) as e:
+    print(f"failed to stream from infer server: {e}")
+    yield {"type": "error", "detail": str(e)}
+
+
+# 推論サーバの/v2/inferを呼び出し、エージェントが追加したメッセージを返す
+def infer_v2(messages: list[BaseMessage], use_msgpack: bool = False) -> list[BaseMessage]:
+  input_data = InferRequestV2(messages=[to_wire(message) for message in messages])
+  if use_msgpack:
+    headers = {"Content-Type": MSGPACK_MEDIA_TYPE, "Accept": MSGPACK_MEDIA_TYPE}
+    body = pack(input_data.model_dump(exclude_defaults=True))
+  else:
+    headers = {"Content-Type": "application/json"}
+    body = input_data.model_dump_json(exclude_defaults=True)
+
+  response = infer_client.request("POST", "/v2/infer", data=body, headers=headers, read_timeout=INFER_TIMEOUT + 10)
+  response.raise_for_status()
+  if use_msgpack:
+    output_data = InferResponseV2.model_validate(unpack(response.content))
+  else:
+    output_data = InferResponseV2.model_validate_json(response.content)
+  return [from_wire(message) for message in output_data.messages]
+
+
+# サマリを作成する
+# use_agent=Falseならエージェントを通さずにモデルを直接呼ぶ/summarizeを使う
+def summarize(messages: list[BaseMessage], use_agent: bool = False) -> str:
+  if use_agent:
+    recevied_msgs = infer_v2(messages)
+    return recevied_msgs[-1].content if recevied_msgs else ""
+
+  input_data = SummarizeRequest(messages=[to_wire(message) for message in messages])
+  response = infer_client.request(
+    "POST",
+    "/summarize",
+    data=input_data.model_dump_json(exclude_defaults=True),
+    headers={"Content-Type": "application/json"},
+    read_timeout=INFER_TIMEOUT + 10,
+  )
+  response.raise_for_status()
+  return SummarizeResponse.model_validate_json(response.content).summary
+
+
+# サマリ作成をバックグラウンドのキューに登録する
+# 同じ生徒の実行待ちのジョブがあれば推論サーバ側で1つにまとめられる
+def enqueue_summary(
+  kind: str,
+  user_name: str,
+  system_prompt: str,
+  heading: str,
+  messages: list[BaseMessage],
+  teacher_name: str = "",
+) -> bool:
+  job = SummaryJobRequest(
+    kind=kind,
+    user_name=user_name,
+    teacher_name=teacher_name,
+    system_prompt=system_prompt,
+    heading=heading,
+    messages=[to_wire(message) for message in messages],
+  )
+  # 同じ生徒のジョブは推論サーバでまとめられるので、再送しても重複しない
+  response = infer_client.request(
+    "POST",
+    "/summarize/jobs",
+    data=job.model_dump_json(exclude_defaults=True),
+    headers={"Content-Type": "application/json"},
+    retry=True,
+  )
+  response.raise_for_status()
+  return response.json()["coalesced"]
+
+
+def get_tools() -> dict[str, Any]:
+  # 推論サーバで利用可能なツールの名前と説明
+  response = infer_client.request("GET", "/tools", read_timeout=10, retry=True)
+  return json.loads(response.json()["tools"])
+
+
+def video_search_arguments(instruction: str) -> dict[str, Any]:
+  # 習慣スタート時に探す動画. 先読みと実際の呼び出しで同じ引数を使う
+  return {"search_query": instruction or "全身の運動", "result_num": 3}
+
+
+def _tool_headers(user_name: str) -> dict[str, str]:
+  # 推論サーバはツールの呼び出しもユーザごとに制限し、TOOL_CALL_TIMEOUT秒で打ち切る
+  return {
+    "Content-Type": "application/json",
+    "X-User-Name": quote(user_name),
+    "X-Request-Timeout": str(TOOL_CALL_TIMEOUT),
+  }
+
+
+def prefetch_tool(name: str, args: dict[str, Any], user_name: str) -> None:
+  # 推論サーバにツールを先に実行させて結果をキャッシュさせる. 失敗しても画面の操作は止めない
+  request = ToolCallRequest(name=name, args=args)
+  try:
+    response = infer_client.request(
+      "POST", "/tools/prefetch", data=request.model_dump_json(), headers=_tool_headers(user_name), read_timeout=2
+    )
+    response.raise_for_status()
+  except requests.RequestException as e:
+    print(f"failed to prefetch {name}: {e}")
+
+
+def call_tool(name: str, args: dict[str, Any], tool_call_id: str, user_name: str) -> ToolMessage | None:
+  # エージェントを通さずにツールを呼び出す. 先読み済みならキャッシュから返る
+  # 推論サーバが期限で打ち切るので、少しだけ長く待つ
+  request = ToolCallRequest(name=name, args=args, id=tool_call_id)
+  try:
+    response = infer_client.request(
+      "POST",
+      "/tools/call",
+      data=request.model_dump_json(),
+      headers=_tool_headers(user_name),
+      read_timeout=TOOL_CALL_TIMEOUT + 2,
+    )
+    response.raise_for_status()
+  except requests.RequestException as e:
+    print(f"failed to call {name}: {e}")
+    return None
+  message = from_wire(WireMessage.model_validate_json(response.content))
+  message.id = str(uuid.uuid4())
+  return message
+
+
+# 推論サーバ側に保存された会話との同期状況を管理する
+# サーバが持っている最後のメッセージより後ろのメッセージとシステムプロンプトの差分だけを送る
+class InferSession:
+  def __init__(self, session_id: str, user_name: str):
+    self.session_id = session_id
+    # 推論サーバはユーザごとに公平にリクエストを処理する
+    self.user_name = user_name
+    self.system_prompt: str | None = None
+    self.last_message_id: str | None = None
+    # 返答をまだ受け取っていないターン(fingerprint, key, 送った本文)
+    self.pending_turn: dict[str, Any] | None = None
+
+  def reset(self) -> None:
+    # 次の推論時に履歴ごと送り直す
+    self.system_prompt = None
+    self.last_message_id = None
+
+  def _pending_messages(self, chat_history: list[BaseMessage]) -> list[BaseMessage] | None:
+    if self.last_message_id is None:
+      return None
+    for i in range(len(chat_history) - 1, -1, -1):
+      if chat_history[i].id == self.last_message_id:
+        return chat_history[i + 1 :]
+    return None
+
+  def _full_payload(self, chat_history: list[BaseMessage], system_prompt: str) -> dict[str, Any]:
+    return {
+      "session_id": self.session_id,
+      "history": messages_to_dict(history_window.select(chat_history)),
+      "system_prompt": system_prompt,
+    }
+
+  def _turn(self, chat_history: list[BaseMessage], system_prompt: str) -> dict[str, Any]:
+    # ユーザの操作(1ターン)ごとにIdempotency-Keyを作り、返答を受け取るまで持っておく(InferSessionはsession_stateにある)
+    # Streamlitの再実行やダブルクリック、切断後の再送ではメッセージのIDが作り直されるので、役割と内容で同じターンか判定する
+    body = json.dumps(
+      [self.session_id, system_prompt, [[m.type, m.name, m.content] for m in chat_history]],
+      ensure_ascii=False,
+      default=str,
+    )
+    fingerprint = hashlib.sha256(body.encode()).hexdigest()
+    if self.pending_turn is None or self.pending_turn["fingerprint"] != fingerprint:
+      self.pending_turn = {"fingerprint": fingerprint, "key": str(uuid.uuid4()), "payloads": {}}
+    return self.pending_turn
+
+  def _post_with_resync(
+    self, turn: dict[str, Any], payload: dict[str, Any], chat_history: list[BaseMessage], system_prompt: str
+  ) -> Iterator[dict[str, Any]]:
+    # 同じターンの再送では最初に送った本文をそのまま送り、推論サーバで1回の実行にまとめられるようにする
+    payload = turn["payloads"].setdefault("first", payload)
+    try:
+      yield from _post_stream("/session/infer/stream", payload, self.user_name, turn["key"])
+    except SessionNotFoundError:
+      # サーバ側の会話が消えていた(イベントを受け取る前に分かる)ので履歴ごと送り直す
+      payload = turn["payloads"].setdefault("resync", self._full_payload(chat_history, system_prompt))
+      yield from _post_stream("/session/infer/stream", payload, self.user_name, f"{turn['key']}/resync")
+
+  def stream(self, chat_history: list[BaseMessage], system_prompt: str) -> Iterator[dict[str, Any]]:
+    chat_history = list(chat_history)
+    pending = self._pending_messages(chat_history)
+    if pending is None:
+      payload = self._full_payload(chat_history, system_prompt)
+    else:
+      payload = {"session_id": self.session_id, "messages": messages_to_dict(pending)}
+      if system_prompt != self.system_prompt:
+        payload["system_prompt"] = system_prompt
+
+    turn = self._turn(chat_history, system_prompt)
+    received = []
+    try:
+      for event in self._post_with_resync(turn, payload, chat_history, system_prompt):
+        if event["type"] == "done":
+          received = event["messages"]
+        yield event
+    except ServerBusyError as e:
+      print(f"infer server is busy: {e}")
+      yield {"type": "error", "detail": str(e), "retry_after": e.retry_after}
+    except (requests.RequestException, json.decoder.JSONDecodeError) as e:
+      print(f"failed to stream from infer server: {e}")
+      yield {"type": "error", "detail": str(e)}
+
+    if received:
+      self.system_prompt = system_prompt
+      self.last_message_id = received[-1]["data"]["id"]
+      self.pending_turn = None
+    else:
+      self.reset()
@@ -0,0 +1,161 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable
+
+from common.firestore import (
+  ActivitySnapshot,
+  StudentInfo,
+  get_student_list,
+  load_student_info,
+  load_teacher_info,
+)
+from common.inference import get_tools
+from common.params import PAGE_LOAD_WORKERS, STUDENT_PROMPT_GID, TEACHER_PROMPT_GID
+from common.prompt_store import PromptSheet
+from common.utils import prompt_store
+from google.cloud.firestore import Client as FirestoreClient
+
+# Streamlitの再実行のたびに必要なデータ(Firestore、推論サーバのツール、プロンプトのシート)を並列に読み込む
+# 読み込みは互いに依存しないので、待ち時間は足し合わせではなく一番遅いものになる
+
+executor = ThreadPoolExecutor(max_workers=PAGE_LOAD_WORKERS, thread_name_prefix="page-load")
+
+
+def load_concurrently(page: str, sources: dict[str, Callable[[], Any]]) -> tuple[dict[str, Any], dict[str, float]]:
+  # 全ての読み込みが終わってから、失敗したものがあれば最初の例外を投げる
+  def timed(load: Callable[[], Any]) -> tuple[Any, float]:
+    started_at = time.perf_counter()
+    result = load()
+    return result, time.perf_counter() - started_at
+
+  started_at = time.perf_counter()
+  futures = {name: executor.submit(timed, load) for name, load in sources.items()}
+  results: dict[str, Any] = {}
+  timings: dict[str, float] = {}
+  error: Exception | None = None
+  for name, future in futures.items():
+    try:
+      results[name], timings[name] = future.result()
+    except Exception as e:
+      print(f"[page context]: failed to load {name}: {e}")
+      error = error or e
+  elapsed = time.perf_counter() - started_at
+
+  # どの読み込みがページの表示を遅くしているか分かるよう、遅い順に残す
+  details = ", ".join(
+    f"{name}={seconds * 1000:.0f}ms" for name, seconds in sorted(timings.items(), key=lambda x: -x[1])
+  )
+  print(f"[page context]: {page} loaded in {elapsed * 1000:.0f}ms ({details})")
+  if error is not None:
+    raise error
+  return results, timings
+
+
+@dataclass
+class StudentPageContext:
+  tools: dict[str, Any]
+  student_info: StudentInfo
+  teacher_agent_chat_summary: str
+  instruction_from_teacher: str
+  activity: ActivitySnapshot
+  prompt_sheet: PromptSheet
+  timings: dict[str, float]
+
+
+def load_student_page(
+  firebase_db: FirestoreClient, user_name: str, teacher_name: str, student_info: StudentInfo | None = None
+) -> StudentPageContext:
+  # student_infoを渡した場合(同じ生徒の再実行)は読み込み直さずに使う
+  sources: dict[str, Callable[[], Any]] = {
+    "tools": get_tools,
+    "teacher_info": lambda: load_teacher_info(firebase_db, teacher_name, user_name),
+    "activity": ActivitySnapshot(firebase_db, user_name).load,
+    "prompt_sheet": lambda: prompt_store.get(STUDENT_PROMPT_GID),
+  }
+  if student_info is None:
+    sources["student_info"] = lambda: load_student_info(firebase_db, user_name)
+
+  results, timings = load_concurrently("student page", sources)
+  _, teacher_agent_chat_summary, instruction_from_teacher = results["teacher_info"]
+  return StudentPageContext(
+    tools=results["tools"],
+    student_info=results.get("student_info", student_info),
+    teacher_agent_chat_summary=teacher_agent_chat_summary,
+    instruction_from_teacher=instruction_from_teacher,
+    activity=results["activity"],
+    prompt_sheet=results["prompt_sheet"],
+    timings=timings,
+  )
+
+
+@dataclass
+class TeacherPageContext:
+  tools: dict[str, Any]
+  student_names: list[str]
+  prompt_sheet: PromptSheet
+  # 以下は選択中の生徒のデータ. user_nameが空の場合は読み込んでいない
+  user_name: str = ""
+  student_info: StudentInfo | None = None
+  activity: ActivitySnapshot | None = None
+  # (チャット履歴, サマリ, 重点取り組み). 生徒が変わった場合だけ読み込む
+  teacher_info: tuple[str, str, str] | None = None
+  timings: dict[str, float] = field(default_factory=dict)
+
+
+def _selected_student_sources(
+  firebase_db: FirestoreClient, teacher_name: str, user_name: str, with_teacher_info: bool
+) -> dict[str, Callable[[], Any]]:
+  sources: dict[str, Callable[[], Any]] = {
+    "student_info": lambda: load_student_info(firebase_db, user_name),
+    "activity": ActivitySnapshot(firebase_db, user_name).load,
+  }
+  if with_teacher_info:
+    sources["teacher_info"] = lambda: load_teacher_info(firebase_db, teacher_name, user_name)
+  return sources
+
+
+def load_teacher_page(
+  firebase_db: FirestoreClient, teacher_name: str, user_name: str, with_teacher_info: bool
+) -> TeacherPageContext:
+  # 選択される生徒は生徒のリストを表示するまで分からないので、前回の再実行で選ばれていた生徒(user_name)を一緒に読み込む
+  # 別の生徒が選ばれた場合はload_selected_studentで読み込み直す
+  sources: dict[str, Callable[[], Any]] = {
+    "tools": get_tools,
+    "student_names": lambda: get_student_list(firebase_db),
+    "prompt_sheet": lambda: prompt_store.get(TEACHER_PROMPT_GID),
+  }
+  if user_name:
+    sources.update(_selected_student_sources(firebase_db, teacher_name, user_name, with_teacher_info))
+
+  results, timings = load_concurrently("teacher page", sources)
+  return TeacherPageContext(
+    tools=results["tools"],
+    student_names=results["student_names"],
+    prompt_sheet=results["prompt_sheet"],
+    user_name=user_name,
+    student_info=results.get("student_info"),
+    activity=results.get("activity"),
+    teacher_info=results.get("teacher_info"),
+    timings=timings,
+  )
+
+
+def load_selected_student(
+  firebase_db: FirestoreClient,
+  teacher_name: str,
+  user_name: str,
+  with_teacher_info: bool,
+  context: TeacherPageContext,
+) -> TeacherPageContext:
+  results, timings = load_concurrently(
+    "selected student", _selected_student_sources(firebase_db, teacher_name, user_name, with_teacher_info)
+  )
+  return replace(
+    context,
+    user_name=user_name,
+    student_info=results["student_info"],
+    activity=results["activity"],
+    teacher_info=results.get("teacher_info"),
+    timings={**context.timings, **timings},
+  )
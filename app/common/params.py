@@ -3,11 +3,38 @@ from datetime import timedelta, timezone
 
 TEMPERATUE = 0.5
 SEND_MSG_SIZE = 10
+# 推論時に送る会話履歴のトークン数の上限(システムプロンプトは含まない)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "8000"))
 MAX_HISTORY_NUM = 30
+# 画面に描画するチャット履歴の件数. 「以前のメッセージを表示」を押すとこの件数ずつ増やす
+CHAT_WINDOW_SIZE = int(os.getenv("CHAT_WINDOW_SIZE", "10"))
 DEBUG_MESSAGE_SIZE = 100
 JST = timezone(timedelta(hours=9))
 
 INF_SERVER_URL = os.getenv("LLM_API_URL", "http://localhost:8000")
+# 推論の期限(秒). 推論サーバはこれを過ぎると途中までの返答を返すので、UIはもう少しだけ長く待つ
+INFER_TIMEOUT = float(os.getenv("INFER_TIMEOUT", "90"))
+# 「習慣スタート」で推論の前に呼ぶツールの期限(秒). 画面はこの間止まるので短くする
+TOOL_CALL_TIMEOUT = float(os.getenv("TOOL_CALL_TIMEOUT", "10"))
+# 推論サーバへの接続. 接続はプロセス全体で使い回す
+INF_POOL_SIZE = int(os.getenv("INF_POOL_SIZE", "16"))
+INF_CONNECT_TIMEOUT = float(os.getenv("INF_CONNECT_TIMEOUT", "5"))
+INF_READ_TIMEOUT = float(os.getenv("INF_READ_TIMEOUT", "30"))
+# 接続に失敗した場合の再試行の回数と待ち時間の基準(秒). 待ち時間はランダムにばらつかせる
+INF_RETRIES = int(os.getenv("INF_RETRIES", "2"))
+INF_RETRY_BACKOFF = float(os.getenv("INF_RETRY_BACKOFF", "0.2"))
+# このサイズ(バイト)以上のリクエストはgzipで圧縮して送る
+INF_GZIP_MIN_BYTES = int(os.getenv("INF_GZIP_MIN_BYTES", "1024"))
+# スプレッドシートのプロンプトを取得し直す間隔(秒)と、取得できない場合に使うスナップショットの保存先
+PROMPT_CACHE_TTL = float(os.getenv("PROMPT_CACHE_TTL", "600"))
+PROMPT_SNAPSHOT_DIR = os.getenv("PROMPT_SNAPSHOT_DIR", "./prompt_snapshots")
+# 画面の表示に必要なデータを並列に読み込むスレッド数(全てのセッションで共有する)
+PAGE_LOAD_WORKERS = int(os.getenv("PAGE_LOAD_WORKERS", "16"))
+# 実施履歴をキャッシュする(生徒, 期間)の数. プロセス全体で共有する
+ACTIVITY_CACHE_SIZE = int(os.getenv("ACTIVITY_CACHE_SIZE", "1000"))
+# 先生の画面の生徒のリストを取得し直す間隔(秒)と、1回の取得で読む件数
+ROSTER_CACHE_TTL = float(os.getenv("ROSTER_CACHE_TTL", "300"))
+ROSTER_PAGE_SIZE = int(os.getenv("ROSTER_PAGE_SIZE", "300"))
 HABIT_DESIGN_PATH = "./habit_design/habit_design_v2.txt"
 
 STUDENT_PROMPT_GID = 1030669973
@@ -0,0 +1,178 @@
+import csv
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+from types import MappingProxyType
+
+import requests
+from common.prompt_template import PromptTemplate
+
+# Googleスプレッドシートのプロンプト(CSV)をプロセス全体で共有する
+# Streamlitの再実行のたびにダウンロードせず、ttl秒ごとにバックグラウンドで更新する
+# 取得に失敗した場合は最後に取得できたCSVのスナップショットを使う
+
+FETCH_TIMEOUT = 10
+
+
+# 1つのシート(gid)の内容
+# 読み込み時にフェーズごとのシステムプロンプトと共有レベルごとのサマリのプロンプトをテンプレートに変換しておく
+# シートはgidごと(生徒用と先生用)に分かれている
+class PromptSheet:
+  def __init__(self, text: str):
+    self.digest = hashlib.sha256(text.encode()).hexdigest()
+    self.rows = [(row[0].strip(), row[1]) for row in csv.reader(io.StringIO(text)) if len(row) >= 2]
+    phases = {1, 2} | {int(phase) for key, _ in self.rows for phase in re.findall(r"phase(\d+)", key)}
+    self.system_templates = MappingProxyType({phase: self._compile_system(phase) for phase in sorted(phases)})
+    # サマリのプロンプトはシートのキーのまま(シートの順に)持ち、共有レベルとの対応は使うときに決める
+    summarize_templates: dict[str, PromptTemplate] = {}
+    for key, value in self.rows:
+      if "summarize_" in key and key not in summarize_templates:
+        summarize_templates[key] = PromptTemplate.compile(key, value)
+    self.summarize_templates = MappingProxyType(summarize_templates)
+    self._summarize_by_level: dict[str, PromptTemplate | None] = {}
+
+  def _compile_system(self, phase: int) -> PromptTemplate:
+    parts = []
+    for key, value in self.rows:
+      if "phase" in key and f"phase{phase}" not in key:
+        continue
+      if "summarize_level" in key:
+        continue
+      parts.append(value + "\n-------------------------\n")
+    return PromptTemplate.compile(f"phase{phase}", "".join(parts))
+
+  def system_template(self, phase: int) -> PromptTemplate:
+    template = self.system_templates.get(phase)
+    if template is None:
+      template = self._compile_system(phase)
+    return template
+
+  def summarize_prompt(self, share_level: str) -> str:
+    # サマリのプロンプトは値を埋め込まずにそのまま使う
+    # キーに"summarize_{share_level}"を含む最初の行を使う(キーに接尾辞などが付いていてもよい)
+    if share_level not in self._summarize_by_level:
+      self._summarize_by_level[share_level] = next(
+        (template for key, template in self.summarize_templates.items() if f"summarize_{share_level}" in key), None
+      )
+    template = self._summarize_by_level[share_level]
+    return template.source if template is not None else ""
+
+  def describe(self) -> str:
+    templates = list(self.system_templates.values()) + list(self.summarize_templates.values())
+    return ", ".join(f"{template.key}={template.static_tokens}" for template in templates)
+
+
+class PromptEntry:
+  def __init__(self, sheet: PromptSheet, etag: str = "", last_modified: str = ""):
+    self.sheet = sheet
+    self.etag = etag
+    self.last_modified = last_modified
+    self.fetched_at = time.monotonic()
+    self.refreshing = False
+
+
+class PromptStore:
+  def __init__(self, base_url: str, ttl: float, snapshot_dir: str = ""):
+    self.base_url = base_url
+    self.ttl = ttl
+    self.snapshot_dir = snapshot_dir
+    self.entries: dict[int, PromptEntry] = {}
+    self._lock = threading.Lock()
+    # 最初の取得は同じgidにつき1回だけ行い、同時に来た他のセッションはそれを待つ
+    self._load_locks: dict[int, threading.Lock] = {}
+
+  def _url(self, gid: int) -> str:
+    return f"{self.base_url}&gid={gid}"
+
+  def _snapshot_path(self, gid: int) -> str:
+    return os.path.join(self.snapshot_dir, f"{gid}.csv")
+
+  def _save_snapshot(self, gid: int, text: str) -> None:
+    if not self.snapshot_dir:
+      return
+    try:
+      os.makedirs(self.snapshot_dir, exist_ok=True)
+      path = self._snapshot_path(gid)
+      with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+      os.replace(path + ".tmp", path)
+    except OSError as e:
+      print(f"[prompt store]: failed to save snapshot of {gid}: {e}")
+
+  def _load_snapshot(self, gid: int) -> PromptEntry | None:
+    if not self.snapshot_dir or not os.path.exists(self._snapshot_path(gid)):
+      return None
+    with open(self._snapshot_path(gid), encoding="utf-8") as f:
+      entry = PromptEntry(PromptSheet(f.read()))
+    # スナップショットは古い可能性があるので、次のgetで取得し直す
+    entry.fetched_at = -self.ttl
+    return entry
+
+  def _fetch(self, gid: int, current: PromptEntry | None) -> PromptEntry:
+    headers = {}
+    if current is not None:
+      if current.etag:
+        headers["If-None-Match"] = current.etag
+      if current.last_modified:
+        headers["If-Modified-Since"] = current.last_modified
+    response = requests.get(self._url(gid), headers=headers, timeout=FETCH_TIMEOUT)
+    if response.status_code == 304 and current is not None:
+      return PromptEntry(current.sheet, current.etag, current.last_modified)
+    response.raise_for_status()
+    response.encoding = "utf-8"
+    text = response.text
+
+    etag = response.headers.get("ETag", "")
+    last_modified = response.headers.get("Last-Modified", "")
+    if current is not None and current.sheet.digest == hashlib.sha256(text.encode()).hexdigest():
+      # 内容が変わっていなければ組み立て済みのプロンプトをそのまま使う
+      return PromptEntry(current.sheet, etag, last_modified)
+    self._save_snapshot(gid, text)
+    sheet = PromptSheet(text)
+    # シートが編集されるたびにプロンプトの大きさを残しておく
+    print(f"[prompt store]: loaded {gid} (tokens: {sheet.describe()})")
+    return PromptEntry(sheet, etag, last_modified)
+
+  def _refresh(self, gid: int, current: PromptEntry) -> None:
+    try:
+      self.entries[gid] = self._fetch(gid, current)
+    except (requests.RequestException, csv.Error) as e:
+      # 取得できなければ今の内容を使い続け、ttl後にもう一度試す
+      print(f"[prompt store]: failed to refresh {gid}: {e}")
+      current.fetched_at = time.monotonic()
+    finally:
+      current.refreshing = False
+
+  def _load(self, gid: int) -> PromptEntry:
+    with self._lock:
+      load_lock = self._load_locks.setdefault(gid, threading.Lock())
+    with load_lock:
+      entry = self.entries.get(gid)
+      if entry is not None:
+        return entry
+      try:
+        entry = self._fetch(gid, None)
+      except (requests.RequestException, csv.Error) as e:
+        entry = self._load_snapshot(gid)
+        if entry is None:
+          raise
+        print(f"[prompt store]: failed to fetch {gid}, using snapshot: {e}")
+      self.entries[gid] = entry
+      return entry
+
+  def get(self, gid: int) -> PromptSheet:
+    entry = self.entries.get(gid)
+    if entry is None:
+      return self._load(gid).sheet
+
+    if time.monotonic() - entry.fetched_at > self.ttl:
+      with self._lock:
+        start = not entry.refreshing
+        entry.refreshing = True
+      if start:
+        # 古い内容を返しつつ、バックグラウンドで更新する
+        threading.Thread(target=self._refresh, args=(gid, entry), daemon=True).start()
+    return entry.sheet
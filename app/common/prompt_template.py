@@ -0,0 +1,74 @@
+import string
+from dataclasses import dataclass
+
+from common.history_window import estimate_tokens
+from langchain_core.messages import SystemMessage
+
+# スプレッドシートのプロンプト(str.formatの書式)を読み込み時に1回だけ解析しておき、
+# 再実行のたびの描画は値を埋め込んで連結するだけにする
+
+
+def count_prompt_tokens(text: str) -> int:
+  # 推論サーバが履歴の上限を見積もるのと同じ数え方
+  return estimate_tokens(SystemMessage(content=text))
+
+
+@dataclass(frozen=True)
+class RenderedPrompt:
+  text: str
+  tokens: int
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+  key: str
+  source: str
+  # (直前の文字列, 埋め込む値の名前). 最後の要素の名前はNone
+  # 書式指定など単純な置換にできないものを含む場合はNoneで、描画はstr.formatで行う
+  segments: tuple[tuple[str, str | None], ...] | None
+  placeholders: frozenset[str]
+  # 値を埋め込む前の固定部分のトークン数
+  static_tokens: int
+
+  @classmethod
+  def compile(cls, key: str, source: str) -> "PromptTemplate":
+    segments: list[tuple[str, str | None]] | None = []
+    placeholders = set()
+    literal = ""
+    try:
+      for text, name, format_spec, conversion in string.Formatter().parse(source):
+        literal += text
+        if name is None:
+          continue
+        placeholders.add(name)
+        if format_spec or conversion or not name.isidentifier():
+          segments = None
+        elif segments is not None:
+          segments.append((literal, name))
+          literal = ""
+    except ValueError:
+      # 括弧の対応が取れていない場合は、これまで通り描画時にstr.formatのエラーにする
+      segments = None
+    if segments is not None:
+      segments.append((literal, None))
+    static = "".join(text for text, _ in segments) if segments is not None else source
+    return cls(
+      key=key,
+      source=source,
+      segments=tuple(segments) if segments is not None else None,
+      placeholders=frozenset(placeholders),
+      static_tokens=count_prompt_tokens(static),
+    )
+
+  def render(self, values: dict[str, str]) -> RenderedPrompt:
+    # str.formatと同じく、足りない値があればKeyErrorになり、余分な値は無視する
+    if self.segments is None:
+      text = self.source.format(**values)
+    else:
+      parts = []
+      for literal, name in self.segments:
+        parts.append(literal)
+        if name is not None:
+          parts.append(str(values[name]))
+      text = "".join(parts)
+    return RenderedPrompt(text=text, tokens=count_prompt_tokens(text))
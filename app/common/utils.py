@@ -1,15 +1,25 @@
-import json
 import os
+import threading
+from collections import OrderedDict
 from enum import Enum
+from typing import Any, Iterator
 
-import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as components
-from common.firestore import StudentInfo, load_student_activity_history
-from google.cloud.firestore import Client as FirestoreClient
-from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from common.firestore import ActivitySnapshot, StudentInfo
+from common.params import CHAT_WINDOW_SIZE, PROMPT_CACHE_TTL, PROMPT_SNAPSHOT_DIR
+from common.prompt_store import PromptSheet, PromptStore
+from common.prompt_template import PromptTemplate
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.messages.utils import messages_from_dict
 
 SPREAD_SHEET_URL = os.environ["SPREAD_SHEET_URL"]
+MARKDOWN_CACHE_SIZE = 10000
+# 全てのセッションで共有するプロンプトのシート
+prompt_store = PromptStore(SPREAD_SHEET_URL, PROMPT_CACHE_TTL, PROMPT_SNAPSHOT_DIR)
+# 描画するメッセージのidごとのMarkdown
+_markdown_cache: OrderedDict[str, str] = OrderedDict()
+_markdown_lock = threading.Lock()
 
 BUTTON_STYLE_STUDENT = """
     <style>
@@ -129,69 +139,103 @@ def create_habit_goal_str(student_info: StudentInfo) -> str:
   return achievement_goal
 
 
-def get_summarize_prompt(share_level: str, df: pd.DataFrame) -> str:
-  for _, row in df.iterrows():
-    if f"summarize_{share_level}" not in row.iloc[0]:
-      continue
-
-    prompt = row.iloc[1]
-    return prompt
-
-  return ""
-
-
-def get_system_prompt(phase: int, df: pd.DataFrame) -> str:
-  prompt = ""
-  for _, row in df.iterrows():
-    if "phase" in row.iloc[0] and f"phase{phase}" not in row.iloc[0]:
-      continue
-
-    if "summarize_level" in row.iloc[0]:
-      continue
-
-    prompt += row.iloc[1]
-    prompt += "\n-------------------------\n"
-
-  return prompt
-
-
-def show_chat_history(firebase_db: FirestoreClient, messages: list[BaseMessage], user_name: str) -> None:
-  # ここにfirebase_dbは渡したくないので要リファクタ
-  for message in messages:
-    content: str = message.content
-    if not content:
-      continue
-    content = content.replace("\\n", "\n")
+def get_summarize_prompt(share_level: str, sheet: PromptSheet) -> str:
+  return sheet.summarize_prompt(share_level)
+
+
+def get_system_template(phase: int, sheet: PromptSheet) -> PromptTemplate:
+  return sheet.system_template(phase)
+
+
+def to_markdown(message: BaseMessage) -> str:
+  # 履歴のメッセージは変更されないので、変換した結果をメッセージのidごとに全てのセッションで共有する
+  if not message.id:
+    return message.content.replace("\\n", "\n")
+  with _markdown_lock:
+    markdown = _markdown_cache.get(message.id)
+    if markdown is not None:
+      _markdown_cache.move_to_end(message.id)
+      return markdown
+  markdown = message.content.replace("\\n", "\n")
+  with _markdown_lock:
+    _markdown_cache[message.id] = markdown
+    if len(_markdown_cache) > MARKDOWN_CACHE_SIZE:
+      _markdown_cache.popitem(last=False)
+  return markdown
+
+
+def show_chat_history(activity: ActivitySnapshot, messages: list[BaseMessage], window_key: str = "") -> None:
+  # カレンダーにはactivity(この再実行で読み込んだ生徒の実施履歴)を使う
+  # window_keyを指定した場合は直近のCHAT_WINDOW_SIZE件だけ描画し、それより前はボタンで表示する件数を増やす
+  # 表示件数はwindow_keyごとにsession_stateに保存する
+  # toolとsystemのメッセージは表示しない
+  messages = [message for message in messages if message.content and isinstance(message, (AIMessage, HumanMessage))]
+  if window_key:
+    window_size = st.session_state.get(window_key, CHAT_WINDOW_SIZE)
+    hidden = len(messages) - window_size
+    if hidden > 0:
+      # 再実行の前に件数を増やしておき、ボタンの表示と描画する件数を揃える
+      st.button(
+        f"以前のメッセージを表示(残り{hidden}件)",
+        key=f"{window_key}/older",
+        on_click=lambda: st.session_state.update({window_key: window_size + CHAT_WINDOW_SIZE}),
+      )
+    messages = messages[-window_size:]
+
+  # カレンダーは最後の1つだけ描画する. 同じ生徒の実施実績なので、それより前のものは最新のものと同じ内容になる
+  last_calendar = max(
+    (i for i, message in enumerate(messages) if isinstance(message, HumanMessage) and message.name == "calendar"),
+    default=-1,
+  )
+  for i, message in enumerate(messages):
     if isinstance(message, AIMessage):
       with st.chat_message("Assistant"):
-        st.markdown(content)
-    elif isinstance(message, HumanMessage):
-      if message.name == "calendar":
-        show_calendar(firebase_db, user_name)
+        st.markdown(to_markdown(message))
+    elif message.name == "calendar":
+      if i == last_calendar:
+        show_calendar(activity)
       else:
-        with st.chat_message("User"):
-          st.markdown(content)
-    elif isinstance(message, ToolMessage):
-      # toolは表示しない
-      pass
-      # with st.chat_message("Tool"):
-      #   try:
-      #     content = ast.literal_eval(content)
-      #     content = [json.loads(c) for c in content]
-      #   except (SyntaxError, ValueError):
-      #     content = message.content
-      #   st.markdown(content)
+        st.caption("カレンダー(最新の実施実績は下に表示しています)")
     else:
-      # systemは表示しない
-      # with st.chat_message("system"):
-      #   st.markdown(content)
-      pass
-
-
-def show_calendar(firebase_db: FirestoreClient, user_name: str) -> None:
-  activity_history = load_student_activity_history(firebase_db, user_name)
-  activity_history = [data.dump_for_calendar() for data in activity_history]
-  events_json = json.dumps(activity_history)
+      with st.chat_message("User"):
+        st.markdown(to_markdown(message))
+
+
+def show_streaming_response(events: Iterator[dict[str, Any]]) -> list[BaseMessage]:
+  # 推論サーバから届いたイベントを逐次描画し、最後に増えた分のメッセージを返す
+  received_msgs: list[BaseMessage] = []
+  with st.chat_message("Assistant"):
+    placeholder = st.empty()
+    tool_status = {}
+    text = ""
+    for event in events:
+      event_type = event.get("type")
+      if event_type == "token":
+        text += event["content"]
+        placeholder.markdown(text.replace("\\n", "\n") + "▌")
+      elif event_type == "tool_start":
+        # ツール呼び出しの前後でメッセージが分かれるので描画先も分ける
+        if text:
+          placeholder.markdown(text.replace("\\n", "\n"))
+        tool_status[event["id"]] = st.empty()
+        tool_status[event["id"]].caption(f"{event['name']} を実行中...")
+        placeholder = st.empty()
+        text = ""
+      elif event_type == "tool_end":
+        if event["id"] in tool_status:
+          tool_status[event["id"]].caption(f"{event['name']} が完了しました")
+      elif event_type == "done":
+        received_msgs = messages_from_dict(event["messages"])
+      elif event_type == "error":
+        print(f"error from infer server: {event.get('detail')}")
+        if "retry_after" in event:
+          st.warning(f"混み合っています。{event['retry_after']}秒ほど待ってからもう一度送信してください。")
+    placeholder.markdown(text.replace("\\n", "\n"))
+  return received_msgs
+
+
+def show_calendar(activity: ActivitySnapshot) -> None:
+  events_json = activity.calendar_json()
 
   components.html(
     f"""
@@ -0,0 +1,105 @@
+from typing import Any, Literal
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from pydantic import BaseModel
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+
+# /v2/inferでやり取りするメッセージ
+# messages_to_dictの形式と違い、表示と推論に必要な項目だけを持つ
+class WireToolCall(BaseModel):
+  id: str | None = None
+  name: str
+  args: dict[str, Any] = {}
+
+
+class WireMessage(BaseModel):
+  type: Literal["system", "human", "ai", "tool"]
+  content: str | list[Any] = ""
+  id: str | None = None
+  name: str | None = None
+  tool_calls: list[WireToolCall] = []
+  tool_call_id: str | None = None
+  # ツールの結果がエラーかどうか(ToolMessageのみ). エラーの結果を往復させても成功にならないようにする
+  status: Literal["success", "error"] = "success"
+  additional_kwargs: dict[str, Any] = {}
+
+
+class InferRequestV2(BaseModel):
+  messages: list[WireMessage]
+
+
+class InferResponseV2(BaseModel):
+  # エージェントが追加したメッセージのみ
+  messages: list[WireMessage]
+
+
+class SummarizeRequest(BaseModel):
+  messages: list[WireMessage]
+
+
+class SummarizeResponse(BaseModel):
+  summary: str
+
+
+class SummaryJobRequest(BaseModel):
+  # student: 生徒とAIの会話を先生向けにまとめる, teacher: 先生とAIの会話を生徒への伝言にまとめる
+  kind: Literal["student", "teacher"]
+  user_name: str
+  teacher_name: str = ""
+  system_prompt: str
+  # ユーザプロンプトの見出し
+  heading: str
+  messages: list[WireMessage]
+
+
+class ToolCallRequest(BaseModel):
+  # エージェントを通さずにツールを呼び出す(/tools/call, /tools/prefetch)
+  name: str
+  args: dict[str, Any] = {}
+  id: str | None = None
+
+
+def to_wire(message: BaseMessage) -> WireMessage:
+  wire = WireMessage(
+    type=message.type,
+    content=message.content,
+    id=message.id,
+    name=message.name,
+    additional_kwargs=message.additional_kwargs,
+  )
+  if isinstance(message, AIMessage):
+    wire.tool_calls = [
+      WireToolCall(id=tool_call["id"], name=tool_call["name"], args=tool_call["args"])
+      for tool_call in message.tool_calls
+    ]
+  elif isinstance(message, ToolMessage):
+    wire.tool_call_id = message.tool_call_id
+    wire.status = message.status
+  return wire
+
+
+def from_wire(wire: WireMessage) -> BaseMessage:
+  common = {"content": wire.content, "id": wire.id, "name": wire.name, "additional_kwargs": wire.additional_kwargs}
+  if wire.type == "system":
+    return SystemMessage(**common)
+  if wire.type == "human":
+    return HumanMessage(**common)
+  if wire.type == "ai":
+    tool_calls = [{"id": t.id, "name": t.name, "args": t.args} for t in wire.tool_calls]
+    return AIMessage(**common, tool_calls=tool_calls)
+  return ToolMessage(**common, tool_call_id=wire.tool_call_id, status=wire.status)
+
+
+def pack(data: dict[str, Any]) -> bytes:
+  return msgpack.packb(data, use_bin_type=True)
+
+
+def unpack(data: bytes) -> dict[str, Any]:
+  return msgpack.unpackb(data, raw=False)
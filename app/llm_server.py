@@ -1,129 +1,530 @@
-import ast
+import asyncio
+import hashlib
 import json
+import logging
 import os
-from contextlib import AsyncExitStack
-
-from fastapi import FastAPI
-from langchain_core.messages import ToolMessage
+import time
+import uuid
+import zlib
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable
+from urllib.parse import unquote
+
+import firebase_admin
+from common.firestore import (
+  ChatSummaryState,
+  load_student_chat_summary,
+  load_teacher_chat_summary,
+  save_student_chat_summary,
+  save_teacher_chat_summary,
+)
+from common.history_window import HistoryWindow, estimate_tokens
+from common.params import HISTORY_TOKEN_BUDGET
+from common.wire import (
+  MSGPACK_MEDIA_TYPE,
+  InferRequestV2,
+  InferResponseV2,
+  SummarizeRequest,
+  SummarizeResponse,
+  SummaryJobRequest,
+  ToolCallRequest,
+  WireMessage,
+  from_wire,
+  msgpack,
+  pack,
+  to_wire,
+  unpack,
+)
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from firebase_admin import firestore
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, SystemMessage, ToolMessage
 from langchain_core.messages.base import messages_to_dict
 from langchain_core.messages.utils import messages_from_dict
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.tools import BaseTool, ToolException
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_mcp_adapters.resources import load_mcp_resources
-from langchain_mcp_adapters.tools import load_mcp_tools
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.prebuilt import create_react_agent
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from server import metrics
+from server.admission import AdmissionController, AdmissionRejected
+from server.deadline import agent_runs_cancelled_total, current_deadline
+from server.idempotency import Execution, IdempotencyKeyMismatch, IdempotencyStore
+from server.mcp_servers import McpServer, start_mcp_servers
+from server.rolling_summary import build_summary_prompt, prompt_hash, select_new_messages
+from server.session import ConversationStore
+from server.summary_queue import SummaryQueue
+from server.telemetry import ModelMetricsCallback, current_timer, finish_request, log_messages, span, start_request
+from server.tool_cache import ToolCache
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 # for langsmith
-os.environ["LANGCHAIN_TRACING"] = "true"
-os.environ["LANGSMITH_ENDPOINT"] = "https://api.smith.langchain.com"
-os.environ["LANGSMITH_PROJECT"] = "habit_agent"
+os.environ.setdefault("LANGCHAIN_TRACING", "true")
+os.environ.setdefault("LANGSMITH_ENDPOINT", "https://api.smith.langchain.com")
+os.environ.setdefault("LANGSMITH_PROJECT", "habit_agent")
 
 GOOGLE_CUSTOM_SEARCH_API_KEY = os.environ["GOOGLE_CUSTOM_SEARCH_API_KEY"]
 GOOGLE_CUSTOM_SEARCH_ENGINE_ID = os.environ["GOOGLE_CUSTOM_SEARCH_ENGINE_ID"]
 
-CONFIG_PATH = "./config/config.json"
+CONFIG_PATH = os.getenv("MCP_CONFIG_PATH", "./config/config.json")
+# fakeならGeminiの代わりにベンチマーク用の偽のモデルを使う(benchmark/fake_model.py)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "./sessions.sqlite")
+# この秒数使われていないセッションの会話を消す. 0なら消さない
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(30 * 24 * 3600)))
+SESSION_CLEANUP_INTERVAL = 3600
+# lazyモードではマニフェストのツール定義を使い、MCPサーバは最初のツール呼び出し時に起動する
+MCP_LAZY_START = os.getenv("MCP_LAZY_START", "") == "1"
+MCP_MANIFEST_PATH = os.getenv("MCP_MANIFEST_PATH", "./config/mcp_manifest.json")
 
 DEBUG_MESSAGE_SIZE = 100
+ABORTED_MESSAGE = "時間内に回答できなかったため中断しました。もう一度送ってください。"
 TEMPERATUE = 0.5
+# サマリ作成はチャットとは別に同時実行数を制限する
+SUMMARIZE_CONCURRENCY = int(os.getenv("SUMMARIZE_CONCURRENCY", "4"))
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "2"))
+# ツールの先読みの同時実行数. 推論のスロットとは別に数え、空きが無ければ先読みしない
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+# 推論リクエストの同時実行数と待ち行列の上限
+# ユーザごとにUSER_REQUESTS_PER_MINUTEのペースで、USER_BURST回まで連続でリクエストできる
+INFER_CONCURRENCY = int(os.getenv("INFER_CONCURRENCY", "8"))
+INFER_QUEUE_SIZE = int(os.getenv("INFER_QUEUE_SIZE", "32"))
+INFER_QUEUE_TIMEOUT = float(os.getenv("INFER_QUEUE_TIMEOUT", "30"))
+USER_REQUESTS_PER_MINUTE = float(os.getenv("USER_REQUESTS_PER_MINUTE", "20"))
+USER_BURST = float(os.getenv("USER_BURST", "5"))
+# ユーザごとのレート制限の状態を保持する上限. 満タンに戻ったものから捨てる
+USER_BUCKETS_MAX = int(os.getenv("USER_BUCKETS_MAX", "10000"))
+# メッセージの内容をログに出すリクエストの割合(LOG_LEVEL=DEBUGのときのみ)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+# 1なら全てのレスポンスに処理時間の内訳を付ける. それ以外はX-Debug-Timing: 1のリクエストのみ
+SERVER_TIMING = os.getenv("SERVER_TIMING", "") == "1"
+# 履歴のトークン数の数え方. model: 文字数で見積もった後、バックグラウンドでモデルのAPIで数え直す, estimate: 文字数から見積もる
+HISTORY_TOKEN_COUNTER = os.getenv("HISTORY_TOKEN_COUNTER", "model")
+# 1回の推論でモデルのAPIでの数え直しを頼むメッセージ数の上限
+HISTORY_TOKEN_REFINES = int(os.getenv("HISTORY_TOKEN_REFINES", "8"))
+# ツールの結果のキャッシュ. TOOL_CACHE_PATHを指定するとsqliteに保存して再起動後も使う
+TOOL_CACHE_SIZE = int(os.getenv("TOOL_CACHE_SIZE", "1000"))
+TOOL_CACHE_PATH = os.getenv("TOOL_CACHE_PATH", "")
+# Idempotency-Keyが同じ推論リクエストの結果を再利用する秒数と件数
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "120"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "1000"))
+# 推論リクエストの期限(秒). 過ぎた場合はエージェントを止めて途中までの返答か定型文を返す
+INFER_DEADLINE = float(os.getenv("INFER_DEADLINE", "120"))
+# ストリーミングでないリクエストで、クライアントの切断を確認する間隔(秒)
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+# gzipで圧縮されたリクエストを展開した後の最大サイズ(バイト)
+MAX_DECOMPRESSED_BODY = int(os.getenv("MAX_DECOMPRESSED_BODY", str(16 * 2**20)))
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("habit.infer_server")
 
 
 class UserInput(BaseModel):
   message: str
 
 
+class SessionInput(BaseModel):
+  session_id: str
+  # 前回のリクエストから増えたメッセージ(messages_to_dictの形式)
+  messages: list[dict[str, Any]] = []
+  # 変更があったときだけ送られてくる
+  system_prompt: str | None = None
+  # 送られてきた場合は会話を新しい世代として作り直し、この履歴から始める
+  history: list[dict[str, Any]] | None = None
+
+
 app = FastAPI()
 
 exit_stack = AsyncExitStack()
 agent = None
-model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", temperature=TEMPERATUE)
+# 会話履歴をサーバ側で保持するエージェント
+session_agent = None
+checkpointer = None
+conversation_store = None
+session_cleanup_task = None
+if LLM_BACKEND == "fake":
+  from benchmark.fake_model import FakeChatModel
+
+  model = FakeChatModel.from_env(callbacks=[ModelMetricsCallback()])
+else:
+  model = ChatGoogleGenerativeAI(
+    model="gemini-2.0-flash-exp", temperature=TEMPERATUE, callbacks=[ModelMetricsCallback()]
+  )
 # 2.5 flashはかなり遅い
 # model = ChatGoogleGenerativeAI(model="gemini-2.5-flash-preview-05-20", temperature=TEMPERATUE)
 tools = []
 resources = []
+mcp_servers: dict[str, McpServer] = {}
+tool_cache = ToolCache(TOOL_CACHE_SIZE, TOOL_CACHE_PATH)
+# 実行中の先読み(タスクが途中で破棄されないように参照を持っておく)
+prefetch_tasks: set[asyncio.Task] = set()
+startup_status: dict[str, float] = {}
+summarize_semaphore = asyncio.Semaphore(SUMMARIZE_CONCURRENCY)
+prefetch_semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+firebase_db = None
+
+
+def get_firebase_db() -> firestore.Client:
+  # サマリの書き込みが必要になるまでfirebaseの初期化を遅らせる
+  global firebase_db
+  if firebase_db is None:
+    if not firebase_admin._apps:
+      firebase_admin.initialize_app(options={"projectId": "habit-agent"})
+    firebase_db = firestore.client()
+  return firebase_db
+
+
+async def run_summary_job(job: SummaryJobRequest) -> None:
+  messages = [from_wire(message) for message in job.messages]
+  db = get_firebase_db()
+  if job.kind == "student":
+    state = await asyncio.to_thread(load_student_chat_summary, db, job.user_name)
+  else:
+    state = await asyncio.to_thread(load_teacher_chat_summary, db, job.teacher_name, job.user_name)
+
+  # サマリ作成のプロンプト(共有レベルなど)が変わった場合は、前回のサマリを使わずに作り直す
+  current_prompt_hash = prompt_hash(job.system_prompt)
+  if state.prompt_hash != current_prompt_hash:
+    state = ChatSummaryState(prompt_hash=current_prompt_hash)
+
+  new_messages = select_new_messages(messages, state.watermark)
+  if not new_messages:
+    return
+
+  prompt_messages = build_summary_prompt(job.system_prompt, job.heading, state.summary, new_messages)
+  async with summarize_semaphore:
+    response = await model.ainvoke(prompt_messages)
+  state = ChatSummaryState(
+    summary=message_text(response), watermark=new_messages[-1].id or "", prompt_hash=current_prompt_hash
+  )
+
+  if job.kind == "student":
+    await asyncio.to_thread(save_student_chat_summary, db, job.user_name, state)
+  else:
+    await asyncio.to_thread(save_teacher_chat_summary, db, job.teacher_name, job.user_name, state)
+
+
+summary_queue = SummaryQueue(run_summary_job)
+admission = AdmissionController(
+  max_concurrency=INFER_CONCURRENCY,
+  max_queue=INFER_QUEUE_SIZE,
+  queue_timeout=INFER_QUEUE_TIMEOUT,
+  user_rate=USER_REQUESTS_PER_MINUTE / 60,
+  user_burst=USER_BURST,
+  max_buckets=USER_BUCKETS_MAX,
+)
+idempotency = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_ENTRIES)
+
+
+def request_user(request: Request) -> str:
+  # UIはX-User-Nameに生徒名/先生名をパーセントエンコードして送ってくる
+  user = request.headers.get("x-user-name")
+  if user:
+    return unquote(user)
+  return request.client.host if request.client else "anonymous"
+
+
+async def admit(request: Request) -> float:
+  with span("admission"):
+    return await admission.acquire(request_user(request))
+
+
+@asynccontextmanager
+async def admitted(request: Request) -> AsyncIterator[None]:
+  admitted_at = await admit(request)
+  try:
+    yield
+  finally:
+    admission.release(admitted_at)
+
+
+class ClientDisconnected(Exception):
+  pass
+
+
+def request_deadline(request: Request) -> float:
+  # 期限はINFER_DEADLINE秒後. X-Request-Timeout(秒)が付いていればそれより短くできる
+  timeout = INFER_DEADLINE
+  header = request.headers.get("x-request-timeout")
+  if header:
+    try:
+      timeout = min(timeout, float(header))
+    except ValueError:
+      raise HTTPException(status_code=400, detail="invalid X-Request-Timeout")
+  return asyncio.get_running_loop().time() + timeout
+
+
+async def until_disconnected(request: Request, awaitable: Awaitable[Any]) -> Any:
+  # uvicornはクライアントが切断してもハンドラを止めないので、待っている間に切断を確認する
+  task = asyncio.ensure_future(awaitable)
+  try:
+    while True:
+      done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+      if done:
+        return task.result()
+      if await request.is_disconnected():
+        raise ClientDisconnected()
+  finally:
+    task.cancel()
+
+
+async def run_once(
+  request: Request, produce: Callable[[], AsyncIterator[Any]], failed: Callable[[Any], bool] | None = None
+) -> Execution:
+  # エージェントは別のタスクで実行し、待っているリクエストが全て切断したらキャンセルする
+  # Idempotency-Keyが付いたリクエストは、同じキーで実行中または完了済みの実行を共有する
+  # Streamlitの再実行やダブルクリックで同じターンが再送されても、エージェントは1回しか動かない
+  current_deadline.set(request_deadline(request))
+  key = request.headers.get("idempotency-key")
+  if key:
+    key = f"{request_user(request)}/{key}"
+    fingerprint = hashlib.sha256(await request.body()).hexdigest()
+    try:
+      execution, owner = idempotency.begin(key, fingerprint, request.url.path)
+    except IdempotencyKeyMismatch as e:
+      raise HTTPException(status_code=422, detail=str(e))
+    if owner:
+      idempotency.run(key, execution, produce(), failed)
+  else:
+    execution = Execution()
+    execution.start(produce(), failed)
+
+  # 最初の結果までに起きた例外(混雑など)はレスポンスを返す前にステータスコードとして返す
+  execution.subscribe()
+  try:
+    await until_disconnected(request, execution.first())
+  except BaseException:
+    execution.unsubscribe()
+    raise
+  return execution
+
+
+async def call_once(request: Request, call: Callable[[], Awaitable[Any]]) -> Any:
+  async def produce() -> AsyncIterator[Any]:
+    yield await call()
+
+  execution = await run_once(request, produce)
+  execution.unsubscribe()
+  return execution.items[0]
+
+
+def is_error_event(event: dict[str, Any]) -> bool:
+  return event["type"] == "error"
+
+
+# リクエストごとの処理時間とサイズを記録する
+# @app.middleware("http")のBaseHTTPMiddlewareを通すとエンドポイントからクライアントの切断を検知できないので、ASGIのミドルウェアにする
+class MeasureRequest:
+  def __init__(self, app: ASGIApp):
+    self.app = app
+
+  async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+    if scope["type"] != "http":
+      await self.app(scope, receive, send)
+      return
+
+    headers = Headers(scope=scope)
+    expose = SERVER_TIMING or headers.get("x-debug-timing") == "1"
+    timer = start_request(scope["path"], LOG_SAMPLE_RATE, expose)
+    request_size = int(headers.get("content-length") or 0)
+    status_code = 500
+    response_size = 0
+
+    async def measured_send(message: Message) -> None:
+      nonlocal status_code, response_size
+      if message["type"] == "http.response.start":
+        status_code = message["status"]
+        route = scope.get("route")
+        timer.endpoint = route.path if route is not None else "unmatched"
+        # ストリーミングでないレスポンスはこの時点でエンドポイントの処理が終わっている
+        # ストリーミングの場合はdoneイベントに内訳を入れる
+        response_headers = MutableHeaders(scope=message)
+        if expose and "content-length" in response_headers:
+          response_headers["Server-Timing"] = timer.server_timing()
+      elif message["type"] == "http.response.body":
+        response_size += len(message.get("body", b""))
+      await send(message)
+
+    try:
+      await self.app(scope, receive, measured_send)
+    finally:
+      finish_request(timer, status_code, request_size, response_size)
+
+
+# UIはサイズの大きいリクエスト(履歴やサマリ対象の会話)をgzipで圧縮して送るので、エンドポイントに渡す前に展開する
+# 本文は一度に読み込んで展開し、展開後は元のreceiveをそのまま使う(切断の検知のため)
+class DecompressRequest:
+  def __init__(self, app: ASGIApp):
+    self.app = app
+
+  async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+    if scope["type"] != "http" or Headers(scope=scope).get("content-encoding", "").lower() != "gzip":
+      await self.app(scope, receive, send)
+      return
+
+    chunks = []
+    while True:
+      message = await receive()
+      if message["type"] == "http.disconnect":
+        return
+      chunks.append(message.get("body", b""))
+      if not message.get("more_body", False):
+        break
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+      body = decompressor.decompress(b"".join(chunks), MAX_DECOMPRESSED_BODY + 1)
+    except zlib.error as e:
+      await JSONResponse({"detail": f"invalid gzip body: {e}"}, status_code=400)(scope, receive, send)
+      return
+    if len(body) > MAX_DECOMPRESSED_BODY:
+      await JSONResponse({"detail": "request body is too large"}, status_code=413)(scope, receive, send)
+      return
+
+    # MeasureRequestがエンドポイント名(route)を読めるよう、scopeはコピーせずに書き換える
+    headers = MutableHeaders(scope=scope)
+    del headers["content-encoding"]
+    headers["content-length"] = str(len(body))
+    replayed = False
+
+    async def decompressed_receive() -> Message:
+      nonlocal replayed
+      if not replayed:
+        replayed = True
+        return {"type": "http.request", "body": body, "more_body": False}
+      return await receive()
+
+    await self.app(scope, decompressed_receive, send)
+
+
+app.add_middleware(DecompressRequest)
+# 圧縮されたままのサイズを記録するため、展開より外側で測る
+app.add_middleware(MeasureRequest)
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, e: ClientDisconnected) -> Response:
+  # クライアントには届かないが、ログとメトリクスでは切断として数える
+  return Response(status_code=499)
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, e: AdmissionRejected) -> JSONResponse:
+  return JSONResponse(
+    status_code=e.status_code,
+    content={"detail": e.reason, "retry_after": e.retry_after_header},
+    headers={"Retry-After": e.retry_after_header},
+  )
+
+
+async def delete_threads(thread_ids: list[str]) -> None:
+  for thread_id in thread_ids:
+    await checkpointer.adelete_thread(thread_id)
+
+
+async def session_cleanup_loop() -> None:
+  # 使われなくなったセッションの会話を定期的に消し、sessions.sqliteが増え続けないようにする
+  while True:
+    try:
+      thread_ids = await conversation_store.expire(SESSION_TTL)
+      await delete_threads(thread_ids)
+      if thread_ids:
+        logger.info(f"expired {len(thread_ids)} sessions")
+    except Exception:
+      logger.exception("failed to expire sessions")
+    await asyncio.sleep(min(SESSION_TTL, SESSION_CLEANUP_INTERVAL))
 
 
 @app.on_event("startup")
 async def startup_event():
-  global exit_stack, agent, tools, resources
+  global exit_stack, agent, session_agent, checkpointer, conversation_store, session_cleanup_task, tools, resources
 
   with open(CONFIG_PATH) as f:
     config_data = json.load(f)
-  mcp_servers = config_data["mcpServers"]
 
   await exit_stack.__aenter__()
   print("MCP server initializing")
-  for server_name, server_info in mcp_servers.items():
-    print(f"--------------- {server_name} ---------------")
-
-    if "env" in server_info:
-      env = {k: os.environ[v] for k, v in server_info["env"].items()}
-    else:
-      env = {}
-
-    is_docker = os.path.exists("/DOCKER")
-    command = "uv" if is_docker else server_info["command"]
-    server_params = StdioServerParameters(
-      command=command,
-      args=server_info["args"],
-      env=env,
-    )
-    read_stream, write_stream = await exit_stack.enter_async_context(stdio_client(server_params))
-    session = await exit_stack.enter_async_context(ClientSession(read_stream, write_stream))
+  startup_started_at = time.monotonic()
+  for server_name, server_info in config_data["mcpServers"].items():
+    mcp_servers[server_name] = McpServer(server_name, server_info, tool_cache)
+  await start_mcp_servers(mcp_servers, lazy=MCP_LAZY_START, manifest_path=MCP_MANIFEST_PATH)
 
-    await session.initialize()
+  for server_name, server in mcp_servers.items():
+    print(f"--------------- {server_name} ({server.state}, {server.startup_seconds}s) ---------------")
+    if server.error:
+      print(f"failed to start: {server.error}")
 
-    server_tools = await load_mcp_tools(session)
+    server_tools = server.create_tools()
     print("<Available tools>")
     for tool in server_tools:
       print(f" - {tool.name}: {tool.description}")
       tools.append(tool)
 
-    server_resources = await load_mcp_resources(session)
     print("<Available resources>")
-    for resource in server_resources:
+    for resource in server.resources:
       print(f" - {resource.data}, {resource.mimetype}, {resource.metadata}")
       resources.append(resource)
+  startup_status["mcp_startup_seconds"] = time.monotonic() - startup_started_at
 
   agent = create_react_agent(model, tools)
 
+  checkpointer = await exit_stack.enter_async_context(AsyncSqliteSaver.from_conn_string(SESSION_DB_PATH))
+  conversation_store = ConversationStore(SESSION_DB_PATH)
+  if SESSION_TTL > 0:
+    session_cleanup_task = asyncio.create_task(session_cleanup_loop())
+  session_agent = create_react_agent(
+    model, tools, prompt=RunnableLambda(create_session_prompt), checkpointer=checkpointer
+  )
+
+  summary_queue.start(SUMMARY_WORKERS)
+  startup_status["startup_seconds"] = time.monotonic() - startup_started_at
+
+
+def count_message_tokens(message: BaseMessage) -> int:
+  # tools/count_token.pyと同じ数え方. Geminiでは通信するので、HistoryWindowがバックグラウンドのスレッドで呼ぶ
+  return model.get_num_tokens_from_messages([message])
+
+
+history_window = HistoryWindow(
+  HISTORY_TOKEN_BUDGET,
+  estimate_tokens,
+  refine_tokens=count_message_tokens if HISTORY_TOKEN_COUNTER == "model" else None,
+  max_refines=HISTORY_TOKEN_REFINES,
+)
+
+
+def create_session_prompt(state: dict[str, Any], config: RunnableConfig) -> list[BaseMessage]:
+  # checkpointerには全履歴が残るので、モデルにはトークン数の上限に収まる直近の履歴とシステムプロンプトだけを渡す
+  system_prompt = config["configurable"]["system_prompt"]
+  return [SystemMessage(content=system_prompt)] + history_window.select(state["messages"])
+
 
 @app.on_event("shutdown")
 async def shutdown():
   global exit_stack
+  if session_cleanup_task is not None:
+    session_cleanup_task.cancel()
+  await summary_queue.stop()
+  await asyncio.gather(*(server.stop() for server in mcp_servers.values()))
   await exit_stack.__aexit__(None, None, None)
 
 
 @app.post("/infer")
-async def infer(input_data: UserInput):
+async def infer(input_data: UserInput, request: Request):
   global agent
 
-  print("=============================================")
   # ユーザからの入力はAPI経由でjsonでくるのでlangchainのメッセージオブジェクトに変換
   messages = messages_from_dict(json.loads(input_data.message))
+  log_messages("input", messages, DEBUG_MESSAGE_SIZE)
 
-  print("---------- [infer server]: user input data from ui ----------")
-  for message in messages:
-    print(f"{message.__class__.__name__}: {message.content[:DEBUG_MESSAGE_SIZE]}")
-
-  agent_response = await agent.ainvoke({"messages": messages})
-  agent_response = agent_response["messages"]
-
-  print("---------- [infer server]: ai agent response ----------")
-
-  for message in agent_response:
-    # デバッグ表示のために形式を変換
-    if isinstance(message, ToolMessage):
-      try:
-        contents = ast.literal_eval(message.content)
-        contents = [json.loads(content) for content in contents]
-      except (SyntaxError, ValueError):
-        contents = message.content
-    else:
-      contents = message.content
+  async def call() -> list[BaseMessage]:
+    async with admitted(request):
+      return await collect_new_messages(agent, {"messages": messages})
 
-    print(f"{message.__class__.__name__}: {contents[:DEBUG_MESSAGE_SIZE]}, {type(message)}")
+  agent_response = messages + await call_once(request, call)
+  log_messages("output", agent_response, DEBUG_MESSAGE_SIZE)
 
   # langchainのinvokeで得たデータはメッセージオブジェクトなのでjsonに変換
   json_data = messages_to_dict(agent_response)
@@ -131,6 +532,330 @@ async def infer(input_data: UserInput):
   return {"response": json_str}
 
 
+async def close_aborted_turn(
+  graph: Any, config: RunnableConfig | None, new_messages: list[BaseMessage], partial_text: str
+) -> list[BaseMessage]:
+  # 途中で止めたターンを閉じるメッセージを作る
+  # 結果の無いツール呼び出しにはエラーの結果を入れ、途中までの返答(無ければ定型文)を最後に追加する
+  answered = {message.tool_call_id for message in new_messages if isinstance(message, ToolMessage)}
+  closing: list[BaseMessage] = []
+  for message in new_messages:
+    if not isinstance(message, AIMessage):
+      continue
+    for tool_call in message.tool_calls:
+      if tool_call["id"] not in answered:
+        closing.append(
+          ToolMessage(
+            content="cancelled",
+            tool_call_id=tool_call["id"],
+            name=tool_call["name"],
+            status="error",
+            id=str(uuid.uuid4()),
+          )
+        )
+  content = f"{partial_text}\n\n({ABORTED_MESSAGE})" if partial_text else ABORTED_MESSAGE
+  closing.append(AIMessage(content=content, id=str(uuid.uuid4())))
+
+  # サーバ側で会話を保持している場合は、次のターンで使えるように会話にも追加する
+  if config is not None:
+    await graph.aupdate_state(config, {"messages": closing}, as_node="agent")
+  return closing
+
+
+async def collect_new_messages(
+  graph: Any, agent_input: dict[str, Any], config: RunnableConfig | None = None
+) -> list[BaseMessage]:
+  # 入力したメッセージは含めず、エージェントが追加したメッセージだけを集める
+  new_messages: list[BaseMessage] = []
+  try:
+    async with asyncio.timeout_at(current_deadline.get()):
+      async for chunk in graph.astream(agent_input, config, stream_mode="updates"):
+        for update in chunk.values():
+          if isinstance(update, dict):
+            new_messages.extend(update.get("messages", []))
+  except TimeoutError:
+    agent_runs_cancelled_total.inc(reason="deadline")
+    new_messages.extend(await close_aborted_turn(graph, config, new_messages, ""))
+  except asyncio.CancelledError:
+    if config is not None:
+      await asyncio.shield(close_aborted_turn(graph, config, new_messages, ""))
+    raise
+  return new_messages
+
+
+def message_text(message: BaseMessage) -> str:
+  # geminiはcontentをlistで返すことがあるのでテキスト部分だけを取り出す
+  if isinstance(message.content, str):
+    return message.content
+  texts = []
+  for part in message.content:
+    if isinstance(part, str):
+      texts.append(part)
+    elif isinstance(part, dict) and part.get("type") == "text":
+      texts.append(part.get("text", ""))
+  return "".join(texts)
+
+
+def to_ndjson(event: dict[str, Any]) -> str:
+  return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+async def ndjson_stream(events: AsyncIterator[dict[str, Any]]) -> AsyncIterator[str]:
+  async for event in events:
+    yield to_ndjson(event)
+
+
+async def stream_agent_events(
+  graph: Any, agent_input: dict[str, Any], config: RunnableConfig | None = None
+) -> AsyncIterator[dict[str, Any]]:
+  # トークン、ツールの開始/終了、最後に増えた分のメッセージをイベントとして順に返す
+  new_messages: list[BaseMessage] = []
+  # 生成中の返答. 期限を過ぎた場合はここまでを返す
+  partial_text = ""
+  aborted = False
+  try:
+    async with asyncio.timeout_at(current_deadline.get()):
+      async for mode, chunk in graph.astream(agent_input, config, stream_mode=["messages", "updates"]):
+        if mode == "messages":
+          message, metadata = chunk
+          if isinstance(message, AIMessageChunk) and metadata.get("langgraph_node") == "agent":
+            text = message_text(message)
+            if text:
+              partial_text += text
+              yield {"type": "token", "content": text}
+        elif mode == "updates":
+          for update in chunk.values():
+            if not isinstance(update, dict):
+              continue
+            for message in update.get("messages", []):
+              new_messages.append(message)
+              if isinstance(message, AIMessage):
+                partial_text = ""
+                for tool_call in message.tool_calls:
+                  yield {
+                    "type": "tool_start",
+                    "id": tool_call["id"],
+                    "name": tool_call["name"],
+                    "args": tool_call["args"],
+                  }
+              elif isinstance(message, ToolMessage):
+                yield {"type": "tool_end", "id": message.tool_call_id, "name": message.name, "status": message.status}
+  except TimeoutError:
+    agent_runs_cancelled_total.inc(reason="deadline")
+    aborted = True
+    new_messages.extend(await close_aborted_turn(graph, config, new_messages, partial_text))
+  except asyncio.CancelledError:
+    # クライアントが切断した
+    if config is not None:
+      await asyncio.shield(close_aborted_turn(graph, config, new_messages, partial_text))
+    raise
+  except Exception as e:
+    logger.exception("streaming failed")
+    yield {"type": "error", "detail": str(e)}
+
+  # 入力したメッセージは含めず、エージェントが追加した分だけを返す
+  done = {"type": "done", "messages": messages_to_dict(new_messages)}
+  if aborted:
+    done["aborted"] = "deadline"
+  timer = current_timer.get()
+  if timer is not None and timer.expose:
+    done["timing"] = timer.breakdown()
+  yield done
+
+
+@app.post("/infer/stream")
+async def infer_stream(input_data: UserInput, request: Request) -> StreamingResponse:
+  messages = messages_from_dict(json.loads(input_data.message))
+
+  log_messages("input", messages, DEBUG_MESSAGE_SIZE)
+
+  async def produce() -> AsyncIterator[dict[str, Any]]:
+    async with admitted(request):
+      async for event in stream_agent_events(agent, {"messages": messages}):
+        yield event
+
+  # 混雑時はストリームを始める前に429/503を返す
+  execution = await run_once(request, produce, is_error_event)
+  return StreamingResponse(ndjson_stream(execution.replay()), media_type="application/x-ndjson")
+
+
+async def prepare_session_turn(input_data: SessionInput) -> tuple[dict[str, Any], RunnableConfig]:
+  session_id = input_data.session_id
+  messages = messages_from_dict(input_data.messages)
+  if not messages and not input_data.history:
+    raise HTTPException(status_code=400, detail="no messages")
+
+  if input_data.history is not None:
+    # UI側の履歴から会話を作り直す
+    previous_thread_id, thread_id = await conversation_store.reset(session_id)
+    if previous_thread_id is not None:
+      # 前の世代の会話はもう使われないので消す
+      await delete_threads([previous_thread_id])
+    messages = messages_from_dict(input_data.history) + messages
+  else:
+    thread_id = await conversation_store.thread_id(session_id)
+    with span("session"):
+      checkpoint = await checkpointer.aget_tuple({"configurable": {"thread_id": thread_id}})
+    if checkpoint is None:
+      # サーバ側に会話が無い(再起動などで消えた)ので、UIに履歴ごと送り直してもらう
+      raise HTTPException(status_code=409, detail="session_not_found")
+
+  if input_data.system_prompt is not None:
+    await conversation_store.update_system_prompt(session_id, input_data.system_prompt)
+  system_prompt = await conversation_store.system_prompt(session_id)
+  if system_prompt is None:
+    raise HTTPException(status_code=409, detail="session_not_found")
+
+  log_messages(f"session {session_id} ({thread_id})", messages, DEBUG_MESSAGE_SIZE)
+
+  config = {"configurable": {"thread_id": thread_id, "system_prompt": system_prompt}}
+  return {"messages": messages}, config
+
+
+@app.post("/session/infer")
+async def session_infer(input_data: SessionInput, request: Request) -> dict[str, Any]:
+  # 重複したリクエストで会話が作り直されたりメッセージが二重に追加されたりしないよう、準備も1回だけ行う
+  async def call() -> list[BaseMessage]:
+    agent_input, config = await prepare_session_turn(input_data)
+    async with admitted(request):
+      return await collect_new_messages(session_agent, agent_input, config)
+
+  new_messages = await call_once(request, call)
+  return {"messages": messages_to_dict(new_messages)}
+
+
+@app.post("/session/infer/stream")
+async def session_infer_stream(input_data: SessionInput, request: Request) -> StreamingResponse:
+  async def produce() -> AsyncIterator[dict[str, Any]]:
+    agent_input, config = await prepare_session_turn(input_data)
+    async with admitted(request):
+      async for event in stream_agent_events(session_agent, agent_input, config):
+        yield event
+
+  execution = await run_once(request, produce, is_error_event)
+  return StreamingResponse(ndjson_stream(execution.replay()), media_type="application/x-ndjson")
+
+
+@app.post("/v2/infer", response_model=InferResponseV2)
+async def infer_v2(request: Request) -> Response:
+  # メッセージを文字列に埋め込まず、型付きのリストとしてそのままやり取りする
+  # Content-Type/Acceptがapplication/msgpackならmsgpackで送受信する
+  body = await request.body()
+  use_msgpack_input = request.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE)
+  use_msgpack_output = MSGPACK_MEDIA_TYPE in request.headers.get("accept", "")
+  if (use_msgpack_input or use_msgpack_output) and msgpack is None:
+    raise HTTPException(status_code=415, detail="msgpack is not available")
+
+  try:
+    if use_msgpack_input:
+      input_data = InferRequestV2.model_validate(unpack(body))
+    else:
+      input_data = InferRequestV2.model_validate_json(body)
+  except (ValidationError, ValueError) as e:
+    raise HTTPException(status_code=422, detail=str(e))
+
+  messages = [from_wire(message) for message in input_data.messages]
+
+  async def call() -> list[BaseMessage]:
+    async with admitted(request):
+      return await collect_new_messages(agent, {"messages": messages})
+
+  new_messages = await call_once(request, call)
+  output_data = InferResponseV2(messages=[to_wire(message) for message in new_messages])
+
+  if use_msgpack_output:
+    return Response(content=pack(output_data.model_dump(exclude_defaults=True)), media_type=MSGPACK_MEDIA_TYPE)
+  return Response(content=output_data.model_dump_json(exclude_defaults=True), media_type="application/json")
+
+
+@app.post("/summarize", response_model=SummarizeResponse)
+async def summarize(input_data: SummarizeRequest) -> SummarizeResponse:
+  # サマリ作成はツールを使わないので、エージェントを通さずにモデルを直接呼ぶ
+  messages = [from_wire(message) for message in input_data.messages]
+  # チャットの推論と取り合わないよう、admissionは通さずサマリ用の同時実行数だけで制限する
+  async with summarize_semaphore:
+    response = await model.ainvoke(messages)
+  return SummarizeResponse(summary=message_text(response))
+
+
+@app.post("/summarize/jobs", status_code=202)
+async def enqueue_summary_job(input_data: SummaryJobRequest) -> dict[str, Any]:
+  # サマリはバックグラウンドで作成してFirestoreに書き込むので、登録したらすぐに返す
+  key = f"{input_data.kind}/{input_data.teacher_name}/{input_data.user_name}"
+  coalesced = summary_queue.submit(key, input_data)
+  return {"key": key, "coalesced": coalesced}
+
+
+@app.get("/metrics")
+def get_metrics() -> Response:
+  return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/ready")
+def get_ready() -> Response:
+  # 全てのMCPサーバが起動済み(lazyを含む)でエージェントが作成されていればready
+  servers = {name: server.status() for name, server in mcp_servers.items()}
+  ready = session_agent is not None and all(s["state"] in ("ready", "lazy") for s in servers.values())
+  content = {"ready": ready, **startup_status, "servers": servers}
+  return Response(content=json.dumps(content), media_type="application/json", status_code=200 if ready else 503)
+
+
+def find_tool(name: str) -> BaseTool:
+  for tool in tools:
+    if tool.name == name:
+      return tool
+  raise HTTPException(status_code=404, detail=f"unknown tool: {name}")
+
+
+@app.post("/tools/call", response_model=WireMessage)
+async def call_tool(input_data: ToolCallRequest, request: Request) -> WireMessage:
+  # エージェントと同じツールを呼び出し、結果をToolMessageとして返す
+  # ツールの結果はキャッシュされるので、先読み済みであればすぐに返る
+  # 推論と同じく同時実行数とユーザごとの制限を受け、リクエストの期限で打ち切る
+  current_deadline.set(request_deadline(request))
+  tool = find_tool(input_data.name)
+  tool_call = {
+    "type": "tool_call",
+    "id": input_data.id or str(uuid.uuid4()),
+    "name": tool.name,
+    "args": input_data.args,
+  }
+  try:
+    async with admitted(request):
+      message = await tool.ainvoke(tool_call)
+  except ToolException as e:
+    raise HTTPException(status_code=502, detail=str(e))
+  except TimeoutError:
+    raise HTTPException(status_code=504, detail=f"{tool.name} did not finish before the deadline")
+  return to_wire(message)
+
+
+async def run_prefetch(tool: BaseTool, args: dict[str, Any]) -> None:
+  try:
+    await tool.ainvoke(args)
+  except Exception as e:
+    logger.warning(f"prefetch failed ({tool.name}): {e}")
+  finally:
+    prefetch_semaphore.release()
+
+
+@app.post("/tools/prefetch", status_code=202)
+async def prefetch_tool(input_data: ToolCallRequest, request: Request) -> dict[str, Any]:
+  # ツールをバックグラウンドで実行して結果をキャッシュに入れておく
+  # 推論のスロットやユーザごとの制限は使わず、先読み用の枠に空きが無ければ待たずに429を返す
+  # (実際のターンの枠を奪ったり、画面の読み込みを待たせたりしないようにする)
+  # リクエストの期限で打ち切る(期限はタスクに引き継がれる)
+  current_deadline.set(request_deadline(request))
+  tool = find_tool(input_data.name)
+  if prefetch_semaphore.locked():
+    raise AdmissionRejected(429, "prefetch_busy", 1.0)
+  await prefetch_semaphore.acquire()
+  task = asyncio.create_task(run_prefetch(tool, input_data.args))
+  prefetch_tasks.add(task)
+  task.add_done_callback(prefetch_tasks.discard)
+  return {"scheduled": True}
+
+
 @app.get("/tools")
 def get_tools() -> dict[str, str]:
   _tools = {tool.name: tool.description for tool in tools}
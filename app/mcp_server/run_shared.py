@@ -0,0 +1,104 @@
+# config.jsonのstdioのMCPサーバを、SSEで接続できる共有のプロセスとして1回だけ起動する
+# 推論サーバを複数のワーカーで動かしても、MCPサーバ(FAISSのインデックスなど)はワーカー数だけ増えない
+# appディレクトリで実行する:
+#   uv run python -m mcp_server.run_shared --output ./config/config.shared.json
+#   MCP_CONFIG_PATH=./config/config.shared.json uv run uvicorn llm_server:app --workers 4
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Any
+
+from server.mcp_servers import create_server_params
+
+STOP_TIMEOUT = 5
+
+
+def wait_for_port(host: str, port: int, process: subprocess.Popen, timeout: float) -> None:
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError(f"MCP server exited with code {process.returncode}")
+    try:
+      with socket.create_connection((host, port), timeout=1):
+        return
+    except OSError:
+      time.sleep(0.2)
+  raise RuntimeError(f"MCP server did not listen on {host}:{port} within {timeout}s")
+
+
+def start_shared_servers(
+  config_data: dict[str, Any], host: str, base_port: int, timeout: float
+) -> tuple[dict[str, Any], list[subprocess.Popen]]:
+  shared_config: dict[str, Any] = {"mcpServers": {}}
+  processes = []
+  for i, (server_name, server_info) in enumerate(config_data["mcpServers"].items()):
+    if "url" in server_info:
+      # 既に共有のサーバ
+      shared_config["mcpServers"][server_name] = server_info
+      continue
+
+    port = base_port + i
+    params = create_server_params(server_info)
+    env = {**os.environ, **params.env, "MCP_TRANSPORT": "sse", "FASTMCP_HOST": host, "FASTMCP_PORT": str(port)}
+    process = subprocess.Popen([params.command, *params.args], env=env)
+    processes.append(process)
+    wait_for_port(host, port, process, timeout)
+    print(f"{server_name}: http://{host}:{port}/sse (pid {process.pid})")
+
+    # プールやキャッシュなど、接続方法以外の設定はそのまま引き継ぐ
+    shared_info = {k: v for k, v in server_info.items() if k not in ("command", "args", "env")}
+    shared_info["url"] = f"http://{host}:{port}/sse"
+    shared_config["mcpServers"][server_name] = shared_info
+  return shared_config, processes
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--config", type=str, default="./config/config.json")
+  parser.add_argument("--output", type=str, default="./config/config.shared.json")
+  parser.add_argument("--host", type=str, default="127.0.0.1")
+  parser.add_argument("--base-port", type=int, default=8100)
+  parser.add_argument("--startup-timeout", type=float, default=120)
+  args = parser.parse_args()
+
+  with open(args.config) as f:
+    config_data = json.load(f)
+
+  # 推論サーバが古い設定を読まないように、全てのサーバが起動してから書き出す
+  if os.path.exists(args.output):
+    os.remove(args.output)
+  try:
+    shared_config, processes = start_shared_servers(config_data, args.host, args.base_port, args.startup_timeout)
+  except RuntimeError as e:
+    print(f"failed to start shared MCP servers: {e}", file=sys.stderr)
+    sys.exit(1)
+  with open(args.output, "w") as f:
+    json.dump(shared_config, f, indent=2, ensure_ascii=False)
+
+  def stop(signum: int, frame: Any) -> None:
+    for process in processes:
+      process.terminate()
+    for process in processes:
+      # SSEの接続が残っているとuvicornの終了が待ち続けるので、猶予を過ぎたら強制終了する
+      try:
+        process.wait(timeout=STOP_TIMEOUT)
+      except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    sys.exit(0)
+
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  # どれかのサーバが落ちたら全て止める(再起動は呼び出し側に任せる)
+  while all(process.poll() is None for process in processes):
+    time.sleep(1)
+  stop(signal.SIGTERM, None)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,3 +1,4 @@
+import os
 from dataclasses import dataclass
 from typing import Any
 
@@ -15,13 +16,20 @@ class SearchResult:
   similarity: float
 
 
-# FAISSをロード
-embeddings = GoogleGenerativeAIEmbeddings(model="models/gemini-embedding-exp-03-07")
-faiss_index = FAISS.load_local(
-  "vector_db/faiss_index",
-  embeddings,
-  allow_dangerous_deserialization=True,
-)
+faiss_index = None
+
+
+def get_faiss_index() -> FAISS:
+  # FAISSとembeddingのクライアントはサーバの起動(initialize)を遅らせないよう最初の検索時にロードする
+  global faiss_index
+  if faiss_index is None:
+    embeddings = GoogleGenerativeAIEmbeddings(model="models/gemini-embedding-exp-03-07")
+    faiss_index = FAISS.load_local(
+      "vector_db/faiss_index",
+      embeddings,
+      allow_dangerous_deserialization=True,
+    )
+  return faiss_index
 
 
 @mcp.tool()
@@ -43,7 +51,7 @@ async def video_search(search_query: str, result_num: int) -> list[Any]:
   top_ranks: list[SearchResult] = []
   # results = google_custom_search_dummy(search_query)
   # results = google_custom_search(search_query)
-  results = faiss_index.similarity_search_with_score(search_query, k=result_num)
+  results = get_faiss_index().similarity_search_with_score(search_query, k=result_num)
 
   for result, similarity in results:
     top_ranks.append(
@@ -60,4 +68,5 @@ if __name__ == "__main__":
   # import asyncio
   # result = asyncio.run(search("ダイエットのやり方", 3))
   # print(result)
-  mcp.run(transport="stdio")
+  # run_shared.pyから起動された場合はSSEで複数の推論サーバのワーカーから接続を受ける
+  mcp.run(transport=os.getenv("MCP_TRANSPORT", "stdio"))
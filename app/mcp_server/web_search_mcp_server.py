@@ -132,4 +132,5 @@ if __name__ == "__main__":
   # result = asyncio.run(get_url_contents("https://www.npr.org/sections/strange-news/"))
   # print(result)
   # asyncio.run(get_url_contents("https://www3.nhk.or.jp/news/catnew.html"))
-  mcp.run(transport="stdio")
+  # run_shared.pyから起動された場合はSSEで複数の推論サーバのワーカーから接続を受ける
+  mcp.run(transport=os.getenv("MCP_TRANSPORT", "stdio"))
@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# MCPサーバを共有プロセスとして1回だけ起動し、推論サーバの全ワーカーからSSEで接続する
+SHARED_CONFIG=./config/config.shared.json
+rm -f $SHARED_CONFIG
+uv run python -m mcp_server.run_shared --config ./config/config.json --output $SHARED_CONFIG &
+MCP_PID=$!
+trap "kill $MCP_PID" EXIT
+
+while [ ! -f $SHARED_CONFIG ]; do
+  if ! kill -0 $MCP_PID 2>/dev/null; then
+    exit 1
+  fi
+  sleep 0.5
+done
+
+MCP_CONFIG_PATH=$SHARED_CONFIG uv run uvicorn llm_server:app --host 0.0.0.0 --port $PORT --workers ${WORKERS:-4}
@@ -0,0 +1,170 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+
+from server.metrics import Counter, Gauge, Histogram
+
+admission_active = Gauge("habit_admission_active", "Inference requests currently running")
+admission_queue_length = Gauge("habit_admission_queue_length", "Inference requests waiting for a slot")
+admission_queue_wait = Histogram("habit_admission_queue_wait_seconds", "Time an inference request waited for a slot")
+admission_admitted_total = Counter("habit_admission_admitted_total", "Inference requests admitted")
+admission_rejected_total = Counter("habit_admission_rejected_total", "Inference requests rejected", ("reason",))
+
+
+class AdmissionRejected(Exception):
+  def __init__(self, status_code: int, reason: str, retry_after: float):
+    super().__init__(reason)
+    self.status_code = status_code
+    self.reason = reason
+    self.retry_after = retry_after
+
+  @property
+  def retry_after_header(self) -> str:
+    return str(max(1, math.ceil(self.retry_after)))
+
+
+# ユーザごとのリクエスト数の制限
+# rate(1秒あたり)でトークンが貯まり、burst個まで連続でリクエストできる
+class TokenBucket:
+  def __init__(self, rate: float, burst: float):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated_at = time.monotonic()
+
+  def take(self) -> float:
+    # トークンを1つ使えれば0を、使えなければ次のトークンが貯まるまでの秒数を返す
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+    self.updated_at = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0.0
+    return (1 - self.tokens) / self.rate
+
+  def is_full(self, now: float) -> bool:
+    # 満タンのバケツは新しく作ったものと同じなので、捨ててもよい
+    return self.tokens + (now - self.updated_at) * self.rate >= self.burst
+
+
+# 推論リクエストの同時実行数の制限
+# 空きが無いときはユーザごとのキューに並べ、空いたスロットはユーザを順番に回して割り当てる
+# (1人のユーザが大量にリクエストしても他のユーザの待ち時間が伸びないようにする)
+class AdmissionController:
+  def __init__(
+    self,
+    max_concurrency: int,
+    max_queue: int,
+    queue_timeout: float,
+    user_rate: float,
+    user_burst: float,
+    max_buckets: int = 10000,
+  ):
+    self.max_concurrency = max_concurrency
+    self.max_queue = max_queue
+    self.queue_timeout = queue_timeout
+    self.user_rate = user_rate
+    self.user_burst = user_burst
+    self.max_buckets = max_buckets
+    self.active = 0
+    self.waiters: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+    # 最後にリクエストした順. 満タンに戻ったものから捨て、X-User-Nameを使い捨てにされても増え続けないようにする
+    self.buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+    # Retry-Afterの見積もりに使う、1リクエストの処理時間の移動平均
+    self.average_seconds = 5.0
+
+  @property
+  def queued(self) -> int:
+    return sum(len(waiters) for waiters in self.waiters.values())
+
+  def _estimate_wait(self) -> float:
+    return self.average_seconds * (self.queued + 1) / self.max_concurrency
+
+  def _reject(self, status_code: int, reason: str, retry_after: float) -> AdmissionRejected:
+    admission_rejected_total.inc(reason=reason)
+    return AdmissionRejected(status_code, reason, retry_after)
+
+  def _update_gauges(self) -> None:
+    admission_active.set(self.active)
+    admission_queue_length.set(self.queued)
+
+  def _remove_waiter(self, user: str, future: asyncio.Future) -> None:
+    waiters = self.waiters.get(user)
+    if waiters is None:
+      return
+    try:
+      waiters.remove(future)
+    except ValueError:
+      pass
+    if not waiters:
+      del self.waiters[user]
+    self._update_gauges()
+
+  def _bucket(self, user: str) -> TokenBucket:
+    bucket = self.buckets.get(user)
+    if bucket is None:
+      bucket = self.buckets[user] = TokenBucket(self.user_rate, self.user_burst)
+    self.buckets.move_to_end(user)
+    # 古い方から満タンのものを捨てる. 上限を超えている場合は満タンでなくても捨てる
+    now = time.monotonic()
+    while len(self.buckets) > 1:
+      oldest_user, oldest = next(iter(self.buckets.items()))
+      if not oldest.is_full(now) and len(self.buckets) <= self.max_buckets:
+        break
+      del self.buckets[oldest_user]
+    return bucket
+
+  async def acquire(self, user: str) -> float:
+    # 実行を開始した時刻を返す. 終わったらrelease()に渡す
+    bucket = self._bucket(user)
+    wait = bucket.take()
+    if wait > 0:
+      raise self._reject(429, "rate_limited", wait)
+
+    enqueued_at = time.monotonic()
+    if self.active < self.max_concurrency and not self.waiters:
+      self.active += 1
+    else:
+      if self.queued >= self.max_queue:
+        raise self._reject(503, "queue_full", self._estimate_wait())
+
+      future = asyncio.get_running_loop().create_future()
+      self.waiters.setdefault(user, deque()).append(future)
+      self._update_gauges()
+      try:
+        await asyncio.wait_for(future, timeout=self.queue_timeout)
+      except asyncio.TimeoutError:
+        self._remove_waiter(user, future)
+        raise self._reject(503, "queue_timeout", self._estimate_wait())
+      except asyncio.CancelledError:
+        # 待っている間にクライアントが切断した. スロットが割り当て済みなら返す
+        if future.done() and not future.cancelled():
+          self.release(time.monotonic())
+        else:
+          self._remove_waiter(user, future)
+        raise
+
+    admitted_at = time.monotonic()
+    admission_queue_wait.observe(admitted_at - enqueued_at)
+    admission_admitted_total.inc()
+    self._update_gauges()
+    return admitted_at
+
+  def release(self, admitted_at: float) -> None:
+    self.average_seconds = 0.9 * self.average_seconds + 0.1 * (time.monotonic() - admitted_at)
+    self.active -= 1
+    while self.waiters:
+      # 先頭のユーザの一番古いリクエストにスロットを渡し、そのユーザを最後尾に回す
+      user, waiters = next(iter(self.waiters.items()))
+      future = waiters.popleft()
+      if waiters:
+        self.waiters.move_to_end(user)
+      else:
+        del self.waiters[user]
+      if future.done():
+        continue
+      self.active += 1
+      future.set_result(None)
+      break
+    self._update_gauges()
@@ -0,0 +1,19 @@
+import asyncio
+from contextvars import ContextVar
+
+from server.metrics import Counter
+
+# リクエストの期限(イベントループの時刻)
+# エージェントの実行とMCPのツール呼び出しは、この期限までの残り時間で打ち切る
+current_deadline: ContextVar[float | None] = ContextVar("current_deadline", default=None)
+
+agent_runs_cancelled_total = Counter(
+  "habit_agent_runs_cancelled_total", "Agent runs stopped before completion", ("reason",)
+)
+
+
+def remaining() -> float | None:
+  deadline = current_deadline.get()
+  if deadline is None:
+    return None
+  return max(0.0, deadline - asyncio.get_running_loop().time())
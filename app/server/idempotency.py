@@ -0,0 +1,160 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable
+
+from server.deadline import agent_runs_cancelled_total
+from server.metrics import Counter, Gauge
+
+idempotency_requests_total = Counter(
+  "habit_idempotency_requests_total", "Requests with an Idempotency-Key", ("endpoint", "result")
+)
+idempotency_entries = Gauge("habit_idempotency_entries", "In-flight and completed executions kept for Idempotency-Key")
+
+# 実行中のタスク(途中で破棄されないように参照を持っておく)
+running_tasks: set[asyncio.Task] = set()
+
+
+class IdempotencyKeyMismatch(Exception):
+  pass
+
+
+# 1回の推論の実行
+# 結果(ストリーミングならイベント、それ以外は1つのレスポンス)を順に貯め、待っているリクエストに最初から再生する
+# 待っているリクエストが全て切断した場合は、完了前でも実行をキャンセルする
+class Execution:
+  def __init__(self, fingerprint: str = ""):
+    self.fingerprint = fingerprint
+    self.items: list[Any] = []
+    self.done = False
+    self.failed = False
+    self.error: Exception | None = None
+    self.expires_at = float("inf")
+    self.subscribers = 0
+    # 全てのリクエストが切断してキャンセルした. タスクが終わるまでの間に届いた再送は新しく実行する
+    self.cancelled = False
+    self.task: asyncio.Task | None = None
+    self._changed = asyncio.Event()
+
+  def _notify(self) -> None:
+    self._changed.set()
+    self._changed = asyncio.Event()
+
+  def start(
+    self,
+    items: AsyncIterator[Any],
+    failed: Callable[[Any], bool] | None = None,
+    on_done: Callable[[], None] | None = None,
+  ) -> None:
+    async def consume() -> None:
+      try:
+        async for item in items:
+          self.items.append(item)
+          if failed is not None and failed(item):
+            self.failed = True
+          self._notify()
+      except asyncio.CancelledError:
+        self.error = RuntimeError("execution was cancelled")
+        self.failed = True
+        raise
+      except Exception as e:
+        self.error = e
+        self.failed = True
+      finally:
+        self.done = True
+        if on_done is not None:
+          on_done()
+        self._notify()
+
+    self.task = asyncio.create_task(consume())
+    running_tasks.add(self.task)
+    self.task.add_done_callback(running_tasks.discard)
+
+  def subscribe(self) -> None:
+    self.subscribers += 1
+
+  def unsubscribe(self) -> None:
+    self.subscribers -= 1
+    if self.subscribers == 0 and not self.done and self.task is not None:
+      agent_runs_cancelled_total.inc(reason="disconnect")
+      self.cancelled = True
+      self.task.cancel()
+
+  async def first(self) -> None:
+    # 最初の結果が届くか、何も返さずに終わるまで待つ
+    # 結果を返す前の失敗(混雑やセッションが無いなど)はここで例外になり、ステータスコードとして返せる
+    while not self.items and not self.done:
+      await self._changed.wait()
+    if not self.items and self.error is not None:
+      raise self.error
+
+  async def replay(self) -> AsyncIterator[Any]:
+    # subscribeしたリクエストの購読を引き継ぎ、最後まで送るか切断されたら購読をやめる
+    index = 0
+    try:
+      while True:
+        while index < len(self.items):
+          yield self.items[index]
+          index += 1
+        if self.done:
+          break
+        await self._changed.wait()
+    finally:
+      self.unsubscribe()
+    if self.error is not None:
+      raise self.error
+
+
+# 同じIdempotency-Keyのリクエストを1回の実行にまとめる
+# 実行中に届いた重複はその実行の結果を待ち、完了後もttl秒は結果を再利用する. 失敗した実行は再利用しない
+class IdempotencyStore:
+  def __init__(self, ttl: float, max_entries: int):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.entries: OrderedDict[str, Execution] = OrderedDict()
+
+  def begin(self, key: str, fingerprint: str, endpoint: str) -> tuple[Execution, bool]:
+    # 新しく実行する場合は(execution, True)を返す. 呼び出し側はrunで実行を始める
+    execution = self.entries.get(key)
+    if execution is not None and (execution.cancelled or execution.expires_at < time.monotonic()):
+      del self.entries[key]
+      execution = None
+
+    if execution is not None:
+      if execution.fingerprint != fingerprint:
+        idempotency_requests_total.inc(endpoint=endpoint, result="mismatch")
+        raise IdempotencyKeyMismatch("Idempotency-Key was reused with a different request")
+      idempotency_requests_total.inc(endpoint=endpoint, result="completed" if execution.done else "in_flight")
+      return execution, False
+
+    idempotency_requests_total.inc(endpoint=endpoint, result="miss")
+    execution = Execution(fingerprint)
+    self.entries[key] = execution
+    self._evict()
+    return execution, True
+
+  def run(
+    self,
+    key: str,
+    execution: Execution,
+    items: AsyncIterator[Any],
+    failed: Callable[[Any], bool] | None = None,
+  ) -> None:
+    def finished() -> None:
+      if execution.failed:
+        if self.entries.get(key) is execution:
+          del self.entries[key]
+      else:
+        execution.expires_at = time.monotonic() + self.ttl
+      idempotency_entries.set(len(self.entries))
+
+    execution.start(items, failed, finished)
+
+  def _evict(self) -> None:
+    # 古い完了済みのものから消す. 実行中のものは消さない
+    if len(self.entries) > self.max_entries:
+      for key in [key for key, execution in self.entries.items() if execution.done]:
+        if len(self.entries) <= self.max_entries:
+          break
+        del self.entries[key]
+    idempotency_entries.set(len(self.entries))
@@ -0,0 +1,329 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any
+
+from langchain_core.tools import BaseTool
+from langchain_mcp_adapters.resources import load_mcp_resources
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.sse import sse_client
+from mcp.client.stdio import stdio_client
+from mcp.types import CallToolResult
+from mcp.types import Tool as MCPTool
+from server.deadline import remaining
+from server.metrics import Counter, Gauge, Histogram
+from server.telemetry import record_tool_call
+from server.tool_cache import ToolCache
+
+DEFAULT_STARTUP_TIMEOUT = float(os.getenv("MCP_STARTUP_TIMEOUT", "60"))
+DEFAULT_POOL_SIZE = int(os.getenv("MCP_POOL_SIZE", "1"))
+DEFAULT_MAX_CALLS_PER_SESSION = int(os.getenv("MCP_MAX_CALLS_PER_SESSION", "1"))
+HEALTH_CHECK_INTERVAL = float(os.getenv("MCP_HEALTH_CHECK_INTERVAL", "30"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("MCP_HEALTH_CHECK_TIMEOUT", "5"))
+DEFAULT_TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", "3600"))
+
+mcp_tool_calls_total = Counter("habit_mcp_tool_calls_total", "MCP tool calls", ("server", "result"))
+mcp_in_flight = Gauge("habit_mcp_tool_calls_in_flight", "MCP tool calls currently running", ("server",))
+mcp_queue_wait = Histogram(
+  "habit_mcp_tool_queue_wait_seconds", "Time a tool call waited for a free MCP session", ("server",)
+)
+mcp_sessions_ready = Gauge("habit_mcp_sessions_ready", "MCP sessions that are connected", ("server",))
+mcp_respawns_total = Counter("habit_mcp_session_respawns_total", "MCP sessions restarted after a failure", ("server",))
+
+
+def create_server_params(server_info: dict[str, Any]) -> StdioServerParameters:
+  if "env" in server_info:
+    env = {k: os.environ[v] for k, v in server_info["env"].items()}
+  else:
+    env = {}
+
+  is_docker = os.path.exists("/DOCKER")
+  command = "uv" if is_docker else server_info["command"]
+  return StdioServerParameters(command=command, args=server_info["args"], env=env)
+
+
+# 1つのMCPサーバとの接続
+# config.jsonに"url"があればSSEで共有のサーバプロセスに接続し、無ければサブプロセスを起動してstdioで接続する
+# anyioのキャンセルスコープの制約があるため、接続の開始から終了までを専用のタスクの中で行う
+class McpConnection:
+  def __init__(self, server_info: dict[str, Any]):
+    self.server_info = server_info
+    self.session: ClientSession | None = None
+    self.mcp_tools: list[MCPTool] = []
+    self.resources: list[Any] = []
+    self.in_flight = 0
+    self.error = ""
+    self._ready = asyncio.Event()
+    self._closed = asyncio.Event()
+    self._task: asyncio.Task | None = None
+
+  @property
+  def alive(self) -> bool:
+    return self.session is not None and self._task is not None and not self._task.done()
+
+  async def _run(self) -> None:
+    try:
+      if "url" in self.server_info:
+        transport = sse_client(self.server_info["url"], headers=self.server_info.get("headers"))
+      else:
+        transport = stdio_client(create_server_params(self.server_info))
+      async with transport as (read_stream, write_stream):
+        async with ClientSession(read_stream, write_stream) as session:
+          await session.initialize()
+          self.mcp_tools = (await session.list_tools()).tools
+          self.resources = await load_mcp_resources(session)
+          self.session = session
+          self._ready.set()
+          await self._closed.wait()
+    except Exception as e:
+      self.error = f"{e.__class__.__name__}: {e}"
+    finally:
+      self.session = None
+      self._ready.set()
+
+  async def start(self, timeout: float) -> None:
+    self.error = ""
+    self._ready.clear()
+    self._closed.clear()
+    self._task = asyncio.create_task(self._run())
+    try:
+      await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+      self.error = f"startup timed out after {timeout}s"
+      await self.stop()
+
+  async def stop(self) -> None:
+    self._closed.set()
+    if self._task is not None:
+      self._task.cancel()
+      await asyncio.gather(self._task, return_exceptions=True)
+      self._task = None
+    self.session = None
+
+  async def ping(self, timeout: float) -> bool:
+    if not self.alive:
+      return False
+    try:
+      await asyncio.wait_for(self.session.send_ping(), timeout=timeout)
+      return True
+    except Exception:
+      return False
+
+
+# 1つのMCPサーバ
+# 同じサーバのサブプロセスをpoolSize個起動し、ツール呼び出しは実行中の呼び出しが最も少ない接続に割り当てる
+class McpServer:
+  def __init__(self, name: str, server_info: dict[str, Any], tool_cache: ToolCache | None = None):
+    self.name = name
+    self.server_info = server_info
+    self.tool_cache = tool_cache
+    self.timeout = float(server_info.get("startupTimeout", DEFAULT_STARTUP_TIMEOUT))
+    self.pool_size = int(server_info.get("poolSize", DEFAULT_POOL_SIZE))
+    # 1つの接続で同時に実行するツール呼び出しの数. これを超えた呼び出しは空きが出るまで待つ
+    self.max_calls_per_session = int(server_info.get("maxCallsPerSession", DEFAULT_MAX_CALLS_PER_SESSION))
+    self.connections = [McpConnection(server_info) for _ in range(self.pool_size)]
+    self.mcp_tools: list[MCPTool] = []
+    self.resources: list[Any] = []
+    # pending -> (lazy) -> starting -> ready / failed / stopped
+    self.state = "pending"
+    self.error = ""
+    self.startup_seconds: float | None = None
+    self._start_lock = asyncio.Lock()
+    self._slots = asyncio.Semaphore(self.pool_size * self.max_calls_per_session)
+    self._respawn_locks = [asyncio.Lock() for _ in self.connections]
+    self._health_task: asyncio.Task | None = None
+    # ツール呼び出しの失敗で始めた作り直し(タスクが途中で破棄されないように参照を持っておく)
+    self._respawn_tasks: set[asyncio.Task] = set()
+
+  async def start(self) -> None:
+    async with self._start_lock:
+      if self.state == "ready":
+        return
+      self.state = "starting"
+      started_at = time.monotonic()
+      # プールの接続を並列に起動し、1つでも起動できればready
+      await asyncio.gather(*(connection.start(self.timeout) for connection in self.connections))
+      self.startup_seconds = time.monotonic() - started_at
+      alive = [connection for connection in self.connections if connection.alive]
+      self.error = next((connection.error for connection in self.connections if connection.error), "")
+      mcp_sessions_ready.set(len(alive), server=self.name)
+      if not alive:
+        self.state = "failed"
+        return
+      self.mcp_tools = alive[0].mcp_tools
+      self.resources = alive[0].resources
+      self.state = "ready"
+      self._health_task = asyncio.create_task(self._health_loop())
+
+  async def stop(self) -> None:
+    if self._health_task is not None:
+      self._health_task.cancel()
+      await asyncio.gather(self._health_task, return_exceptions=True)
+      self._health_task = None
+    for task in self._respawn_tasks:
+      task.cancel()
+    await asyncio.gather(*self._respawn_tasks, return_exceptions=True)
+    await asyncio.gather(*(connection.stop() for connection in self.connections))
+    mcp_sessions_ready.set(0, server=self.name)
+    if self.state == "ready":
+      self.state = "stopped"
+
+  async def _respawn(self, index: int) -> None:
+    async with self._respawn_locks[index]:
+      connection = self.connections[index]
+      if connection.alive and await connection.ping(HEALTH_CHECK_TIMEOUT):
+        return
+      print(f"[mcp]: respawning {self.name} session {index}: {connection.error or 'health check failed'}")
+      mcp_respawns_total.inc(server=self.name)
+      await connection.stop()
+      await connection.start(self.timeout)
+      mcp_sessions_ready.set(sum(c.alive for c in self.connections), server=self.name)
+
+  def _start_respawn(self, index: int) -> None:
+    task = asyncio.create_task(self._respawn(index))
+    self._respawn_tasks.add(task)
+    task.add_done_callback(self._respawn_done)
+
+  def _respawn_done(self, task: asyncio.Task) -> None:
+    self._respawn_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+      print(f"[mcp]: failed to respawn {self.name} session: {task.exception()}")
+
+  async def _health_loop(self) -> None:
+    # 死んでいる接続やpingに応答しない接続を作り直す
+    while True:
+      await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+      results = await asyncio.gather(*(connection.ping(HEALTH_CHECK_TIMEOUT) for connection in self.connections))
+      for index, healthy in enumerate(results):
+        if not healthy:
+          await self._respawn(index)
+
+  async def _select_connection(self) -> int:
+    alive = [i for i, connection in enumerate(self.connections) if connection.alive]
+    if not alive:
+      # 全ての接続が死んでいる場合はヘルスチェックを待たずに作り直す
+      await self._respawn(0)
+      alive = [0] if self.connections[0].alive else []
+    if not alive:
+      raise RuntimeError(f"MCP server {self.name} is not available: {self.connections[0].error}")
+    return min(alive, key=lambda i: self.connections[i].in_flight)
+
+  def _tool_cache_config(self, tool: str) -> dict[str, Any] | None:
+    # config.jsonの"toolCache"で設定する. falseならこのサーバのツールはキャッシュしない
+    # {"ttl": 3600, "tools": {"get_url_contents": {"ttl": 86400}, "video_search": {"textArgs": ["search_query"]},
+    #  "some_tool": {"enabled": false}}}
+    cache_config = self.server_info.get("toolCache", {})
+    if self.tool_cache is None or cache_config is False:
+      return None
+    tool_config = cache_config.get("tools", {}).get(tool, {})
+    if tool_config.get("enabled", True) is False:
+      return None
+    return {"ttl": cache_config.get("ttl", DEFAULT_TOOL_CACHE_TTL), **tool_config}
+
+  async def call_tool(self, name: str, arguments: dict[str, Any]) -> CallToolResult:
+    tool_config = self._tool_cache_config(name)
+    ttl = 0.0 if tool_config is None else float(tool_config["ttl"])
+    if ttl > 0:
+      # textArgsに書いた自由文の引数だけ、全角/半角や空白の違いを無視してキャッシュを引く
+      text_args = tool_config.get("textArgs", ())
+      return await self.tool_cache.get_or_call(
+        name, arguments, ttl, lambda: self._call_tool(name, arguments), text_args
+      )
+    return await self._call_tool(name, arguments)
+
+  async def _call_tool(self, name: str, arguments: dict[str, Any]) -> CallToolResult:
+    # lazyモードでは最初のツール呼び出し時にサーバを起動する
+    if self.state != "ready":
+      await self.start()
+    if self.state != "ready":
+      raise RuntimeError(f"MCP server {self.name} is not available: {self.error}")
+
+    enqueued_at = time.monotonic()
+    # 空きを待つ時間もリクエストの期限までにする
+    try:
+      async with asyncio.timeout(remaining()):
+        await self._slots.acquire()
+    except TimeoutError:
+      mcp_tool_calls_total.inc(server=self.name, result="deadline")
+      raise
+    try:
+      mcp_queue_wait.observe(time.monotonic() - enqueued_at, server=self.name)
+      index = await self._select_connection()
+      connection = self.connections[index]
+      connection.in_flight += 1
+      mcp_in_flight.inc(server=self.name)
+      started_at = time.monotonic()
+      try:
+        # リクエストの期限までの残り時間で打ち切る
+        # mcp 1.6.0のサーバはnotifications/cancelledを受け取ると落ちるので、打ち切った呼び出しの結果は捨てるだけにする
+        async with asyncio.timeout(remaining()):
+          result = await connection.session.call_tool(name, arguments)
+        mcp_tool_calls_total.inc(server=self.name, result="error" if result.isError else "success")
+        return result
+      except TimeoutError:
+        mcp_tool_calls_total.inc(server=self.name, result="deadline")
+        raise
+      except asyncio.CancelledError:
+        mcp_tool_calls_total.inc(server=self.name, result="cancelled")
+        raise
+      except Exception:
+        mcp_tool_calls_total.inc(server=self.name, result="exception")
+        if not connection.alive:
+          self._start_respawn(index)
+        raise
+      finally:
+        record_tool_call(name, time.monotonic() - started_at)
+        connection.in_flight -= 1
+        mcp_in_flight.dec(server=self.name)
+    finally:
+      self._slots.release()
+
+  def create_tools(self) -> list[BaseTool]:
+    # langchainのツールからの呼び出しはcall_toolを経由させる
+    return [convert_mcp_tool_to_langchain_tool(self, tool) for tool in self.mcp_tools]
+
+  def status(self) -> dict[str, Any]:
+    return {
+      "state": self.state,
+      "startup_seconds": self.startup_seconds,
+      "error": self.error,
+      "tools": [tool.name for tool in self.mcp_tools],
+      "pool_size": self.pool_size,
+      "sessions_ready": sum(connection.alive for connection in self.connections),
+      "in_flight": [connection.in_flight for connection in self.connections],
+    }
+
+
+def load_manifest(manifest_path: str) -> dict[str, Any]:
+  if not os.path.exists(manifest_path):
+    return {}
+  with open(manifest_path) as f:
+    return json.load(f)
+
+
+def save_manifest(manifest_path: str, servers: dict[str, McpServer]) -> None:
+  manifest = load_manifest(manifest_path)
+  for name, server in servers.items():
+    if server.state == "ready":
+      manifest[name] = {"tools": [tool.model_dump(exclude_none=True) for tool in server.mcp_tools]}
+  with open(manifest_path, "w") as f:
+    json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+
+async def start_mcp_servers(servers: dict[str, McpServer], lazy: bool, manifest_path: str) -> None:
+  # lazyモードではマニフェストにツール定義があるサーバは起動せず、最初のツール呼び出しまで遅らせる
+  manifest = load_manifest(manifest_path) if lazy else {}
+  eager_servers = {}
+  for name, server in servers.items():
+    if name in manifest:
+      server.mcp_tools = [MCPTool.model_validate(tool) for tool in manifest[name]["tools"]]
+      server.state = "lazy"
+    else:
+      eager_servers[name] = server
+
+  # 各サーバを並列に起動する
+  await asyncio.gather(*(server.start() for server in eager_servers.values()))
+  if eager_servers:
+    save_manifest(manifest_path, eager_servers)
@@ -0,0 +1,114 @@
+import math
+
+# Prometheusのテキスト形式で出力できる最小限のメトリクス
+# 外部ライブラリは使わず、このモジュールで定義したメトリクスを/metricsで返す
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry: list["_Metric"] = []
+
+
+def _format_labels(labelnames: tuple[str, ...], labelvalues: tuple[str, ...], extra: str = "") -> str:
+  pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+  if extra:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+  if math.isinf(value):
+    return "+Inf"
+  return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+  type_name = ""
+
+  def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    _registry.append(self)
+
+  def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+  def samples(self) -> list[str]:
+    raise NotImplementedError
+
+  def render(self) -> str:
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+    lines.extend(self.samples())
+    return "\n".join(lines)
+
+
+class Counter(_Metric):
+  type_name = "counter"
+
+  def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+    super().__init__(name, documentation, labelnames)
+    self.values: dict[tuple[str, ...], float] = {}
+
+  def inc(self, amount: float = 1, **labels: str) -> None:
+    key = self._key(labels)
+    self.values[key] = self.values.get(key, 0) + amount
+
+  def get(self, **labels: str) -> float:
+    return self.values.get(self._key(labels), 0)
+
+  def samples(self) -> list[str]:
+    return [
+      f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in self.values.items()
+    ]
+
+
+class Gauge(Counter):
+  type_name = "gauge"
+
+  def set(self, value: float, **labels: str) -> None:
+    self.values[self._key(labels)] = value
+
+  def dec(self, amount: float = 1, **labels: str) -> None:
+    self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+  type_name = "histogram"
+
+  def __init__(
+    self,
+    name: str,
+    documentation: str,
+    labelnames: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+  ):
+    super().__init__(name, documentation, labelnames)
+    self.buckets = tuple(sorted(buckets)) + (math.inf,)
+    self.counts: dict[tuple[str, ...], list[int]] = {}
+    self.sums: dict[tuple[str, ...], float] = {}
+
+  def observe(self, value: float, **labels: str) -> None:
+    key = self._key(labels)
+    counts = self.counts.setdefault(key, [0] * len(self.buckets))
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        counts[i] += 1
+    self.sums[key] = self.sums.get(key, 0) + value
+
+  def count(self, **labels: str) -> int:
+    counts = self.counts.get(self._key(labels))
+    return counts[-1] if counts else 0
+
+  def samples(self) -> list[str]:
+    lines = []
+    for key, counts in self.counts.items():
+      for bound, count in zip(self.buckets, counts):
+        le = f'le="{_format_value(bound)}"'
+        lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+      lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(self.sums[key])}")
+      lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}")
+    return lines
+
+
+def render() -> str:
+  return "\n".join(metric.render() for metric in _registry) + "\n"
@@ -0,0 +1,45 @@
+import hashlib
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+# 前回のサマリとそれ以降のメッセージだけからサマリを更新する
+# 会話が長くなってもプロンプトの長さ(コスト)がほぼ一定になる
+
+
+def prompt_hash(system_prompt: str) -> str:
+  return hashlib.sha256(system_prompt.encode()).hexdigest()
+
+
+def select_new_messages(messages: list[BaseMessage], watermark: str) -> list[BaseMessage]:
+  # watermark(サマリに反映済みの最後のメッセージID)より後ろのメッセージを返す
+  # 見つからない場合は、初回か履歴の上限で古いメッセージが消えた後なので全て未反映とみなす
+  if watermark:
+    for i in range(len(messages) - 1, -1, -1):
+      if messages[i].id == watermark:
+        return messages[i + 1 :]
+  return messages
+
+
+def build_summary_prompt(
+  system_prompt: str,
+  heading: str,
+  previous_summary: str,
+  new_messages: list[BaseMessage],
+) -> list[BaseMessage]:
+  contents = [message.content for message in new_messages]
+  if previous_summary:
+    user_prompt = f"""
+  ### これまでのサマリ
+  {previous_summary}
+
+  ### {heading}(これまでのサマリ以降)
+  {contents}
+
+  これまでのサマリに新しい内容を反映して、サマリ全体を作り直してください。
+  """
+  else:
+    user_prompt = f"""
+  ### {heading}
+  {contents}
+  """
+  return [SystemMessage(content=system_prompt), HumanMessage(content=user_prompt)]
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Any, Callable
+
+
+# セッションIDごとに会話の世代とシステムプロンプトを保存する
+# 会話履歴そのものはLangGraphのcheckpointerがthread_id単位で保存する
+# sqliteへのアクセスはイベントループを止めないよう別スレッドで行い、ロックで1つずつ実行する
+class ConversationStore:
+  def __init__(self, db_path: str):
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(db_path, check_same_thread=False)
+    self.conn.execute(
+      """
+      CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 0,
+        system_prompt TEXT,
+        prompt_hash TEXT,
+        updated_at REAL
+      )
+      """
+    )
+    self.conn.commit()
+
+  async def _run(self, query: Callable[[], Any]) -> Any:
+    def locked() -> Any:
+      with self.lock:
+        return query()
+
+    return await asyncio.to_thread(locked)
+
+  def _get(self, session_id: str) -> tuple[int, str | None] | None:
+    row = self.conn.execute(
+      "SELECT generation, system_prompt FROM sessions WHERE session_id = ?", (session_id,)
+    ).fetchone()
+    return row
+
+  def _thread_id(self, session_id: str) -> str:
+    # 会話をリセットすると世代が進み、別のthread_idとして扱われる
+    row = self._get(session_id)
+    generation = row[0] if row else 0
+    return f"{session_id}:{generation}"
+
+  async def thread_id(self, session_id: str) -> str:
+    def query() -> str:
+      # 使われているセッションは期限切れで消されないよう、最後に使った時刻を更新する
+      self.conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (time.time(), session_id))
+      self.conn.commit()
+      return self._thread_id(session_id)
+
+    return await self._run(query)
+
+  async def system_prompt(self, session_id: str) -> str | None:
+    row = await self._run(lambda: self._get(session_id))
+    return row[1] if row else None
+
+  async def update_system_prompt(self, session_id: str, system_prompt: str) -> None:
+    prompt_hash = hashlib.sha256(system_prompt.encode()).hexdigest()
+
+    def query() -> None:
+      self.conn.execute(
+        """
+        INSERT INTO sessions (session_id, generation, system_prompt, prompt_hash, updated_at)
+        VALUES (?, 0, ?, ?, ?)
+        ON CONFLICT(session_id) DO UPDATE SET
+          system_prompt = excluded.system_prompt, prompt_hash = excluded.prompt_hash, updated_at = excluded.updated_at
+        """,
+        (session_id, system_prompt, prompt_hash, time.time()),
+      )
+      self.conn.commit()
+
+    await self._run(query)
+
+  async def reset(self, session_id: str) -> tuple[str | None, str]:
+    # 前の世代のthread_id(無ければNone)と新しい世代のthread_idを返す
+    # 前の世代の会話はもう使われないので、呼び出し側でcheckpointerから消す
+    def query() -> tuple[str | None, str]:
+      previous = self._thread_id(session_id) if self._get(session_id) else None
+      self.conn.execute(
+        """
+        INSERT INTO sessions (session_id, generation, updated_at) VALUES (?, 0, ?)
+        ON CONFLICT(session_id) DO UPDATE SET generation = generation + 1, updated_at = excluded.updated_at
+        """,
+        (session_id, time.time()),
+      )
+      self.conn.commit()
+      return previous, self._thread_id(session_id)
+
+    return await self._run(query)
+
+  async def expire(self, ttl: float) -> list[str]:
+    # ttl秒使われていないセッションを消し、その会話のthread_idを返す
+    def query() -> list[str]:
+      cutoff = time.time() - ttl
+      rows = self.conn.execute(
+        "SELECT session_id, generation FROM sessions WHERE updated_at IS NULL OR updated_at < ?", (cutoff,)
+      ).fetchall()
+      self.conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(session_id,) for session_id, _ in rows])
+      self.conn.commit()
+      return [f"{session_id}:{generation}" for session_id, generation in rows]
+
+    return await self._run(query)
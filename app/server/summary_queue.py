@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from server.metrics import Counter, Gauge, Histogram
+
+summary_queue_depth = Gauge("habit_summary_queue_depth", "Number of summary jobs waiting to run")
+summary_jobs_total = Counter("habit_summary_jobs_total", "Finished summary jobs", ("result",))
+summary_coalesced_total = Counter("habit_summary_coalesced_total", "Summary requests merged into a pending job")
+summary_job_latency = Histogram("habit_summary_job_latency_seconds", "Time from first enqueue until the job finished")
+summary_job_duration = Histogram("habit_summary_job_duration_seconds", "Time spent running a summary job")
+
+logger = logging.getLogger("habit.infer_server")
+
+
+@dataclass
+class SummaryJob:
+  key: str
+  payload: Any
+  enqueued_at: float
+  coalesced: int = 0
+
+
+# サマリ作成ジョブのキュー
+# 同じキー(生徒)のジョブが実行待ちの間に届いた依頼は、最新の内容に置き換えて1回の実行にまとめる
+class SummaryQueue:
+  def __init__(self, run_job: Callable[[Any], Awaitable[None]]):
+    self.run_job = run_job
+    self.pending: dict[str, SummaryJob] = {}
+    self.keys: asyncio.Queue[str] = asyncio.Queue()
+    # 同じキーのジョブが並列に実行されて書き込み順が入れ替わらないようにする
+    self.locks: dict[str, asyncio.Lock] = {}
+    self.workers: list[asyncio.Task] = []
+
+  def submit(self, key: str, payload: Any) -> bool:
+    job = self.pending.get(key)
+    if job is not None:
+      job.payload = payload
+      job.coalesced += 1
+      summary_coalesced_total.inc()
+      return True
+
+    self.pending[key] = SummaryJob(key=key, payload=payload, enqueued_at=time.monotonic())
+    self.keys.put_nowait(key)
+    summary_queue_depth.set(len(self.pending))
+    return False
+
+  def start(self, num_workers: int) -> None:
+    for _ in range(num_workers):
+      self.workers.append(asyncio.create_task(self._worker()))
+
+  async def stop(self) -> None:
+    for worker in self.workers:
+      worker.cancel()
+    await asyncio.gather(*self.workers, return_exceptions=True)
+    self.workers = []
+
+  async def _worker(self) -> None:
+    while True:
+      key = await self.keys.get()
+      lock = self.locks.setdefault(key, asyncio.Lock())
+      async with lock:
+        await self._run(key)
+      # 同じキーの依頼が残っていなければロックを消す
+      # (ロックを待っているワーカーがいる間は、そのワーカーが取り出す依頼がpendingに残っている)
+      if key not in self.pending and self.locks.get(key) is lock:
+        del self.locks[key]
+
+  async def _run(self, key: str) -> None:
+    job = self.pending.pop(key, None)
+    summary_queue_depth.set(len(self.pending))
+    if job is None:
+      return
+
+    started_at = time.monotonic()
+    try:
+      await self.run_job(job.payload)
+      summary_jobs_total.inc(result="success")
+    except Exception:
+      logger.exception(f"failed to summarize ({key})")
+      summary_jobs_total.inc(result="error")
+    finished_at = time.monotonic()
+    summary_job_duration.observe(finished_at - started_at)
+    summary_job_latency.observe(finished_at - job.enqueued_at)
+    if job.coalesced:
+      logger.info(f"{key} summarized ({job.coalesced} requests coalesced)")
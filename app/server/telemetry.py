@@ -0,0 +1,153 @@
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+from server.metrics import Counter, Histogram
+
+# リクエストごとの処理時間の内訳(span)とメトリクス、サンプリングしたログ
+
+PAYLOAD_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+request_latency = Histogram("habit_request_latency_seconds", "Time to finish an HTTP request", ("endpoint",))
+requests_total = Counter("habit_requests_total", "HTTP requests", ("endpoint", "status"))
+payload_bytes = Histogram(
+  "habit_payload_bytes", "Size of request and response bodies", ("endpoint", "direction"), PAYLOAD_BUCKETS
+)
+model_call_latency = Histogram("habit_model_call_seconds", "Time spent in a single chat model call")
+model_tokens = Histogram("habit_model_tokens", "Tokens per chat model call", ("direction",), TOKEN_BUCKETS)
+tool_call_latency = Histogram("habit_tool_call_seconds", "Time spent in a single tool call", ("tool",))
+
+# 監視からの定期的なリクエストはDEBUGでログに出す
+QUIET_ENDPOINTS = ("/metrics", "/ready")
+
+logger = logging.getLogger("habit.infer_server")
+
+
+class RequestTimer:
+  def __init__(self, endpoint: str, sampled: bool, expose: bool):
+    self.endpoint = endpoint
+    # サンプリングされたリクエストだけメッセージの内容をログに出す
+    self.sampled = sampled
+    # Server-Timingヘッダ(ストリームの場合はdoneイベント)で内訳を返すか
+    self.expose = expose
+    self.started_at = time.monotonic()
+    self.spans: dict[str, float] = {}
+    self.counts: dict[str, int] = {}
+    self.fields: dict[str, Any] = {}
+
+  def add(self, name: str, seconds: float) -> None:
+    self.spans[name] = self.spans.get(name, 0.0) + seconds
+    self.counts[name] = self.counts.get(name, 0) + 1
+
+  @contextmanager
+  def span(self, name: str) -> Iterator[None]:
+    started_at = time.monotonic()
+    try:
+      yield
+    finally:
+      self.add(name, time.monotonic() - started_at)
+
+  def elapsed(self) -> float:
+    return time.monotonic() - self.started_at
+
+  def breakdown(self) -> dict[str, float]:
+    # ミリ秒
+    timing = {name: round(seconds * 1000, 1) for name, seconds in self.spans.items()}
+    timing["total"] = round(self.elapsed() * 1000, 1)
+    return timing
+
+  def server_timing(self) -> str:
+    return ", ".join(f"{name};dur={duration}" for name, duration in self.breakdown().items())
+
+
+current_timer: ContextVar[RequestTimer | None] = ContextVar("current_timer", default=None)
+
+
+def start_request(endpoint: str, sample_rate: float, expose: bool) -> RequestTimer:
+  timer = RequestTimer(endpoint, sampled=random.random() < sample_rate, expose=expose)
+  current_timer.set(timer)
+  return timer
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+  # リクエストの外(バックグラウンドのジョブなど)では何もしない
+  timer = current_timer.get()
+  if timer is None:
+    yield
+    return
+  with timer.span(name):
+    yield
+
+
+def record_tool_call(tool: str, seconds: float) -> None:
+  tool_call_latency.observe(seconds, tool=tool)
+  timer = current_timer.get()
+  if timer is not None:
+    timer.add("tool", seconds)
+
+
+def finish_request(timer: RequestTimer, status: int, request_size: int, response_size: int) -> None:
+  elapsed = timer.elapsed()
+  request_latency.observe(elapsed, endpoint=timer.endpoint)
+  requests_total.inc(endpoint=timer.endpoint, status=str(status))
+  payload_bytes.observe(request_size, endpoint=timer.endpoint, direction="request")
+  payload_bytes.observe(response_size, endpoint=timer.endpoint, direction="response")
+  record = {
+    "endpoint": timer.endpoint,
+    "status": status,
+    "request_bytes": request_size,
+    "response_bytes": response_size,
+    "timing_ms": timer.breakdown(),
+    **timer.fields,
+  }
+  level = logging.DEBUG if timer.endpoint in QUIET_ENDPOINTS else logging.INFO
+  logger.log(level, json.dumps(record, ensure_ascii=False))
+
+
+def log_messages(label: str, messages: list[BaseMessage], max_chars: int) -> None:
+  # 全リクエストで内容を出力すると重いので、サンプリングされたリクエストだけ出す
+  timer = current_timer.get()
+  if timer is None or not timer.sampled or not logger.isEnabledFor(logging.DEBUG):
+    return
+  for message in messages:
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    logger.debug(f"[{timer.endpoint}] {label} {message.__class__.__name__}: {content[:max_chars]}")
+
+
+# チャットモデルの呼び出しごとの時間とトークン数を記録する
+class ModelMetricsCallback(BaseCallbackHandler):
+  run_inline = True
+
+  def __init__(self):
+    self.started_at: dict[Any, float] = {}
+
+  def on_chat_model_start(self, serialized: dict[str, Any], messages: Any, *, run_id: Any, **kwargs: Any) -> None:
+    self.started_at[run_id] = time.monotonic()
+
+  def on_llm_end(self, response: LLMResult, *, run_id: Any, **kwargs: Any) -> None:
+    started_at = self.started_at.pop(run_id, None)
+    if started_at is not None:
+      seconds = time.monotonic() - started_at
+      model_call_latency.observe(seconds)
+      timer = current_timer.get()
+      if timer is not None:
+        timer.add("model", seconds)
+
+    for generations in response.generations:
+      for generation in generations:
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        if usage:
+          model_tokens.observe(usage.get("input_tokens", 0), direction="input")
+          model_tokens.observe(usage.get("output_tokens", 0), direction="output")
+
+  def on_llm_error(self, error: BaseException, *, run_id: Any, **kwargs: Any) -> None:
+    self.started_at.pop(run_id, None)
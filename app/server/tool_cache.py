@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Collection
+
+from mcp.types import CallToolResult
+from server.deadline import current_deadline, remaining
+from server.metrics import Counter, Gauge
+
+tool_cache_requests_total = Counter("habit_tool_cache_requests_total", "Tool cache lookups", ("tool", "result"))
+tool_cache_entries = Gauge("habit_tool_cache_entries", "Entries in the tool result cache")
+tool_cache_evictions_total = Counter("habit_tool_cache_evictions_total", "Entries evicted from the tool result cache")
+
+
+def normalize_text(value: Any) -> Any:
+  # 全角/半角や余分な空白だけが違う検索語を同じキーにする. 大文字/小文字は区別する
+  if isinstance(value, str):
+    return " ".join(unicodedata.normalize("NFKC", value).split())
+  return value
+
+
+def cache_key(tool: str, arguments: dict[str, Any], text_args: Collection[str] = ()) -> str:
+  # キーは引数そのままにし、ツールが自由文として指定した引数(検索語など)だけを正規化する
+  # URLやIDは大文字/小文字で別のものを指すので変えない
+  arguments = {name: normalize_text(value) if name in text_args else value for name, value in arguments.items()}
+  serialized = json.dumps([tool, arguments], sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+  return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+# MCPツールの結果のキャッシュ
+# 期限付きのLRUで、persist_pathを指定した場合はsqliteにも書き込み、再起動後も使う
+class ToolCache:
+  def __init__(self, max_entries: int, persist_path: str = ""):
+    self.max_entries = max_entries
+    self.entries: OrderedDict[str, tuple[float, CallToolResult]] = OrderedDict()
+    self.in_flight: dict[str, SharedCall] = {}
+    self.conn = None
+    self.writer: ThreadPoolExecutor | None = None
+    if persist_path:
+      self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tool-cache")
+      self.conn = sqlite3.connect(persist_path, check_same_thread=False)
+      self.conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tool_cache (
+          key TEXT PRIMARY KEY,
+          expires_at REAL NOT NULL,
+          result TEXT NOT NULL
+        )
+        """
+      )
+      self.conn.execute("DELETE FROM tool_cache WHERE expires_at < ?", (time.time(),))
+      self.conn.commit()
+      self._load()
+
+  def _load(self) -> None:
+    rows = self.conn.execute(
+      "SELECT key, expires_at, result FROM tool_cache ORDER BY expires_at DESC LIMIT ?", (self.max_entries,)
+    ).fetchall()
+    for key, expires_at, result in reversed(rows):
+      self.entries[key] = (expires_at, CallToolResult.model_validate_json(result))
+    tool_cache_entries.set(len(self.entries))
+
+  def get(self, key: str) -> CallToolResult | None:
+    entry = self.entries.get(key)
+    if entry is None:
+      return None
+    expires_at, result = entry
+    if expires_at < time.time():
+      del self.entries[key]
+      tool_cache_entries.set(len(self.entries))
+      return None
+    self.entries.move_to_end(key)
+    return result
+
+  def put(self, key: str, result: CallToolResult, ttl: float) -> None:
+    expires_at = time.time() + ttl
+    evicted_keys = []
+    self.entries[key] = (expires_at, result)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      evicted_key, _ = self.entries.popitem(last=False)
+      evicted_keys.append(evicted_key)
+      tool_cache_evictions_total.inc()
+    if self.writer is not None:
+      # sqliteへの書き込みはイベントループを止めないよう、書き込み用のスレッドで順に行う
+      self.writer.submit(self._persist, key, expires_at, result.model_dump_json(), evicted_keys)
+    tool_cache_entries.set(len(self.entries))
+
+  def _persist(self, key: str, expires_at: float, result: str, evicted_keys: list[str]) -> None:
+    try:
+      self.conn.executemany("DELETE FROM tool_cache WHERE key = ?", [(k,) for k in evicted_keys])
+      self.conn.execute(
+        "INSERT OR REPLACE INTO tool_cache (key, expires_at, result) VALUES (?, ?, ?)", (key, expires_at, result)
+      )
+      self.conn.commit()
+    except sqlite3.Error as e:
+      print(f"[tool cache]: failed to persist {key}: {e}")
+
+  def _start_call(self, key: str, ttl: float, call: Callable[[], Awaitable[CallToolResult]]) -> "SharedCall":
+    async def run() -> CallToolResult:
+      try:
+        result = await call()
+        # エラーの結果はキャッシュしない
+        if not result.isError:
+          self.put(key, result, ttl)
+        return result
+      finally:
+        if self.in_flight.get(key) is shared:
+          del self.in_flight[key]
+
+    # 期限は待っている呼び出しごとに付けるので、共有の呼び出しには最初のリクエストの期限を引き継がない
+    context = contextvars.copy_context()
+    context.run(current_deadline.set, None)
+    shared = SharedCall(asyncio.create_task(run(), context=context))
+    self.in_flight[key] = shared
+    return shared
+
+  async def get_or_call(
+    self,
+    tool: str,
+    arguments: dict[str, Any],
+    ttl: float,
+    call: Callable[[], Awaitable[CallToolResult]],
+    text_args: Collection[str] = (),
+  ) -> CallToolResult:
+    key = cache_key(tool, arguments, text_args)
+    result = self.get(key)
+    if result is not None:
+      tool_cache_requests_total.inc(tool=tool, result="hit")
+      return result
+
+    # 同じキーの呼び出しが同時に来た場合は1回の呼び出しを共有し、それぞれ自分の期限まで待つ
+    # 待っている呼び出しが全て諦めたら共有の呼び出しをキャンセルする
+    shared = self.in_flight.get(key)
+    if shared is not None:
+      tool_cache_requests_total.inc(tool=tool, result="coalesced")
+    else:
+      tool_cache_requests_total.inc(tool=tool, result="miss")
+      shared = self._start_call(key, ttl, call)
+    shared.waiters += 1
+    try:
+      async with asyncio.timeout(remaining()):
+        return await asyncio.shield(shared.task)
+    finally:
+      shared.waiters -= 1
+      if shared.waiters == 0 and not shared.task.done():
+        shared.task.cancel()
+
+
+class SharedCall:
+  def __init__(self, task: asyncio.Task):
+    self.task = task
+    self.waiters = 0
+    # 全員が待つのをやめた後に失敗した場合に、例外が取り出されないままになるのを防ぐ
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
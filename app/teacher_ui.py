@@ -1,35 +1,38 @@
 import ast
 import copy
 import json
+import uuid
 from collections import deque
 
 import firebase_admin
-import pandas as pd
-import requests
 import streamlit as st
 from common.firestore import (
   SHARE_LEVEL,
+  activity_cache,
   chat_history_to_str,
-  get_student_list,
-  load_student_activity_history,
-  load_student_info,
-  load_teacher_info,
   save_teacher_info,
   str_to_chat_history,
 )
-from common.params import DEBUG_MESSAGE_SIZE, INF_SERVER_URL, MAX_HISTORY_NUM, SEND_MSG_SIZE, TEACHER_PROMPT_GID
+from common.http_client import infer_client
+from common.inference import (
+  VIDEO_SEARCH_TOOL,
+  InferSession,
+  enqueue_summary,
+  prefetch_tool,
+  video_search_arguments,
+)
+from common.page_context import load_selected_student, load_teacher_page
+from common.params import DEBUG_MESSAGE_SIZE, MAX_HISTORY_NUM
 from common.utils import (
   BUTTON_STYLE_TEACHER,
-  SPREAD_SHEET_URL,
   create_achievement_goal_str,
   create_habit_goal_str,
-  get_system_prompt,
+  get_system_template,
   show_chat_history,
+  show_streaming_response,
 )
 from firebase_admin import firestore
-from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, ToolMessage
-from langchain_core.messages.base import messages_to_dict
-from langchain_core.messages.utils import messages_from_dict
+from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage
 
 # TODO: loggerを導入する
 DEBUG = False
@@ -49,9 +52,11 @@ st.markdown(
 )
 
 
-def create_chat_summary(chat_history: list[BaseMessage]) -> str:
-  print("---------- create summary ----------")
-  chat_hisutory_only_human = [message.content for message in chat_history if isinstance(message, HumanMessage)]
+def request_chat_summary(chat_history: list[BaseMessage], teacher_name: str, user_name: str) -> None:
+  print("---------- request summary ----------")
+  chat_hisutory_only_human = [
+    message for message in chat_history if isinstance(message, HumanMessage) and message.name != "calendar"
+  ]
   system_prompt = """
   ### タスク
   あなたはピラティスのインストラクターです。
@@ -60,30 +65,18 @@ def create_chat_summary(chat_history: list[BaseMessage]) -> str:
   先生が生徒に話しかけるような口調で一項目100文字以内でまとめてください。
   伝えるべきことがなければ「伝言はありません」と出力してください。
   """
-  system_message = SystemMessage(content=system_prompt)
-
-  user_prompt = f"""
-  ### ピラティスのインストラクターのメモ
-  {chat_hisutory_only_human}
-  """
-  user_message = HumanMessage(content=user_prompt)
-
-  json_input_data = messages_to_dict([system_message, user_message])
-  json_str = json.dumps(json_input_data, indent=2)
-  try:
-    # 推論
-    response = requests.post(INF_SERVER_URL + "/infer", json={"message": json_str})
-    json_data = response.json()
-    json_data = json.loads(json_data["response"])
-  except json.decoder.JSONDecodeError:
-    print("failed to parse json")
-    json_data = json_input_data
   try:
-    recevied_msgs = messages_from_dict(json_data)
+    # サマリは推論サーバがバックグラウンドで作成してFirestoreに書き込むので、完了を待たない
+    enqueue_summary(
+      kind="teacher",
+      user_name=user_name,
+      teacher_name=teacher_name,
+      system_prompt=system_prompt,
+      heading="ピラティスのインストラクターのメモ",
+      messages=chat_hisutory_only_human,
+    )
   except Exception as e:
     print(f"エラーが発生しました: {e}")
-    return ""
-  return recevied_msgs[-1].content
 
 
 @st.dialog("生徒の重点項目設定")
@@ -99,9 +92,11 @@ def set_instruction(teacher_name: str, user_name: str) -> None:
       teacher_name,
       user_name,
       chat_history_to_str(st.session_state.chat_history),
-      st.session_state.chat_summary,
+      None,
       st.session_state.instruction,
     )
+    # 生徒が習慣スタートを押したときに探す動画を先に検索しておく
+    prefetch_tool(VIDEO_SEARCH_TOOL, video_search_arguments(st.session_state.instruction), teacher_name)
     st.success("設定しました。")
     st.rerun()
 
@@ -112,13 +107,6 @@ def main() -> None:
   # =======================================
   st.title("HabitLink for Teacher")
 
-  # =======================================
-  # 利用可能なツールの取得
-  # =======================================
-  response = requests.get(INF_SERVER_URL + "/tools")
-  json_data = response.json()
-  json_data = json.loads(json_data["tools"])
-
   # =======================================
   # 先生の名前の取得
   # =======================================
@@ -136,10 +124,23 @@ def main() -> None:
   # 生徒の選択
   # TODO: user_nameはstudent nameにrenameする
   st.sidebar.header("生徒")
-  user_names = get_student_list(firebase_db)
-  user_name = st.sidebar.radio("状況を確認する生徒を選んでください", tuple(user_names))
-  if "student_info" not in st.session_state or st.session_state.student_info.user_name != user_name:
-    chat_history, chat_summary, instruction = load_teacher_info(firebase_db, teacher_name, user_name)
+
+  def is_new_student(name: str) -> bool:
+    return "student_info" not in st.session_state or st.session_state.student_info.user_name != name
+
+  # 生徒のリストやプロンプト、利用可能なツールと、前回の再実行で選ばれていた生徒のデータをまとめてロード
+  previous_user_name = st.session_state.get("selected_student", "")
+  page_context = load_teacher_page(
+    firebase_db, teacher_name, previous_user_name, bool(previous_user_name) and is_new_student(previous_user_name)
+  )
+  user_name = st.sidebar.radio(
+    "状況を確認する生徒を選んでください", tuple(page_context.student_names), key="selected_student"
+  )
+  if user_name != page_context.user_name:
+    page_context = load_selected_student(firebase_db, teacher_name, user_name, is_new_student(user_name), page_context)
+
+  if is_new_student(user_name):
+    chat_history, chat_summary, instruction = page_context.teacher_info
     if chat_history:
       st.session_state.chat_history = str_to_chat_history(chat_history)
     else:
@@ -148,8 +149,8 @@ def main() -> None:
     st.session_state.chat_summary = chat_summary
     st.session_state.instruction = instruction
 
-  st.session_state.student_info = load_student_info(firebase_db, user_name)
-  st.session_state.activity_history = load_student_activity_history(firebase_db, user_name)
+  st.session_state.student_info = page_context.student_info
+  st.session_state.activity_history = page_context.activity.activity_history
   print(f"Loaded student name: {st.session_state.student_info.user_name}")
 
   st.sidebar.header(f"{user_name}さんの実施実績")
@@ -189,7 +190,7 @@ def main() -> None:
     st.sidebar.write("まだ設定されていません")
 
   # st.sidebar.header("Tools")
-  # for name in json_data.keys():
+  # for name in page_context.tools.keys():
   #   st.sidebar.write(f"{name}")
 
   # =======================================
@@ -228,8 +229,7 @@ def main() -> None:
   else:
     student_agent_chat_summary = "まだサマリは作成されていません"
 
-  url = f"{SPREAD_SHEET_URL}&gid={TEACHER_PROMPT_GID}"
-  spreadsheet_df = pd.read_csv(url, header=None)
+  prompt_sheet = page_context.prompt_sheet
 
   phase = 2 if st.session_state.student_info.goal else 1
   if phase == 1:
@@ -238,7 +238,7 @@ def main() -> None:
     goal = create_achievement_goal_str(st.session_state.student_info)
     goal += "\n"
     goal += create_habit_goal_str(st.session_state.student_info)
-  system_prompt = get_system_prompt(phase=phase, df=spreadsheet_df)
+  system_template = get_system_template(phase=phase, sheet=prompt_sheet)
   activity_history_for_prompt = [
     history.start_time.strftime("%Y-%m-%d") for history in st.session_state.activity_history
   ]
@@ -250,25 +250,21 @@ def main() -> None:
     "activity_history": activity_history_for_prompt,
     "student_agent_chat": student_agent_chat_summary,
   }
-  system_prompt = system_prompt.format(**value)
-  st.session_state.system_prompt = system_prompt
-
-  # =======================================
-  # チャット履歴の描画
-  # =======================================
-  # TODO: chat_historyを適宜DBに保存して読み出す
-  show_chat_history(firebase_db, st.session_state.chat_history, user_name)
+  system_prompt = system_template.render(value)
+  st.session_state.system_prompt = system_prompt.text
+  st.session_state.system_prompt_tokens = system_prompt.tokens
 
   # =======================================
   # ユーザの入力を受け付けて推論する
   # =======================================
+  # 入力欄は画面の下に固定されるので、履歴を描画する前に入力を受け取り、増えたメッセージを履歴に加えてから1回だけ描画する
   chat_input = st.chat_input("何でも入力してね")
   temporary_message = None
   calendar_message = None
   if st.session_state.temporary_message:
     temporary_message = st.session_state.temporary_message
     st.session_state.temporary_message = ""
-    calendar_message = HumanMessage(content="test", name="calendar")
+    calendar_message = HumanMessage(content="test", name="calendar", id=str(uuid.uuid4()))
 
   user_input = ""
   if chat_input:
@@ -277,18 +273,19 @@ def main() -> None:
     user_input = temporary_message
 
   if user_input:
-    st.session_state.chat_history.append(HumanMessage(content=user_input))
+    st.session_state.chat_history.append(HumanMessage(content=user_input, id=str(uuid.uuid4())))
   if calendar_message:
     st.session_state.chat_history.append(calendar_message)
 
   # カレンダーの描画などを行うとrerunが走る可能性があるため、事前にsession_stateに保存する
   st.session_state.user_input = user_input
 
-  # カレンダーの描画等
-  if user_input:
-    show_chat_history(firebase_db, [HumanMessage(content=user_input)], user_name)
+  # =======================================
+  # チャット履歴の描画(カレンダーは追加したものを含めて最後の1つだけ描画される)
+  # =======================================
+  # TODO: chat_historyを適宜DBに保存して読み出す
+  show_chat_history(page_context.activity, st.session_state.chat_history, window_key=f"chat_window/{user_name}")
   if calendar_message:
-    show_chat_history(firebase_db, [calendar_message], user_name)
     st.rerun()
 
   if st.session_state.user_input:
@@ -296,68 +293,47 @@ def main() -> None:
     st.session_state.user_input = ""
 
   if user_input:
-    with st.spinner("AI agent is typing..."):
-      # 会話履歴 + ユーザの入力をjsonにしてAPIで推論サーバにpost
-      print("=================================")
-
-      # すべての履歴を送ると推論に時間がかかるので直近の数個を送る
-      # chat_historyにSystemMessageは無いため先頭に付与する
-      chat_history = copy.copy(list(st.session_state.chat_history)[-SEND_MSG_SIZE:])
-      chat_history.insert(0, SystemMessage(content=f"{st.session_state.system_prompt}", id=0))
-      sent_message_len = len(chat_history)
-
-      if DEBUG:
-        print("---------- [UI]: send data to infer server ----------")
-        for message in chat_history:
-          print(
-            f"{message.__class__.__name__}(name: {message.name}, id: {message.id}): {message.content[:DEBUG_MESSAGE_SIZE]}"
-          )
-
-      json_input_data = messages_to_dict(chat_history)
-      json_str = json.dumps(json_input_data, indent=2)
-      try:
-        # 推論
-        response = requests.post(INF_SERVER_URL + "/infer", json={"message": json_str})
-
-        json_data = response.json()
-        json_data = json.loads(json_data["response"])
-      except json.decoder.JSONDecodeError:
-        print("failed to parse json")
-        json_data = json_input_data
-
-      # 推論サーバからデータがjsonで来るのでlangchainのオブジェクトに変換
-      try:
-        recevied_msgs = messages_from_dict(json_data)
-      except Exception as e:
-        print(f"エラーが発生しました: {e}")
-        recevied_msgs = []
-      if DEBUG:
-        print("---------- [UI]: receved data from infer server ----------")
-
-      # 送信したメッセージに対して受信で増えた分だけを履歴に追加
-      chat_history = copy.copy(st.session_state.chat_history)
-      for message in recevied_msgs[sent_message_len:]:
-        chat_history.append(message)
-      st.session_state.chat_history = chat_history
-
-    # チャットサマリの作成
-    chat_history_for_summary = copy.deepcopy(st.session_state.chat_history)
-    summary = create_chat_summary(chat_history_for_summary)
-    st.session_state.chat_summary = summary
+    # 推論サーバ側で会話履歴を保持しているので、増えたメッセージとシステムプロンプトの差分だけを送る
+    print("=================================")
+    session_id = f"teacher/{teacher_name}/{user_name}"
+    if "infer_session" not in st.session_state or st.session_state.infer_session.session_id != session_id:
+      st.session_state.infer_session = InferSession(session_id, teacher_name)
 
-    # 推論サーバが追加で返してきた分のみ描画する
-    show_chat_history(firebase_db, recevied_msgs[sent_message_len:], user_name)
+    if DEBUG:
+      print(
+        f"---------- [UI]: send data to infer server ({session_id}, "
+        f"system prompt: {st.session_state.system_prompt_tokens} tokens) ----------"
+      )
+
+    # 推論サーバから届いたトークンやツールの実行状況を逐次描画する
+    # 推論サーバは増えた分のメッセージだけを返す
+    recevied_msgs = show_streaming_response(
+      st.session_state.infer_session.stream(st.session_state.chat_history, st.session_state.system_prompt)
+    )
+    if DEBUG:
+      print("---------- [UI]: receved data from infer server ----------")
+      print(f"[UI]: infer client stats: {infer_client.stats()}")
+      print(f"[UI]: activity cache stats: {activity_cache.stats()}")
 
-    # chat情報の保存
+    chat_history = copy.copy(st.session_state.chat_history)
+    for message in recevied_msgs:
+      chat_history.append(message)
+    st.session_state.chat_history = chat_history
+
+    # chat情報の保存(サマリは推論サーバが書き込むので上書きしない)
     save_teacher_info(
       firebase_db,
       teacher_name,
       user_name,
       chat_history_to_str(st.session_state.chat_history),
-      st.session_state.chat_summary,
+      None,
       st.session_state.instruction,
     )
 
+    # チャットサマリの作成を依頼する
+    chat_history_for_summary = copy.deepcopy(st.session_state.chat_history)
+    request_chat_summary(chat_history_for_summary, teacher_name, user_name)
+
     # for debug
     if DEBUG:
       for message in recevied_msgs:
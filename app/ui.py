@@ -1,39 +1,45 @@
 import ast
 import copy
 import json
+import uuid
 from datetime import datetime
 
 import firebase_admin
-import pandas as pd
-import requests
 import streamlit as st
 from common.firestore import (
   SHARE_LEVEL,
   ActivityData,
   StudentInfo,
-  load_student_activity_history,
-  load_student_info,
-  load_teacher_info,
+  activity_cache,
   save_student_activity_data,
   save_student_info,
   save_teacher_info,
 )
-from common.params import DEBUG_MESSAGE_SIZE, INF_SERVER_URL, JST, SEND_MSG_SIZE, STUDENT_PROMPT_GID
+from common.http_client import infer_client
+from common.inference import (
+  VIDEO_SEARCH_TOOL,
+  InferSession,
+  call_tool,
+  enqueue_summary,
+  prefetch_tool,
+  video_search_arguments,
+)
+from common.page_context import load_student_page
+from common.params import DEBUG_MESSAGE_SIZE, JST, SEND_MSG_SIZE
+from common.prompt_store import PromptSheet
 from common.utils import (
   BUTTON_STYLE_STUDENT,
-  SPREAD_SHEET_URL,
   ActivityType,
   HabitFrequency,
   create_achievement_goal_str,
   create_habit_goal_str,
   get_summarize_prompt,
-  get_system_prompt,
+  get_system_template,
   show_chat_history,
+  show_streaming_response,
 )
 from firebase_admin import firestore
-from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, ToolMessage
-from langchain_core.messages.base import messages_to_dict
-from langchain_core.messages.utils import messages_from_dict
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
 from pyparsing import deque
 
 st.set_page_config(page_title="HabitLink for Student")
@@ -54,35 +60,23 @@ st.markdown(
 )
 
 
-def create_chat_summary(chat_history: deque[BaseMessage], df: pd.DataFrame, student_info: StudentInfo) -> str:
-  print("---------- create summary ----------")
+def request_chat_summary(chat_history: deque[BaseMessage], sheet: PromptSheet, student_info: StudentInfo) -> None:
+  print("---------- request summary ----------")
   chat_history_only_human = [
-    message.content for message in chat_history if isinstance(message, HumanMessage) and message.name != "calendar"
+    message for message in chat_history if isinstance(message, HumanMessage) and message.name != "calendar"
   ]
-  system_prompt = get_summarize_prompt(student_info.share_level, df)
-  system_message = SystemMessage(content=system_prompt)
-  user_prompt = f"""
-  ### 生徒の会話
-  {chat_history_only_human}
-  """
-  user_message = HumanMessage(content=user_prompt)
-
-  json_input_data = messages_to_dict([system_message, user_message])
-  json_str = json.dumps(json_input_data, indent=2)
+  system_prompt = get_summarize_prompt(student_info.share_level, sheet)
   try:
-    # 推論
-    response = requests.post(INF_SERVER_URL + "/infer", json={"message": json_str})
-    json_data = response.json()
-    json_data = json.loads(json_data["response"])
-  except json.decoder.JSONDecodeError:
-    print("failed to parse json")
-    json_data = json_input_data
-  try:
-    recevied_msgs = messages_from_dict(json_data)
+    # サマリは推論サーバがバックグラウンドで作成してFirestoreに書き込むので、完了を待たない
+    enqueue_summary(
+      kind="student",
+      user_name=student_info.user_name,
+      system_prompt=system_prompt,
+      heading="生徒の会話",
+      messages=chat_history_only_human,
+    )
   except Exception as e:
     print(f"エラーが発生しました: {e}")
-    return ""
-  return recevied_msgs[-1].content
 
 
 def start_activity(user_name: str, instruction_from_teacher: str):
@@ -96,6 +90,19 @@ def start_activity(user_name: str, instruction_from_teacher: str):
     created_at=now_jst,
   )
   save_student_activity_data(firebase_db, user_name, activity_data)
+
+  # 先読みしておいた動画の検索結果を、エージェントのツール呼び出しとして履歴に入れる
+  # エージェントは検索をせずに結果の紹介だけを行うので、すぐに返答できる
+  args = video_search_arguments(instruction_from_teacher)
+  tool_call_id = str(uuid.uuid4())
+  tool_message = call_tool(VIDEO_SEARCH_TOOL, args, tool_call_id, user_name)
+  if tool_message is not None:
+    tool_call = {"id": tool_call_id, "name": VIDEO_SEARCH_TOOL, "args": args}
+    st.session_state.prefetched_messages = [
+      AIMessage(content="", tool_calls=[tool_call], id=str(uuid.uuid4())),
+      tool_message,
+    ]
+
   if instruction_from_teacher:
     msg = f"ピラティスを始めます。先生からの指示である「{instruction_from_teacher}」に関する動画を探してください。"
   else:
@@ -151,6 +158,7 @@ def set_goal(user_name: str):
       save_student_info(
         firebase_db=firebase_db,
         student_info=st.session_state.student_info,
+        include_summary=True,
       )
 
       save_teacher_info(
@@ -184,6 +192,7 @@ def reset_goal(user_name: str):
     save_student_info(
       firebase_db=firebase_db,
       student_info=st.session_state.student_info,
+      include_summary=True,
     )
     st.success("リセットしました。")
     st.session_state.temporary_message = """
@@ -251,13 +260,6 @@ def main() -> None:
   # =======================================
   st.title("HabitLink for Student")
 
-  # =======================================
-  # 利用可能なツールの取得
-  # =======================================
-  response = requests.get(INF_SERVER_URL + "/tools")
-  json_data = response.json()
-  json_data = json.loads(json_data["tools"])
-
   # =======================================
   # サイドバー
   # =======================================
@@ -274,18 +276,29 @@ def main() -> None:
     st.error("URLに生徒名と先生名を設定してください(?user_name=your name&teacher_name=your teacher name)。")
     return
 
-  if "student_info" not in st.session_state or st.session_state.student_info.user_name != user_name:
+  # =======================================
+  # DBからユーザのデータやプロンプト、利用可能なツールをまとめてロード
+  # =======================================
+  same_student = "student_info" in st.session_state and st.session_state.student_info.user_name == user_name
+  page_context = load_student_page(
+    firebase_db, user_name, teacher_name, st.session_state.student_info if same_student else None
+  )
+  if not same_student:
     # ユーザ名が変わったら目標をロードしなおしてチャット履歴もクリア
-    st.session_state.student_info = load_student_info(firebase_db, user_name)
+    st.session_state.student_info = page_context.student_info
     print(f"Loaded student name: {st.session_state.student_info.user_name}")
 
-    # 先生とエージェント間で行われた会話履歴と生徒への指示をロード
-  _, teacher_agent_chat_summary, instruction_from_teacher = load_teacher_info(
-    firebase_db, teacher_name, st.session_state.student_info.user_name
-  )
+  # 先生とエージェント間で行われた会話履歴と生徒への指示
+  teacher_agent_chat_summary = page_context.teacher_agent_chat_summary
+  instruction_from_teacher = page_context.instruction_from_teacher
   st.session_state.instruction_from_teacher = instruction_from_teacher
   st.session_state.teacher_agent_chat_summary = teacher_agent_chat_summary
 
+  # 習慣スタートで探す動画を先に検索してキャッシュさせておく
+  if st.session_state.get("prefetched_instruction") != instruction_from_teacher:
+    prefetch_tool(VIDEO_SEARCH_TOOL, video_search_arguments(instruction_from_teacher), user_name)
+    st.session_state.prefetched_instruction = instruction_from_teacher
+
   # if st.button("習慣スタート", disabled=not bool(st.session_state.student_info.goal), type="primary"):
   #   start_activity(st.session_state.student_info.user_name, st.session_state.instruction_from_teacher)
 
@@ -359,7 +372,7 @@ def main() -> None:
   #   reset_goal(st.session_state.student_info.user_name)
 
   # st.sidebar.header("Tools")
-  # for name in json_data.keys():
+  # for name in page_context.tools.keys():
   #   st.sidebar.write(f"{name}")
 
   # =======================================
@@ -385,15 +398,8 @@ def main() -> None:
   st.header(f"こんにちは {st.session_state.student_info.user_name}さん!")
   st.warning("注意: 使い終わったら必ずブラウザや本タブを閉じてください")
 
-  # =======================================
-  # DBからユーザのデータやプロンプトをロード
-  # =======================================
-  url = f"{SPREAD_SHEET_URL}&gid={STUDENT_PROMPT_GID}"
-  spreadsheet_df = pd.read_csv(url, header=None)
-
-  st.session_state.activity_history = load_student_activity_history(
-    firebase_db, st.session_state.student_info.user_name
-  )
+  prompt_sheet = page_context.prompt_sheet
+  st.session_state.activity_history = page_context.activity.activity_history
 
   activity_history_for_prompt = [
     history.start_time.strftime("%Y-%m-%d") for history in st.session_state.activity_history
@@ -408,28 +414,21 @@ def main() -> None:
     goal += ","
     goal += create_habit_goal_str(st.session_state.student_info)
 
-  system_prompt = get_system_prompt(phase=phase, df=spreadsheet_df)
+  system_template = get_system_template(phase=phase, sheet=prompt_sheet)
   value = {
     "user_name": st.session_state.student_info.user_name,
     "habit_goal": goal,
     "activity_history": activity_history_for_prompt,
     "teacher_agent_chat": teacher_agent_chat_summary,
   }
-  system_prompt = system_prompt.format(**value)
-  st.session_state.system_prompt = system_prompt
-
-  # =======================================
-  # チャット履歴の描画
-  # =======================================
-  show_chat_history(
-    firebase_db,
-    st.session_state.student_info.chat_history,
-    st.session_state.student_info.user_name,
-  )
+  system_prompt = system_template.render(value)
+  st.session_state.system_prompt = system_prompt.text
+  st.session_state.system_prompt_tokens = system_prompt.tokens
 
   # =======================================
   # ユーザの入力を受け付けて推論する
   # =======================================
+  # 入力欄は画面の下に固定されるので、履歴を描画する前に入力を受け取り、増えたメッセージを履歴に加えてから1回だけ描画する
   chat_input = st.chat_input("何でも入力してね")
   temporary_message = None
   calendar_message = None
@@ -439,7 +438,7 @@ def main() -> None:
 
     # TODO:
     # - firestoreのデータを読み取りデータをchat_historyに入れる
-    calendar_message = HumanMessage(content="test", name="calendar")
+    calendar_message = HumanMessage(content="test", name="calendar", id=str(uuid.uuid4()))
 
   user_input = ""
   if chat_input:
@@ -448,84 +447,63 @@ def main() -> None:
     user_input = temporary_message
 
   if user_input:
-    st.session_state.student_info.chat_history.append(HumanMessage(content=user_input))
+    st.session_state.student_info.chat_history.append(HumanMessage(content=user_input, id=str(uuid.uuid4())))
   if calendar_message:
     st.session_state.student_info.chat_history.append(calendar_message)
+  if temporary_message and st.session_state.get("prefetched_messages"):
+    st.session_state.student_info.chat_history.extend(st.session_state.prefetched_messages)
+    st.session_state.prefetched_messages = []
 
   # カレンダーの描画などを行うとrerunが走る可能性があるため、事前にsession_stateに保存する
   st.session_state.user_input = user_input
 
-  # カレンダーの描画等
-  if user_input:
-    show_chat_history(
-      firebase_db,
-      [HumanMessage(content=user_input)],
-      st.session_state.student_info.user_name,
-    )
-  if calendar_message:
-    show_chat_history(
-      firebase_db,
-      [calendar_message],
-      st.session_state.student_info.user_name,
-    )
+  # =======================================
+  # チャット履歴の描画(カレンダーは追加したものを含めて最後の1つだけ描画される)
+  # =======================================
+  show_chat_history(
+    page_context.activity,
+    st.session_state.student_info.chat_history,
+    window_key=f"chat_window/{user_name}",
+  )
 
   if st.session_state.user_input:
     user_input = st.session_state.user_input
     st.session_state.user_input = ""
 
   if user_input:
-    with st.spinner("AI agent is typing..."):
-      # 会話履歴 + ユーザの入力をjsonにしてAPIで推論サーバにpost
-      print("=================================")
-
-      # すべての履歴を送ると推論に時間がかかるので直近の数個を送る
-      # chat_historyにSystemMessageは無いため先頭に付与する
-      chat_history = copy.copy(list(st.session_state.student_info.chat_history)[-SEND_MSG_SIZE:])
-      chat_history.insert(0, SystemMessage(content=f"{st.session_state.system_prompt}", id=0))
-      sent_message_len = len(chat_history)
-
-      if DEBUG:
-        print("---------- [UI]: send data to infer server ----------")
-        for message in chat_history:
-          print(
-            f"{message.__class__.__name__}(name: {message.name}, id: {message.id}): {message.content[:DEBUG_MESSAGE_SIZE]}"
-          )
-
-      json_input_data = messages_to_dict(chat_history)
-      json_str = json.dumps(json_input_data, indent=2)
-      try:
-        # 推論
-        response = requests.post(INF_SERVER_URL + "/infer", json={"message": json_str})
-
-        json_data = response.json()
-        json_data = json.loads(json_data["response"])
-      except json.decoder.JSONDecodeError:
-        print("failed to parse json")
-        json_data = json_input_data
-
-      # 推論サーバからデータがjsonで来るのでlangchainのオブジェクトに変換
-      try:
-        recevied_msgs = messages_from_dict(json_data)
-      except Exception as e:
-        print(f"エラーが発生しました: {e}")
-        recevied_msgs = []
-      # 送信したメッセージに対して受信で増えた分だけを履歴に追加
-      chat_history = copy.copy(st.session_state.student_info.chat_history)
-      for message in recevied_msgs[sent_message_len:]:
-        chat_history.append(message)
-      st.session_state.student_info.chat_history = chat_history
-
-    # チャットサマリの作成
-    chat_history_for_summary = copy.deepcopy(st.session_state.student_info.chat_history)
-    summary = create_chat_summary(
-      chat_history_for_summary, df=spreadsheet_df, student_info=st.session_state.student_info
+    # 推論サーバ側で会話履歴を保持しているので、増えたメッセージとシステムプロンプトの差分だけを送る
+    print("=================================")
+    session_id = f"student/{user_name}"
+    if "infer_session" not in st.session_state or st.session_state.infer_session.session_id != session_id:
+      st.session_state.infer_session = InferSession(session_id, user_name)
+
+    if DEBUG:
+      print(
+        f"---------- [UI]: send data to infer server ({session_id}, "
+        f"system prompt: {st.session_state.system_prompt_tokens} tokens) ----------"
+      )
+
+    # 推論サーバから届いたトークンやツールの実行状況を逐次描画する
+    # 推論サーバは増えた分のメッセージだけを返す
+    recevied_msgs = show_streaming_response(
+      st.session_state.infer_session.stream(st.session_state.student_info.chat_history, st.session_state.system_prompt)
     )
-    st.session_state.student_info.chat_summary = summary
+    if DEBUG:
+      print("---------- [UI]: receved data from infer server ----------")
+      print(f"[UI]: infer client stats: {infer_client.stats()}")
+      print(f"[UI]: activity cache stats: {activity_cache.stats()}")
+
+    chat_history = copy.copy(st.session_state.student_info.chat_history)
+    for message in recevied_msgs:
+      chat_history.append(message)
+    st.session_state.student_info.chat_history = chat_history
 
-    # 推論サーバが追加で返してきた分のみ描画する
-    show_chat_history(firebase_db, recevied_msgs[sent_message_len:], user_name)
     # chat historyの保存
     save_student_info(firebase_db, st.session_state.student_info)
+
+    # チャットサマリの作成を依頼する
+    chat_history_for_summary = copy.deepcopy(st.session_state.student_info.chat_history)
+    request_chat_summary(chat_history_for_summary, sheet=prompt_sheet, student_info=st.session_state.student_info)
     # for debug
     if DEBUG:
       print("---------- [UI]: receved data from infer server ----------")